@@ -0,0 +1,59 @@
+import json
+import time
+
+# A batch is sent once it holds MAX_BATCH_MESSAGES messages or its
+# oldest message has waited MAX_BATCH_DELAY_SEC, whichever comes first
+MAX_BATCH_MESSAGES = 8
+MAX_BATCH_DELAY_SEC = 0.02
+
+
+# Collects outgoing messages (dicts with a "command") and sends them together as
+# one {"command": "batch", "messages": [...]} message, so encryption and the send
+# call are paid once per batch. A batch of one is sent as the plain message.
+class BatchSender():
+
+    def __init__(self, send, maxMessages=MAX_BATCH_MESSAGES, maxDelay=MAX_BATCH_DELAY_SEC):
+        # send is called with the json string of every batch and the number of samples in it
+        self.send = send
+        self.maxMessages = maxMessages
+        self.maxDelay = maxDelay
+        self.messages = []
+        self.samples = 0
+        self.deadline = None
+
+        # Counters
+        self.batchesSent = 0
+        self.messagesSent = 0
+
+    def add(self, message, samples=0):
+        # samples is the number of bluno samples message carries
+        if not self.messages:
+            self.deadline = time.monotonic() + self.maxDelay
+        self.messages.append(message)
+        self.samples += samples
+        if len(self.messages) >= self.maxMessages:
+            self.flush()
+
+    def timeout(self):
+        # Seconds until the pending batch is due, None if nothing is pending
+        if not self.messages:
+            return None
+        return max(0, self.deadline - time.monotonic())
+
+    def flushIfDue(self):
+        if self.messages and time.monotonic() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        if not self.messages:
+            return
+        if len(self.messages) == 1:
+            message = self.messages[0]
+        else:
+            message = {"command": "batch", "messages": self.messages}
+        self.send(json.dumps(message), self.samples)
+        self.batchesSent += 1
+        self.messagesSent += len(self.messages)
+        self.messages = []
+        self.samples = 0
+        self.deadline = None
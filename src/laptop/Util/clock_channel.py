@@ -0,0 +1,47 @@
+import socket
+import struct
+import time
+
+# Clock sync over its own TCP connection, so the exchange never queues behind move
+# data on the data socket (a UDP socket would be lighter, but the ssh tunnels to the
+# ultra96 only forward TCP). The laptop connects to the data port + CLOCK_PORT_OFFSET
+# and identifies with one encrypted frame holding its dancer ID, like on the data
+# socket. After that both sides only exchange fixed size plain packets
+#   uint8 type, 3 pad bytes, uint32 round, float64 t1, t2, t3, t4 (network order)
+# in rounds of
+#   server SYNC -> laptop REQUEST(t1) -> server REPLY(t1, t2, t3) -> laptop RESULT(t1..t4)
+# Timestamps are taken right next to the recv and send calls, nothing is decoded,
+# decrypted or logged in between. Servers or laptops without the channel keep using
+# the clocksync and offset commands of the data socket.
+
+CLOCK_PORT_OFFSET = 1
+PACKET = struct.Struct('!BxxxIdddd')
+
+# Packet types
+SYNC = 1
+REQUEST = 2
+REPLY = 3
+RESULT = 4
+
+
+def packPacket(packetType, number, t1=0.0, t2=0.0, t3=0.0, t4=0.0):
+    return PACKET.pack(packetType, number, t1, t2, t3, t4)
+
+
+def setNoDelay(sock):
+    # No Nagle delay for the small packets
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def recvPacket(sock, buffer):
+    # Blocks until a whole packet is in buffer (a bytearray of PACKET.size), returns
+    # (type, round, t1, t2, t3, t4) and the time the last of it was received
+    view = memoryview(buffer)
+    received = 0
+    while received < PACKET.size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("clock channel closed")
+        received += count
+    recvTime = time.time()
+    return PACKET.unpack(buffer), recvTime
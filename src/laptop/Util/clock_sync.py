@@ -0,0 +1,129 @@
+from collections import deque, namedtuple
+import math
+
+# NTP style clock sync between a laptop (local clock) and the ultra96 (remote clock).
+# Every exchange gives four timestamps: t1 request sent and t4 reply received on the
+# local clock, t2 request received and t3 reply sent on the remote clock. Each gives
+#   offset = ((t2 - t1) + (t3 - t4)) / 2     remote - local, at local time (t1 + t4) / 2
+#   rtt    = (t4 - t1) - (t3 - t2)
+# and the true offset is within rtt / 2 of it, so only the lowest rtt samples of a
+# window are kept. A line offset + skew * (t - reference) is fitted through them so
+# drift between syncs is extrapolated, and error() estimates how far off the offset
+# may be at a given time, which is what decides when to sync again.
+#
+# The same class runs on both sides: the laptop to compute the offset it reports,
+# the server to convert each dancer's timestamps and to schedule its sync rounds.
+
+# Samples remembered, and the fraction of them with the lowest rtt used for the fit
+WINDOW_SIZE = 32
+KEEP_FRACTION = 0.5
+# Fewer samples than this are not enough to trust the offset
+MIN_SAMPLES = 4
+# The skew is only fitted once the kept samples span this long, before that it's noise
+MIN_SKEW_SPAN_SEC = 20
+# Assumed relative drift of two clocks while there's no skew estimate (crystals are +-50 ppm)
+MAX_DRIFT = 100e-6
+# Offsets less certain than this need a sync
+MAX_ERROR_SEC = 0.01
+# Even an accurate model is refreshed this often
+MAX_SYNC_INTERVAL_SEC = 60
+
+ClockSample = namedtuple("ClockSample", ["time", "offset", "rtt"])
+
+
+def clockSample(t1, t2, t3, t4):
+    return ClockSample((t1 + t4) / 2, ((t2 - t1) + (t3 - t4)) / 2, (t4 - t1) - (t3 - t2))
+
+
+class ClockSync():
+
+    def __init__(self, windowSize=WINDOW_SIZE, keepFraction=KEEP_FRACTION, maxError=MAX_ERROR_SEC):
+        self.samples = deque(maxlen=windowSize)
+        self.keepFraction = keepFraction
+        self.maxError = maxError
+        self.syncCount = 0
+
+        # The fitted model, see fit()
+        self.reference = 0.0
+        self.intercept = 0.0
+        self.skew = 0.0
+        self.skewError = MAX_DRIFT
+        self.residual = 0.0
+        self.minRtt = math.inf
+
+    def addSample(self, t1, t2, t3, t4):
+        # Returns the sample made of the four timestamps
+        sample = clockSample(t1, t2, t3, t4)
+        if sample.rtt < 0:
+            # the clocks can't have moved backwards, a timestamp is bad
+            return sample
+        self.samples.append(sample)
+        self.syncCount += 1
+        self.fit()
+        return sample
+
+    def addOffset(self, localTime, offset):
+        # An offset computed elsewhere without its timestamps, taken as exact
+        return self.addSample(localTime, localTime + offset, localTime + offset, localTime)
+
+    def fit(self):
+        count = max(min(MIN_SAMPLES, len(self.samples)), int(len(self.samples) * self.keepFraction))
+        kept = sorted(self.samples, key=lambda sample: sample.rtt)[:count]
+        self.minRtt = kept[0].rtt
+        self.reference = sum(sample.time for sample in kept) / count
+        meanOffset = sum(sample.offset for sample in kept) / count
+        spread = sum((sample.time - self.reference) ** 2 for sample in kept)
+
+        span = max(sample.time for sample in kept) - min(sample.time for sample in kept)
+        if count > 2 and span >= MIN_SKEW_SPAN_SEC:
+            self.skew = sum((sample.time - self.reference) * (sample.offset - meanOffset) for sample in kept) / spread
+        else:
+            self.skew = 0.0
+        self.intercept = meanOffset
+
+        squares = sum((sample.offset - self.offset(sample.time)) ** 2 for sample in kept)
+        degrees = count - 2 if self.skew else count - 1
+        self.residual = math.sqrt(squares / degrees) if degrees > 0 else 0.0
+        if self.skew:
+            self.skewError = self.residual / math.sqrt(spread)
+        else:
+            self.skewError = MAX_DRIFT
+
+    def offset(self, localTime):
+        # remote - local clock at localTime, 0 until the first sample
+        return self.intercept + self.skew * (localTime - self.reference)
+
+    def toRemote(self, localTime):
+        return localTime + self.offset(localTime)
+
+    def toLocal(self, remoteTime):
+        # the offset changes by microseconds over the difference, no need to iterate
+        return remoteTime - self.offset(remoteTime)
+
+    def error(self, localTime):
+        # How far off offset(localTime) may be: the asymmetry the best sample allows,
+        # the scatter around the fit and the drift since the samples it's based on
+        if len(self.samples) < MIN_SAMPLES:
+            return math.inf
+        return self.minRtt / 2 + self.residual + self.skewError * abs(localTime - self.reference)
+
+    def needsSync(self, localTime):
+        return self.error(localTime) > self.maxError
+
+    def nextSyncDelay(self, localTime):
+        # Seconds until the error grows over maxError, 0 if it already has
+        error = self.error(localTime)
+        if error > self.maxError:
+            return 0.0
+        if self.skewError == 0:
+            return MAX_SYNC_INTERVAL_SEC
+        return min((self.maxError - error) / self.skewError, MAX_SYNC_INTERVAL_SEC)
+
+    def state(self, localTime):
+        return {
+            "offset": self.offset(localTime),
+            "skewPpm": self.skew * 1e6,
+            "errorMs": self.error(localTime) * 1000,
+            "minRttMs": self.minRtt * 1000,
+            "samples": len(self.samples),
+        }
@@ -1,11 +1,36 @@
 import socket
+import os
+import random
+import struct
+import threading
 from Cryptodome.Cipher import AES
+from Cryptodome.Hash import SHA256
+from Cryptodome.Protocol.KDF import HKDF
 from Cryptodome.Util.Padding import pad, unpad
 from Cryptodome.Random import get_random_bytes
 from base64 import b64encode, b64decode, decode
 from getpass import getpass
 import json
 
+try:
+    # Reusable AES-GCM context, much cheaper per message than a new Cryptodome cipher
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+# Session mode: AES-GCM with a key derived per connection at identification
+SESSION_NONCE_BYTES = 16
+SESSION_KEY_BYTES = 16
+# GCM nonce: uint32 stream, uint64 counter. The top bit of the stream is the direction,
+# the rest is random per process, so forked processes sharing a session never reuse a nonce
+GCM_NONCE = struct.Struct('!IQ')
+GCM_TAG_BYTES = 16
+SERVER_STREAM = 0x80000000
+# Frames of a stream may arrive out of counter order (encrypted when queued, sent later),
+# counters this far behind the highest one seen are still accepted once
+REPLAY_WINDOW = 1024
+
 # Class to handle AES encryption and decryption, initialized at start with secret sixteen bit key
 class EncryptionHandler():
 
@@ -29,4 +54,88 @@ class EncryptionHandler():
         decrypted_message = cipher.decrypt(decoded_message[16:]).strip()
         decrypted_message = decrypted_message.decode('utf8')
 
-        return decrypted_message
\ No newline at end of file
+        return decrypted_message
+
+    # Raw IV + ciphertext with PKCS7 padding, for the binary frames of Util/framing.py.
+    # message is a str or bytes, binary=True returns the plaintext as bytes
+    def encrypt_raw(self, message):
+        if isinstance(message, str):
+            message = message.encode('utf8')
+        cipher = AES.new(self.key, AES.MODE_CBC)
+        return cipher.iv + cipher.encrypt(pad(message, AES.block_size))
+
+    def decrypt_raw(self, data, binary=False):
+        cipher = AES.new(self.key, AES.MODE_CBC, data[:16])
+        plaintext = unpad(cipher.decrypt(data[16:]), AES.block_size)
+        return plaintext if binary else plaintext.decode('utf8')
+
+    def newSession(self, clientNonce, serverNonce, dancerID, isServer):
+        # Both sides derive the same key from the shared key and the nonces they exchanged
+        key = HKDF(self.key, SESSION_KEY_BYTES, clientNonce + serverNonce, SHA256, context=b"session " + dancerID.encode('utf8'))
+        return SessionCipher(key, isServer, clientNonce, serverNonce)
+
+
+# AES-GCM with counter nonces for one connection, with the same encrypt_raw and
+# decrypt_raw as EncryptionHandler. Frames carry nonce + ciphertext + tag, a frame
+# that was tampered with, reflected back or replayed fails to decrypt.
+class SessionCipher():
+
+    def __init__(self, key, isServer, clientNonce, serverNonce):
+        self.key = key
+        # Kept to recognise a laptop resuming this session after a reconnect
+        self.clientNonce = clientNonce
+        self.serverNonce = serverNonce
+        self.direction = SERVER_STREAM if isServer else 0
+        self.aead = AESGCM(key) if AESGCM is not None else None
+        self.lock = threading.Lock()
+        self.pid = None
+        self.stream = 0
+        self.counter = 0
+        # For each of the other side's streams, the highest counter received and the
+        # counters received within REPLAY_WINDOW of it
+        self.received = {}
+
+    def nextNonce(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.stream = self.direction | random.SystemRandom().getrandbits(31)
+                self.counter = 0
+            self.counter += 1
+            return GCM_NONCE.pack(self.stream, self.counter)
+
+    def encrypt_raw(self, message):
+        if isinstance(message, str):
+            message = message.encode('utf8')
+        nonce = self.nextNonce()
+        if self.aead is not None:
+            return nonce + self.aead.encrypt(nonce, message, None)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(message)
+        return nonce + ciphertext + tag
+
+    def decrypt_raw(self, data, binary=False):
+        nonceBytes = GCM_NONCE.size
+        if len(data) < nonceBytes + GCM_TAG_BYTES:
+            raise ValueError("session frame of {} bytes is too short".format(len(data)))
+        nonce = bytes(data[:nonceBytes])
+        stream, counter = GCM_NONCE.unpack(nonce)
+        if stream & SERVER_STREAM == self.direction:
+            raise ValueError("session frame sent in the wrong direction")
+        highest, seen = self.received.get(stream, (0, set()))
+        if counter <= highest - REPLAY_WINDOW or counter in seen:
+            raise ValueError("replayed session frame")
+        if self.aead is not None:
+            try:
+                plaintext = self.aead.decrypt(nonce, bytes(data[nonceBytes:]), None)
+            except InvalidTag:
+                raise ValueError("MAC check failed")
+        else:
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+            plaintext = cipher.decrypt_and_verify(data[nonceBytes:-GCM_TAG_BYTES], data[-GCM_TAG_BYTES:])
+        seen.add(counter)
+        highest = max(highest, counter)
+        if len(seen) > 2 * REPLAY_WINDOW:
+            seen = {seenCounter for seenCounter in seen if seenCounter > highest - REPLAY_WINDOW}
+        self.received[stream] = (highest, seen)
+        return plaintext if binary else plaintext.decode('utf8')
@@ -0,0 +1,152 @@
+from multiprocessing import Array
+
+# Firmware sequence numbers count up to SEQUENCE_MODULO - 1 and wrap around
+SEQUENCE_MODULO = 256
+
+# Without firmware sequence numbers, an inter-arrival time over GAP_FACTOR times
+# the mean interval is counted as round(interval / mean) - 1 lost packets. Intervals
+# under the mean divided by GAP_FACTOR are packets of one notification flush, which
+# share an arrival time, they stay out of the mean interval and jitter.
+GAP_FACTOR = 3
+
+# Upper edges in ms of the inter-arrival time histogram, the last bucket is everything above
+HISTOGRAM_EDGES_MS = (5, 10, 20, 40, 80, 160, 320)
+
+# Smoothing of the mean interval and of the RFC 3550 style jitter estimate
+SMOOTHING = 1 / 16
+
+# Fields of one bluno in SharedLinkStats, rates are derived from these when read
+COUNTER_FIELDS = ("received", "lost", "outOfOrder", "duplicates", "checksumErrors", "parseErrors",
+                  "bytesDropped", "meanIntervalMs", "jitterMs", "firmwareSequence")
+HISTOGRAM_FIELDS = tuple("histogram{}".format(i) for i in range(len(HISTOGRAM_EDGES_MS) + 1))
+STAT_FIELDS = COUNTER_FIELDS + HISTOGRAM_FIELDS
+
+
+# Loss, reordering and jitter accounting for the packets of one bluno.
+# Uses the firmware sequence number when packets carry one, otherwise loss is
+# estimated from gaps in the arrival times.
+class LinkStats():
+
+    def __init__(self, sequenceModulo=SEQUENCE_MODULO):
+        self.sequenceModulo = sequenceModulo
+        self.expectedSequence = None
+        self.firmwareSequence = False
+
+        self.received = 0
+        self.lost = 0
+        self.outOfOrder = 0
+        self.duplicates = 0
+
+        self.lastArrivalTime = None
+        self.meanInterval = None
+        self.jitter = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_EDGES_MS) + 1)
+
+    def update(self, sequence, arrivalTime):
+        # sequence is -1 for packets from firmware without sequence numbers
+        self.received += 1
+        interval = None
+        if self.lastArrivalTime is not None:
+            interval = arrivalTime - self.lastArrivalTime
+        self.lastArrivalTime = arrivalTime
+
+        if sequence >= 0:
+            self.firmwareSequence = True
+            self.updateSequence(sequence)
+        elif interval is not None and self.meanInterval and interval > GAP_FACTOR * self.meanInterval:
+            self.lost += round(interval / self.meanInterval) - 1
+            # the gap goes into the mean capped, so a mean below the real interval (the
+            # packet rate dropped) climbs back up instead of every later interval being a gap
+            self.meanInterval += (GAP_FACTOR * self.meanInterval - self.meanInterval) * SMOOTHING
+            self.addToHistogram(interval)
+            return
+
+        if interval is not None:
+            self.updateInterval(interval)
+
+    def updateSequence(self, sequence):
+        if self.expectedSequence is None:
+            self.expectedSequence = (sequence + 1) % self.sequenceModulo
+            return
+
+        gap = (sequence - self.expectedSequence) % self.sequenceModulo
+        if gap < self.sequenceModulo // 2:
+            # in order, gap packets were lost in between
+            self.lost += gap
+            self.expectedSequence = (sequence + 1) % self.sequenceModulo
+        elif (sequence + 1) % self.sequenceModulo == self.expectedSequence:
+            self.duplicates += 1
+        else:
+            # late packet, it was counted as lost when the gap was seen
+            self.outOfOrder += 1
+            if self.lost > 0:
+                self.lost -= 1
+
+    def updateInterval(self, interval):
+        if self.meanInterval is None or self.meanInterval <= 0:
+            if interval > 0:
+                self.meanInterval = interval
+        elif interval < self.meanInterval / GAP_FACTOR:
+            # part of a flushed burst, no measure of the packet rate
+            pass
+        else:
+            self.jitter += (abs(interval - self.meanInterval) - self.jitter) * SMOOTHING
+            self.meanInterval += (interval - self.meanInterval) * SMOOTHING
+        self.addToHistogram(interval)
+
+    def addToHistogram(self, interval):
+        intervalMs = interval * 1000
+        for i, edge in enumerate(HISTOGRAM_EDGES_MS):
+            if intervalMs <= edge:
+                self.histogram[i] += 1
+                return
+        self.histogram[-1] += 1
+
+    def snapshot(self, decoder=None):
+        # Counters of this link, plus the parser counters of decoder (a PacketDecoder) if given
+        stats = {
+            "received": self.received,
+            "lost": self.lost,
+            "outOfOrder": self.outOfOrder,
+            "duplicates": self.duplicates,
+            "checksumErrors": decoder.checksumErrors if decoder is not None else 0,
+            "parseErrors": decoder.parseErrors if decoder is not None else 0,
+            "bytesDropped": decoder.bytesDropped if decoder is not None else 0,
+            "meanIntervalMs": (self.meanInterval or 0) * 1000,
+            "jitterMs": self.jitter * 1000,
+            "firmwareSequence": int(self.firmwareSequence),
+        }
+        for field, count in zip(HISTOGRAM_FIELDS, self.histogram):
+            stats[field] = count
+        return stats
+
+
+def addRates(stats):
+    # Loss rate is radio loss (sequence gaps), checksum failure rate is parser loss
+    sent = stats["received"] + stats["lost"]
+    stats["lossRate"] = stats["lost"] / sent if sent else 0
+    parsed = stats["received"] + stats["checksumErrors"] + stats["parseErrors"]
+    stats["checksumFailureRate"] = stats["checksumErrors"] / parsed if parsed else 0
+    return stats
+
+
+# Link stats of every bluno in shared memory, published by the bluno process
+# and polled by LaptopClient from another process.
+class SharedLinkStats():
+
+    def __init__(self, numDevices):
+        self.numDevices = numDevices
+        self.values = Array('d', numDevices * len(STAT_FIELDS), lock=False)
+
+    def publish(self, index, stats):
+        offset = index * len(STAT_FIELDS)
+        for i, field in enumerate(STAT_FIELDS):
+            self.values[offset + i] = stats[field]
+
+    def snapshot(self, index):
+        offset = index * len(STAT_FIELDS)
+        stats = {field: self.values[offset + i] for i, field in enumerate(STAT_FIELDS)}
+        return addRates(stats)
+
+    def snapshots(self):
+        return [self.snapshot(index) for index in range(self.numDevices)]
@@ -0,0 +1,145 @@
+import atexit
+import logging
+import logging.handlers
+from multiprocessing.util import Finalize, register_after_fork
+import os
+import queue
+import sys
+import time
+
+# Logging shared by every module, records are put on a queue by the calling thread and
+# written out by a QueueListener thread, so a slow console never blocks the hot paths.
+#
+# Levels are set per module (logger name) through environment variables:
+#   LOG_LEVEL=INFO                          default level for every module
+#   LOG_LEVELS=server=DEBUG,dummyML=WARNING per module overrides
+
+DEFAULT_LEVEL = "INFO"
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+# Minimum seconds between two messages of the same kind on a RateLimitedLogger
+RATE_LIMIT_SEC = 1.0
+
+logQueue = None
+listener = None
+listenerStream = None
+
+
+def parseLevels(levels):
+    # "server=DEBUG,dummyML=WARNING" -> {"server": "DEBUG", "dummyML": "WARNING"}
+    result = {}
+    for item in levels.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            result[name.strip()] = level.strip().upper()
+    return result
+
+
+def startListener():
+    global logQueue, listener
+    logQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler(listenerStream)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(logQueue, handler)
+    listener.start()
+
+    root = logging.getLogger()
+    for oldHandler in root.handlers[:]:
+        root.removeHandler(oldHandler)
+    root.addHandler(logging.handlers.QueueHandler(logQueue))
+
+
+def stopListener():
+    # Writes out every queued record before returning
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def setupLogging(level=None, levels=None, stream=None):
+    # Safe to call more than once, the last call wins.
+    # level and levels default to LOG_LEVEL and LOG_LEVELS from the environment.
+    global listenerStream
+    stopListener()
+    listenerStream = stream if stream is not None else sys.stderr
+    startListener()
+
+    if level is None:
+        level = os.environ.get("LOG_LEVEL", DEFAULT_LEVEL)
+    logging.getLogger().setLevel(level.upper())
+
+    if levels is None:
+        levels = parseLevels(os.environ.get("LOG_LEVELS", ""))
+    for name, moduleLevel in levels.items():
+        logging.getLogger(name).setLevel(moduleLevel)
+
+
+def getLogger(name):
+    if listener is None:
+        setupLogging()
+    return logging.getLogger(name)
+
+
+def restartAfterFork():
+    # A forked child (multiprocessing on linux) inherits the queue handler but not the
+    # listener thread, start a new listener so the child's records are still written out
+    if listener is not None:
+        startListener()
+
+
+def stopAtProcessExit(_):
+    # multiprocessing children leave through os._exit and skip atexit, and their
+    # finalizer registry is cleared right after the fork, so register here instead
+    if listener is not None:
+        Finalize(None, stopListener, exitpriority=0)
+
+
+class ForkHook():
+    pass
+
+
+forkHook = ForkHook()
+os.register_at_fork(after_in_child=restartAfterFork)
+register_after_fork(forkHook, stopAtProcessExit)
+atexit.register(stopListener)
+
+
+# Wraps a logger for messages emitted once per packet or sample. Each message
+# (keyed by its format string) is written at most once every interval seconds,
+# together with how many times it was suppressed in between. When the level is
+# disabled a call costs a single isEnabledFor check.
+class RateLimitedLogger():
+
+    def __init__(self, logger, interval=RATE_LIMIT_SEC):
+        self.logger = logger
+        self.interval = interval
+        self.lastLogTime = {}
+        self.suppressed = {}
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        lastLogTime = self.lastLogTime.get(msg)
+        if lastLogTime is not None and now - lastLogTime < self.interval:
+            self.suppressed[msg] = self.suppressed.get(msg, 0) + 1
+            return
+        self.lastLogTime[msg] = now
+        suppressed = self.suppressed.pop(msg, 0)
+        if suppressed:
+            self.logger.log(level, msg + " (%d similar messages suppressed)", *args, suppressed)
+        else:
+            self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
@@ -0,0 +1,73 @@
+from collections import deque
+from Util.ring_buffer import MOVE_FLAG, TIME
+
+# Idle samples kept from just before the move flag goes up and sent with the segment
+PRE_ROLL_SAMPLES = 5
+
+# Moves with fewer moving samples are treated as noise and dropped
+MIN_SEGMENT_SAMPLES = 20
+
+# Segments are cut at this many samples, including the pre-roll
+MAX_SEGMENT_SAMPLES = 60
+
+
+# Cuts the sample stream of one bluno into complete moves from moveFlag transitions.
+# A segment starts with the pre-roll and the first sample with moveFlag 1, and ends on
+# the first sample with moveFlag 0 or when it reaches maxLength. The rest of a move
+# that was cut at maxLength is skipped, so one move never gives more than one segment.
+class MoveSegmenter():
+
+    def __init__(self, preRoll=PRE_ROLL_SAMPLES, minLength=MIN_SEGMENT_SAMPLES, maxLength=MAX_SEGMENT_SAMPLES):
+        self.minLength = minLength
+        self.maxLength = maxLength
+        self.preRoll = deque(maxlen=preRoll)
+        self.segment = None
+        self.moveStartTime = None
+        self.moveSamples = 0
+        self.skipping = False
+
+        # Counters
+        self.segmentsEmitted = 0
+        self.segmentsDiscarded = 0
+        self.segmentsTruncated = 0
+
+    def clear(self):
+        self.preRoll.clear()
+        self.segment = None
+        self.skipping = False
+
+    def update(self, record):
+        # Returns (moveStartTime, records) when record completes a segment, None otherwise
+        moving = record[MOVE_FLAG] == 1
+
+        if not moving:
+            self.skipping = False
+            segment = self.finish() if self.segment is not None else None
+            self.preRoll.append(record)
+            return segment
+
+        if self.skipping:
+            return None
+
+        if self.segment is None:
+            self.segment = list(self.preRoll)
+            self.preRoll.clear()
+            self.moveStartTime = record[TIME]
+            self.moveSamples = 0
+
+        self.segment.append(record)
+        self.moveSamples += 1
+        if len(self.segment) >= self.maxLength:
+            self.segmentsTruncated += 1
+            self.skipping = True
+            return self.finish()
+        return None
+
+    def finish(self):
+        segment = self.segment
+        self.segment = None
+        if self.moveSamples < self.minLength:
+            self.segmentsDiscarded += 1
+            return None
+        self.segmentsEmitted += 1
+        return self.moveStartTime, segment
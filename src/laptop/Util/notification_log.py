@@ -0,0 +1,43 @@
+import struct
+import time
+
+# Compact binary log of raw BLE notifications, used to replay real traffic offline.
+# File layout: MAGIC, then one record per notification:
+#   float64 arrival time, uint8 bluno index, uint8 payload length, payload bytes
+MAGIC = b"BLENTF1\n"
+RECORD_HEADER = struct.Struct('<dBB')
+
+
+class NotificationRecorder():
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.count = 0
+
+    def record(self, index, rawData, arrivalTime=None):
+        if arrivalTime is None:
+            arrivalTime = time.time()
+        self.file.write(RECORD_HEADER.pack(arrivalTime, index, len(rawData)))
+        self.file.write(rawData)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def readNotifications(path):
+    # Returns a list of (arrivalTime, index, rawData) in recorded order
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("{} is not a notification log".format(path))
+
+    notifications = []
+    offset = len(MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        arrivalTime, index, length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        notifications.append((arrivalTime, index, data[offset:offset + length]))
+        offset += length
+    return notifications
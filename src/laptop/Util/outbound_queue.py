@@ -0,0 +1,110 @@
+from collections import deque
+import threading
+import time
+
+# What put() does when the queue is full
+BLOCK = "block"                     # wait for the sender, backpressure onto the ingest loop
+DROP_OLDEST = "drop-oldest"         # drop the oldest queued message
+DROP_IDLE_FIRST = "drop-idle-first" # drop the oldest idle message, the oldest message if there is none
+POLICIES = (BLOCK, DROP_OLDEST, DROP_IDLE_FIRST)
+
+# Message priorities
+IDLE = 0    # stats and other data that is worthless once stale
+MOVE = 1    # move segments and their timestamps
+
+MAX_QUEUED_MESSAGES = 64
+# Idle messages that waited longer than this are dropped instead of sent
+MAX_IDLE_AGE_SEC = 2
+
+
+# Bounded queue of encrypted frames between handleBlunoData and the thread writing
+# to the socket, so a slow link or tunnel sheds stale data instead of blocking ingest
+# and delivering move windows seconds late. One message can be a whole move segment,
+# so shedding is counted in the samples the dropped messages carried as well.
+class OutboundQueue():
+
+    def __init__(self, maxMessages=MAX_QUEUED_MESSAGES, policy=DROP_IDLE_FIRST, maxIdleAge=MAX_IDLE_AGE_SEC):
+        if policy not in POLICIES:
+            raise ValueError("unknown outbound queue policy {}, expected one of {}".format(policy, POLICIES))
+        self.maxMessages = maxMessages
+        self.policy = policy
+        self.maxIdleAge = maxIdleAge
+        # (enqueue time, priority, frame, samples), oldest first
+        self.messages = deque()
+        self.condition = threading.Condition()
+
+        # Counters, shed and stale are reset by report()
+        self.sent = 0
+        self.shed = 0
+        self.shedSamples = 0
+        self.stale = 0
+        self.maxDepth = 0
+        self.lastReportTime = time.monotonic()
+
+    def put(self, frame, priority=MOVE, samples=0):
+        # samples is the number of bluno samples in frame, for the shed samples rate
+        with self.condition:
+            while len(self.messages) >= self.maxMessages:
+                if self.policy == BLOCK:
+                    self.condition.wait()
+                    continue
+                self.dropOne()
+            self.messages.append((time.monotonic(), priority, frame, samples))
+            self.maxDepth = max(self.maxDepth, len(self.messages))
+            self.condition.notify_all()
+
+    def dropOne(self):
+        if self.policy == DROP_IDLE_FIRST:
+            for i, (_, priority, _, samples) in enumerate(self.messages):
+                if priority == IDLE:
+                    del self.messages[i]
+                    self.shed += 1
+                    self.shedSamples += samples
+                    return
+        _, _, _, samples = self.messages.popleft()
+        self.shed += 1
+        self.shedSamples += samples
+
+    def get(self, timeout=None):
+        # Returns the oldest frame still worth sending, None if none came within timeout
+        entry = self.getEntry(timeout)
+        return None if entry is None else entry[1]
+
+    def getEntry(self, timeout=None):
+        # Same as get(), but returns (priority, frame)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                while self.messages:
+                    enqueueTime, priority, frame, _ = self.messages.popleft()
+                    self.condition.notify_all()
+                    if priority == IDLE and time.monotonic() - enqueueTime > self.maxIdleAge:
+                        self.stale += 1
+                        continue
+                    self.sent += 1
+                    return priority, frame
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def report(self):
+        # Queue depth and age now, and messages and samples shed per second since the last report
+        with self.condition:
+            now = time.monotonic()
+            elapsed = max(now - self.lastReportTime, 1e-9)
+            stats = {
+                "policy": self.policy,
+                "depth": len(self.messages),
+                "maxDepth": self.maxDepth,
+                "oldestAgeMs": (now - self.messages[0][0]) * 1000 if self.messages else 0,
+                "shedPerSec": self.shed / elapsed,
+                "shedSamplesPerSec": self.shedSamples / elapsed,
+                "stalePerSec": self.stale / elapsed,
+            }
+            self.shed = 0
+            self.shedSamples = 0
+            self.stale = 0
+            self.maxDepth = len(self.messages)
+            self.lastReportTime = now
+            return stats
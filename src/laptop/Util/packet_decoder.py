@@ -0,0 +1,216 @@
+from functools import reduce
+from operator import xor
+import numpy as np
+
+# Bluno packet format: "gyroX;gyroY;gyroZ;accelX;accelY;accelZ;moveFlag;emg[;sequence]:checksum\n"
+# where checksum is the XOR of every byte before the ':'. Newer firmware appends a
+# sequence number, packets from older firmware get NO_SEQUENCE instead.
+END_FLAG = b'\n'
+DELIMITER = b';'
+CHECKSUM_DELIMITER = b':'
+
+# An incomplete packet longer than this can never be valid, drop it
+MAX_DATA_LENGTH = 70
+
+# Number of content fields read from every packet, excluding the sequence number
+NUM_FIELDS = 8
+NO_SEQUENCE = -1
+
+# When at least this many packets are pending (e.g. a BLE link flushing after a stall,
+# buffered with append() while the burst is drained) they are decoded with the
+# vectorized backlog path
+BATCH_THRESHOLD = 16
+
+# Lookup tables used by the backlog path, indexed by byte value
+SEPARATOR_TABLE = bytes(32 if chr(i) in ';:\r\n' else i for i in range(256))
+ALLOWED_BYTES = np.zeros(256, dtype=bool)
+ALLOWED_BYTES[list(b'0123456789-;:\r\n')] = True
+
+
+def calculateChecksum(data):
+    # XOR of all bytes in data, data can be bytes, bytearray or memoryview
+    return reduce(xor, data, 0)
+
+
+# Incremental framer/decoder for the raw bytes received from a Bluno.
+# Notifications are appended to a bytearray and only the newly received bytes
+# are scanned for END_FLAG, so a packet split over several 20 byte notifications
+# is never rescanned or decoded to str.
+class PacketDecoder():
+
+    def __init__(self, maxDataLength=MAX_DATA_LENGTH):
+        self.buffer = bytearray()
+        self.maxDataLength = maxDataLength
+
+        # Offset in buffer up to which END_FLAG has already been searched for
+        self.scanOffset = 0
+        # Complete packets appended since the last decode
+        self.pendingPackets = 0
+
+        # Counters, only ever incremented
+        self.packetsDecoded = 0
+        self.checksumErrors = 0
+        self.parseErrors = 0
+        self.bytesDropped = 0
+
+    def feed(self, rawData):
+        # Append rawData and return a list of samples for every packet completed by it.
+        # Each sample is a sequence of NUM_FIELDS ints in packet order followed by the
+        # sequence number.
+        self.append(rawData)
+        return self.decode()
+
+    def append(self, rawData):
+        # Buffers rawData, its packets are returned by the next decode()
+        self.buffer += rawData
+        self.pendingPackets += rawData.count(END_FLAG)
+
+    def decode(self):
+        # Returns the samples of every complete packet appended since the last decode
+        buffer = self.buffer
+        pendingPackets, self.pendingPackets = self.pendingPackets, 0
+
+        if pendingPackets >= BATCH_THRESHOLD:
+            end = buffer.rfind(END_FLAG) + 1
+            with memoryview(buffer) as view:
+                backlog = self.decodeBacklog(view[:end])
+            if backlog is not None:
+                del buffer[:end]
+                self.dropOverflow()
+                return backlog
+
+        samples = []
+        start = 0
+        end = buffer.find(END_FLAG, self.scanOffset)
+        while end != -1:
+            # empty packet (very unlikely but possible if \n\n) is skipped
+            if end > start:
+                sample = self.decodePacket(buffer, start, end)
+                if sample is not None:
+                    samples.append(sample)
+            start = end + 1
+            end = buffer.find(END_FLAG, start)
+
+        if start > 0:
+            del buffer[:start]
+
+        self.dropOverflow()
+        return samples
+
+    def dropOverflow(self):
+        if len(self.buffer) >= self.maxDataLength:
+            # No END_FLAG exists for a long enough data stream, drop all buffer
+            self.bytesDropped += len(self.buffer)
+            self.buffer.clear()
+        self.scanOffset = len(self.buffer)
+
+    def decodePacket(self, buffer, start, end):
+        # Decode buffer[start:end] (END_FLAG excluded), returns None if corrupted
+        separator = buffer.rfind(CHECKSUM_DELIMITER, start, end)
+        if separator == -1:
+            self.parseErrors += 1
+            return None
+
+        with memoryview(buffer) as view:
+            checksumComputed = calculateChecksum(view[start:separator])
+
+        try:
+            checksumReceived = int(buffer[separator + 1:end])
+            if checksumReceived != checksumComputed:
+                self.checksumErrors += 1
+                return None
+
+            tokens = buffer[start:separator].split(DELIMITER)
+            if len(tokens) < NUM_FIELDS:
+                self.parseErrors += 1
+                return None
+            sequence = int(tokens[NUM_FIELDS]) if len(tokens) > NUM_FIELDS else NO_SEQUENCE
+            sample = tuple(map(int, tokens[:NUM_FIELDS])) + (sequence,)
+        except ValueError:
+            self.parseErrors += 1
+            return None
+
+        self.packetsDecoded += 1
+        return sample
+
+    def decodeBacklog(self, data):
+        # Decode every packet in data, the start of self.buffer up to and including an
+        # END_FLAG, at once. Returns the samples like feed(), or None if data can't be
+        # tokenized in bulk and has to go through decodePacket one packet at a time.
+        # Packets that aren't clean (stray bytes, missing fields) are handed to decodePacket
+        # on their own, so errors are counted the same as on the per packet path.
+        raw = np.frombuffer(data, dtype=np.uint8)
+
+        isEnd = raw == END_FLAG[0]
+        isSeparator = raw == CHECKSUM_DELIMITER[0]
+        isDelimiter = raw == DELIMITER[0]
+        isInvalid = ~ALLOWED_BYTES[raw]
+
+        ends = np.flatnonzero(isEnd)
+        starts = np.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+
+        # Prefix sums give per packet counts without a python loop,
+        # count in packet [start, end) is cum[end] - cum[start]
+        def countPerPacket(mask):
+            cum = np.zeros(len(mask) + 1, dtype=np.int64)
+            np.cumsum(mask, out=cum[1:])
+            return cum[ends] - cum[starts]
+
+        numSeparators = countPerPacket(isSeparator)
+        numDelimiters = countPerPacket(isDelimiter)
+        valid = ((numSeparators == 1)
+                 & (numDelimiters >= NUM_FIELDS - 1)
+                 & (countPerPacket(isInvalid) == 0))
+
+        # XOR of packet content is xorCum[separator] ^ xorCum[start]
+        xorCum = np.zeros(len(raw) + 1, dtype=np.uint8)
+        np.bitwise_xor.accumulate(raw, out=xorCum[1:])
+        separators = np.flatnonzero(isSeparator)
+        firstSeparator = np.searchsorted(separators, starts[valid])
+        checksumComputed = xorCum[separators[firstSeparator]] ^ xorCum[starts[valid]]
+
+        # Tokenize the valid packets in one pass, every separator becomes a space
+        packetOfByte = np.repeat(np.arange(len(ends)), ends - starts + 1)
+        text = raw[valid[packetOfByte]].tobytes().translate(SEPARATOR_TABLE)
+        numTokens = numDelimiters[valid] + 2
+        try:
+            tokens = np.fromstring(text, dtype=np.int64, sep=' ')
+        except ValueError:
+            return None
+        if len(tokens) != numTokens.sum():
+            # e.g. a stray '-' in the middle of a number
+            return None
+
+        firstToken = np.cumsum(numTokens) - numTokens
+        checksumReceived = tokens[firstToken + numTokens - 1]
+        checksumOk = checksumReceived == checksumComputed
+
+        self.checksumErrors += int(np.count_nonzero(~checksumOk))
+
+        firstToken = firstToken[checksumOk]
+        samples = np.empty((len(firstToken), NUM_FIELDS + 1), dtype=np.int64)
+        samples[:, :NUM_FIELDS] = tokens[firstToken[:, None] + np.arange(NUM_FIELDS)]
+        # packets with more than NUM_FIELDS fields carry a sequence number
+        hasSequence = numDelimiters[valid][checksumOk] >= NUM_FIELDS
+        samples[:, NUM_FIELDS] = NO_SEQUENCE
+        samples[hasSequence, NUM_FIELDS] = tokens[firstToken[hasSequence] + NUM_FIELDS]
+        self.packetsDecoded += len(samples)
+
+        # empty packets are skipped rather than counted as errors
+        unclean = np.flatnonzero(~valid & (ends > starts))
+        if not len(unclean):
+            return samples.tolist()
+        decoded = dict(zip(np.flatnonzero(valid)[checksumOk].tolist(), samples.tolist()))
+        for packet in unclean.tolist():
+            sample = self.decodePacket(self.buffer, int(starts[packet]), int(ends[packet]))
+            if sample is not None:
+                decoded[packet] = sample
+        return [decoded[packet] for packet in sorted(decoded)]
+
+    def reset(self):
+        # Drop any partially received packet, e.g. after a reconnection
+        self.buffer.clear()
+        self.scanOffset = 0
+        self.pendingPackets = 0
@@ -0,0 +1,66 @@
+from collections import deque
+
+# Number of samples the position change is detected over
+WINDOW_LENGTH = 100
+
+# AccelY must go below MIN_THRESHOLD and above MAX_THRESHOLD within the window
+MIN_THRESHOLD = -60
+MAX_THRESHOLD = 80
+
+
+# Detects a position change from the Y acceleration of one bluno over a sliding window.
+# The window min and max are kept in monotonic deques of (position, accelY), so every
+# update is amortized O(1) instead of rescanning the whole window. On equal values the
+# most recent sample is kept, same as scanning the window from newest to oldest.
+class PositionChangeDetector():
+
+    def __init__(self, windowLength=WINDOW_LENGTH, minThreshold=MIN_THRESHOLD, maxThreshold=MAX_THRESHOLD):
+        self.windowLength = windowLength
+        self.minThreshold = minThreshold
+        self.maxThreshold = maxThreshold
+        self.clear()
+
+    def clear(self):
+        # Position of the next sample, only ever increases
+        self.position = 0
+        # Increasing accelY from oldest to newest, front is the window min
+        self.minDeque = deque()
+        # Decreasing accelY from oldest to newest, front is the window max
+        self.maxDeque = deque()
+
+    def update(self, accelY, motionFlag):
+        # Samples taken while moving count as 0 so a dance move isn't seen as a position change
+        if motionFlag != 0:
+            accelY = 0
+
+        minDeque = self.minDeque
+        maxDeque = self.maxDeque
+        while minDeque and minDeque[-1][1] >= accelY:
+            minDeque.pop()
+        minDeque.append((self.position, accelY))
+        while maxDeque and maxDeque[-1][1] <= accelY:
+            maxDeque.pop()
+        maxDeque.append((self.position, accelY))
+
+        self.position += 1
+        oldest = self.position - self.windowLength
+        if minDeque[0][0] < oldest:
+            minDeque.popleft()
+        if maxDeque[0][0] < oldest:
+            maxDeque.popleft()
+
+    def getPosChangeFlag(self):
+        if not self.minDeque:
+            return 0
+
+        minPosition, minY = self.minDeque[0]
+        maxPosition, maxY = self.maxDeque[0]
+        if minY < self.minThreshold and maxY > self.maxThreshold:
+            ## moving right, min came before max
+            if minPosition < maxPosition:
+                return -1
+            ## moving left
+            return 1
+
+        ## netural
+        return 0
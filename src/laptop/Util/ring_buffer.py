@@ -0,0 +1,116 @@
+from multiprocessing import shared_memory
+from queue import Empty
+import struct
+import time
+
+# Fixed width record for one sample, field order is given by the index constants below:
+# (Id, GyroX, GyroY, GyroZ, AccelX, AccelY, AccelZ, moveFlag, PosChangeFlag, time)
+RECORD = struct.Struct('<b6i2bxd')
+ID, GYRO_X, GYRO_Y, GYRO_Z, ACCEL_X, ACCEL_Y, ACCEL_Z, MOVE_FLAG, POS_CHANGE_FLAG, TIME = range(10)
+RECORD_KEYS = ("Id", "GyroX", "GyroY", "GyroZ", "AccelX", "AccelY", "AccelZ", "moveFlag", "PosChangeFlag", "time")
+
+# Header of native uint64 slots, each is only ever written by one side and the two
+# indices live on separate cache lines. The header is accessed through a memoryview cast
+# to 'Q' so every index is loaded and stored as a whole word, struct's standard size
+# packing writes byte by byte and the other process could see a torn index.
+WRITE_INDEX = 0     # written by the producer, once the record is in its slot
+WRITING_INDEX = 1   # written by the producer, before the record goes into its slot
+READ_INDEX = 8      # written by the consumer
+OVERRUNS = 9        # written by the consumer
+HEADER_SIZE = 128
+
+# Sleep between polls while a blocking get() waits for the producer
+POLL_SEC = 0.0005
+
+
+def recordToDict(record):
+    return dict(zip(RECORD_KEYS, record))
+
+
+# Lock-free single producer/single consumer ring buffer of sample records in shared memory,
+# used in place of a multiprocessing.Queue between the bluno process and handleBlunoData.
+# Records are packed straight into shared memory, so nothing is pickled or written to a pipe.
+# When the consumer falls behind, the producer overwrites the oldest records and the consumer
+# counts the records it missed in overruns.
+class SampleRingBuffer():
+
+    def __init__(self, capacity=1024, name=None):
+        self.capacity = capacity
+        if name is None:
+            self.sharedMemory = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + capacity * RECORD.size)
+            self.sharedMemory.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+            self.owner = True
+        else:
+            self.sharedMemory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.buf = self.sharedMemory.buf
+        self.header = self.buf[:HEADER_SIZE].cast('Q')
+
+    def __getstate__(self):
+        # Only the name is sent to a spawned process, which attaches to the same block
+        return (self.capacity, self.sharedMemory.name)
+
+    def __setstate__(self, state):
+        capacity, name = state
+        self.__init__(capacity, name)
+
+    def put(self, record):
+        # Producer side, never blocks
+        header = self.header
+        writeIndex = header[WRITE_INDEX]
+        header[WRITING_INDEX] = writeIndex + 1
+        RECORD.pack_into(self.buf, HEADER_SIZE + (writeIndex % self.capacity) * RECORD.size, *record)
+        header[WRITE_INDEX] = writeIndex + 1
+
+    def get(self, block=True, timeout=None):
+        # Consumer side, returns the oldest unread record as a tuple.
+        # Raises queue.Empty like multiprocessing.Queue.get if nothing arrives in time.
+        header = self.header
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            readIndex = header[READ_INDEX]
+            writeIndex = header[WRITE_INDEX]
+
+            if writeIndex == readIndex:
+                if not block or (deadline is not None and time.time() >= deadline):
+                    raise Empty
+                time.sleep(POLL_SEC)
+                continue
+
+            if writeIndex - readIndex > self.capacity:
+                # Producer has lapped us, skip to the oldest record still in the buffer
+                self.addOverruns(writeIndex - readIndex - self.capacity)
+                readIndex = writeIndex - self.capacity
+
+            record = RECORD.unpack_from(self.buf, HEADER_SIZE + (readIndex % self.capacity) * RECORD.size)
+
+            # The slot may have been overwritten while it was being copied, if so drop it and retry.
+            # The write of index readIndex + capacity goes into the same slot, it has started
+            # once the writing index is past it. A full buffer alone overwrote nothing.
+            if header[WRITING_INDEX] - readIndex > self.capacity:
+                self.addOverruns(1)
+                header[READ_INDEX] = readIndex + 1
+                continue
+
+            header[READ_INDEX] = readIndex + 1
+            return record
+
+    def addOverruns(self, count):
+        self.header[OVERRUNS] += count
+
+    def overruns(self):
+        # Number of records overwritten before the consumer could read them
+        return self.header[OVERRUNS]
+
+    def qsize(self):
+        return min(self.header[WRITE_INDEX] - self.header[READ_INDEX], self.capacity)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def close(self):
+        self.header.release()
+        self.buf = None
+        self.sharedMemory.close()
+        if self.owner:
+            self.sharedMemory.unlink()
@@ -0,0 +1,166 @@
+import struct
+import zlib
+import numpy as np
+
+# Fixed layout binary encoding of sample records, used for move segments in place of json.
+# A batch is a header followed by the body of count samples in the batch's codec:
+#   header: uint8 schema version, uint8 codec, uint16 count, float64 time of the first sample
+#   sample: uint8 bluno id, 6 x int16 gyro and accel axes, uint8 flags, uint16 time delta
+# flags holds moveFlag in bit 0 and PosChangeFlag + 1 (-1, 0 or 1) in bits 1-2. The time
+# delta is from the previous sample in units of TIME_RESOLUTION_SEC, computed against the
+# decoded previous time so rounding errors don't add up over a batch.
+#
+# Codecs:
+#   CODEC_RAW         the samples as they are, fixed size
+#   CODEC_DELTA       ids, then flags, then every axis delta encoded from the previous sample,
+#                     axis by axis, then the time deltas, all numbers zigzag varint packed
+#   CODEC_DELTA_ZLIB  the CODEC_DELTA body compressed with zlib at ZLIB_LEVEL
+
+SCHEMA_VERSION = 1
+BATCH_HEADER = struct.Struct('<BBHd')
+
+CODEC_RAW = 0
+CODEC_DELTA = 1
+CODEC_DELTA_ZLIB = 2
+CODECS = {"raw": CODEC_RAW, "delta": CODEC_DELTA, "delta-zlib": CODEC_DELTA_ZLIB}
+# Fastest zlib level, the link is slow but the laptop shouldn't fall behind either
+ZLIB_LEVEL = 1
+NUM_AXES = 6
+MAX_VARINT_BYTES = 5
+SAMPLE = np.dtype([("id", "u1"), ("axes", "<i2", 6), ("flags", "u1"), ("dt", "<u2")])
+
+TIME_RESOLUTION_SEC = 1e-4
+MAX_BATCH_SAMPLES = 0xFFFF
+
+INT16_MIN = -0x8000
+INT16_MAX = 0x7FFF
+MAX_TIME_DELTA = 0xFFFF
+
+# Record fields, same order as the records of the laptop's SampleRingBuffer
+COLUMNS = ("Id", "GyroX", "GyroY", "GyroZ", "AccelX", "AccelY", "AccelZ", "moveFlag", "PosChangeFlag", "time")
+MOVE_FLAG = 7
+TIME = 9
+
+
+class SampleCodecError(ValueError):
+    pass
+
+
+def zigzag(values):
+    # Small negative and positive int32 to small uint32: 0, -1, 1, -2 -> 0, 1, 2, 3
+    values = values.astype(np.int32)
+    return ((values << 1) ^ (values >> 31)).astype(np.uint32)
+
+
+def unzigzag(values):
+    values = values.astype(np.int64)
+    return (values >> 1) ^ -(values & 1)
+
+
+def encodeVarints(values):
+    # Little endian base 128, 7 bits per byte with the high bit set on all but the last byte
+    values = np.asarray(values, dtype=np.uint64)
+    shifts = np.arange(MAX_VARINT_BYTES, dtype=np.uint64) * np.uint64(7)
+    groups = ((values[:, None] >> shifts) & np.uint64(0x7f)).astype(np.uint8)
+    lengths = 1 + (values[:, None] >= (np.uint64(1) << shifts[1:])).sum(axis=1)
+    positions = np.arange(MAX_VARINT_BYTES)
+    groups[positions < (lengths - 1)[:, None]] |= 0x80
+    return groups[positions < lengths[:, None]].tobytes()
+
+
+def decodeVarints(data, count):
+    encoded = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(encoded < 0x80)
+    if len(ends) != count or (count and ends[-1] != len(encoded) - 1):
+        raise SampleCodecError("expected {} varints".format(count))
+    if count == 0:
+        return np.empty(0, dtype=np.uint64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    positions = np.arange(len(encoded)) - np.repeat(starts, ends - starts + 1)
+    groups = (encoded & 0x7f).astype(np.uint64) << (positions.astype(np.uint64) * np.uint64(7))
+    return np.add.reduceat(groups, starts)
+
+
+def packDelta(samples):
+    axes = samples["axes"].astype(np.int32)
+    deltas = np.diff(axes, axis=0, prepend=np.zeros((1, NUM_AXES), dtype=np.int32))
+    values = np.concatenate((zigzag(deltas.T.ravel()), samples["dt"]))
+    return samples["id"].tobytes() + samples["flags"].tobytes() + encodeVarints(values)
+
+
+def unpackDelta(body, count):
+    if len(body) < 2 * count:
+        raise SampleCodecError("delta body of {} bytes is too short for {} samples".format(len(body), count))
+    samples = np.empty(count, dtype=SAMPLE)
+    samples["id"] = np.frombuffer(body, dtype=np.uint8, count=count)
+    samples["flags"] = np.frombuffer(body, dtype=np.uint8, count=count, offset=count)
+    values = decodeVarints(body[2 * count:], (NUM_AXES + 1) * count)
+    deltas = unzigzag(values[:NUM_AXES * count]).reshape(NUM_AXES, count).T
+    samples["axes"] = np.cumsum(deltas, axis=0)
+    samples["dt"] = values[NUM_AXES * count:]
+    return samples
+
+
+def encodeSamples(records, codec=CODEC_RAW):
+    # records are (id, gyroX, gyroY, gyroZ, accelX, accelY, accelZ, moveFlag, posChangeFlag, time)
+    # tuples. Axes outside int16 are saturated.
+    count = len(records)
+    if count > MAX_BATCH_SAMPLES:
+        raise SampleCodecError("{} samples is over the {} sample batch limit".format(count, MAX_BATCH_SAMPLES))
+    firstTime = records[0][TIME] if count else 0.0
+
+    samples = np.empty(count, dtype=SAMPLE)
+    if count:
+        values = np.array([record[:TIME] for record in records], dtype=np.int64)
+        samples["id"] = values[:, 0]
+        samples["axes"] = np.clip(values[:, 1:7], INT16_MIN, INT16_MAX)
+        samples["flags"] = (values[:, 7] & 1) | ((values[:, 8] + 1) << 1)
+
+        ticks = np.rint((np.array([record[TIME] for record in records]) - firstTime) / TIME_RESOLUTION_SEC)
+        # deltas between the rounded times never accumulate rounding error
+        deltas = np.diff(ticks, prepend=0)
+        samples["dt"] = np.clip(deltas, 0, MAX_TIME_DELTA)
+
+    if codec == CODEC_RAW:
+        body = samples.tobytes()
+    elif codec == CODEC_DELTA:
+        body = packDelta(samples)
+    elif codec == CODEC_DELTA_ZLIB:
+        body = zlib.compress(packDelta(samples), ZLIB_LEVEL)
+    else:
+        raise SampleCodecError("unknown codec {}".format(codec))
+    return BATCH_HEADER.pack(SCHEMA_VERSION, codec, count, firstTime) + body
+
+
+def decodeSamples(data):
+    # Returns the list of records encoded in data
+    if len(data) < BATCH_HEADER.size:
+        raise SampleCodecError("sample batch of {} bytes is too short".format(len(data)))
+    version, codec, count, firstTime = BATCH_HEADER.unpack_from(data)
+    if version != SCHEMA_VERSION:
+        raise SampleCodecError("unsupported sample schema version {}".format(version))
+    body = data[BATCH_HEADER.size:]
+
+    if codec == CODEC_RAW:
+        if len(body) != count * SAMPLE.itemsize:
+            raise SampleCodecError("sample batch length doesn't match its count of {}".format(count))
+        samples = np.frombuffer(body, dtype=SAMPLE, count=count)
+    elif codec == CODEC_DELTA:
+        samples = unpackDelta(body, count)
+    elif codec == CODEC_DELTA_ZLIB:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise SampleCodecError("corrupt zlib body: {}".format(e))
+        samples = unpackDelta(body, count)
+    else:
+        raise SampleCodecError("unknown codec {}".format(codec))
+
+    times = firstTime + np.cumsum(samples["dt"], dtype=np.int64) * TIME_RESOLUTION_SEC
+    moveFlags = samples["flags"] & 1
+    posChangeFlags = ((samples["flags"] >> 1) & 3).astype(np.int8) - 1
+
+    return [(sampleId, *axes, moveFlag, posChangeFlag, sampleTime)
+            for sampleId, axes, moveFlag, posChangeFlag, sampleTime
+            in zip(samples["id"].tolist(), samples["axes"].tolist(), moveFlags.tolist(),
+                   posChangeFlags.tolist(), times.tolist())]
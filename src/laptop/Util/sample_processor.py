@@ -0,0 +1,84 @@
+import time
+from Util.packet_decoder import PacketDecoder
+from Util.position_detector import PositionChangeDetector
+from Util.logger import getLogger, RateLimitedLogger
+from Util.link_stats import LinkStats
+
+logger = getLogger("internal_comms")
+hotPathLogger = RateLimitedLogger(logger)
+
+
+# Seconds between two publications of the link stats to SharedLinkStats
+PUBLISH_STATS_SEC = 1
+
+# appendData decodes once this many packets are pending, so a bluno that never
+# goes quiet still gets its samples through
+MAX_PENDING_PACKETS = 64
+
+
+# Turns the raw data notifications of one bluno into sample records.
+# Holds all the per bluno parsing state, so any number of blunos can be
+# handled in the same process.
+class SampleProcessor():
+
+    def __init__(self, index, outputQueue, sharedStats=None):
+        self.index = index
+        self.outputQueue = outputQueue
+        self.decoder = PacketDecoder()
+        self.positionDetector = PositionChangeDetector()
+        self.linkStats = LinkStats()
+        # Optional SharedLinkStats the stats are published to for LaptopClient
+        self.sharedStats = sharedStats
+        self.lastPublishTime = 0
+
+    def handleData(self, rawData):
+        samples = self.decoder.feed(rawData)
+        if samples:
+            self.postProcessing(samples)
+
+    def appendData(self, rawData):
+        # Like handleData, but rawData is only decoded by flush(), so a burst of
+        # notifications is decoded in one go
+        self.decoder.append(rawData)
+        if self.decoder.pendingPackets >= MAX_PENDING_PACKETS:
+            self.flush()
+
+    def flush(self):
+        samples = self.decoder.decode()
+        if samples:
+            self.postProcessing(samples)
+
+    def postProcessing(self, samples):
+        # samples are tuples of ints decoded by PacketDecoder, in packet order
+        time_recv = time.time()
+        for gyroX, gyroY, gyroZ, accelX, accelY, accelZ, motion_flag, emg, sequence in samples:
+            self.linkStats.update(sequence, time_recv)
+            pos_change_flag = 0
+            ## push accelY or 0 to the sliding window
+            self.positionDetector.update(accelY, motion_flag)
+
+            ## get pos change if in neutral
+            if motion_flag == 0:
+                hotPathLogger.debug("no motion!")
+                pos_change_flag = self.positionDetector.getPosChangeFlag()
+
+                if pos_change_flag != 0:
+                    logger.info("bluno %d position change detected: %d", self.index, pos_change_flag)
+                    self.positionDetector.clear() ## clear window
+
+            # record layout is defined in Util/ring_buffer.py
+            record = (self.index, gyroX, gyroY, gyroZ, accelX, accelY, accelZ, motion_flag, pos_change_flag, time_recv)
+            hotPathLogger.debug("Emg: %d", emg)
+            hotPathLogger.debug("Sample: %s", record)
+            self.outputQueue.put(record)
+
+        if self.sharedStats is not None and time_recv - self.lastPublishTime >= PUBLISH_STATS_SEC:
+            self.sharedStats.publish(self.index, self.getStats())
+            self.lastPublishTime = time_recv
+
+    def getStats(self):
+        return self.linkStats.snapshot(self.decoder)
+
+    def reset(self):
+        # Called after a reconnection, a partial packet from the old connection is useless
+        self.decoder.reset()
@@ -0,0 +1,56 @@
+from collections import deque
+import threading
+import time
+from Util.outbound_queue import IDLE
+
+# Frames spooled while the connection to the ultra96 is down, replayed after reconnecting
+SPOOL_MAX_FRAMES = 256
+SPOOL_MAX_BYTES = 4 << 20
+# Move windows older than this are no use to the eval any more and aren't replayed
+MAX_REPLAY_AGE_SEC = 5
+
+
+# Bounded in memory log of encrypted frames that couldn't be sent. When it is full the
+# oldest frames are discarded. replay() hands back what is still worth sending after a
+# reconnect: move windows younger than maxAge, never idle data like link stats.
+class Spool():
+
+    def __init__(self, maxFrames=SPOOL_MAX_FRAMES, maxBytes=SPOOL_MAX_BYTES, maxAge=MAX_REPLAY_AGE_SEC):
+        self.maxFrames = maxFrames
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        # (spool time, priority, frame), oldest first
+        self.frames = deque()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.spooled = 0
+        self.replayed = 0
+        self.discarded = 0
+
+    def append(self, frame, priority):
+        with self.lock:
+            self.frames.append((time.monotonic(), priority, frame))
+            self.size += len(frame)
+            self.spooled += 1
+            while len(self.frames) > self.maxFrames or self.size > self.maxBytes:
+                _, _, dropped = self.frames.popleft()
+                self.size -= len(dropped)
+                self.discarded += 1
+
+    def replay(self):
+        # Empties the spool, returns the frames to send in their original order
+        with self.lock:
+            now = time.monotonic()
+            frames = [frame for spoolTime, priority, frame in self.frames
+                      if priority != IDLE and now - spoolTime <= self.maxAge]
+            self.discarded += len(self.frames) - len(frames)
+            self.replayed += len(frames)
+            self.frames.clear()
+            self.size = 0
+            return frames
+
+    def report(self):
+        with self.lock:
+            return {"spooled": self.spooled, "replayed": self.replayed, "discarded": self.discarded,
+                    "depth": len(self.frames)}
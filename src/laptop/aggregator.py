@@ -0,0 +1,183 @@
+import asyncio
+import json
+import sys
+from laptopClient import openTunnels
+from Util.encryption import EncryptionHandler
+from Util.framing import FrameReader, FramingError, TYPE_TAGGED, encryptFrame, decryptFrame, encodeTagged, decodeTagged, frameBytes
+from Util.logger import getLogger
+
+logger = getLogger("aggregator")
+
+# Multiplexes the connections of several dancer clients (main.py, asyncLaptopClient.py,
+# or simulated dancers started here) over one upstream connection to the ultra96, so
+# there is a single tunnel and handshake instead of one per dancer. Every frame goes
+# upstream wrapped in a TYPE_TAGGED frame naming its dancer, and frames the server
+# tags for a dancer are unwrapped and passed on to it. Frames stay encrypted end to
+# end, the key is only needed to read the dancer IDs.
+#
+# The aggregator waits for all its dancers before connecting upstream and introduces
+# them in its first message, {"command": "aggregator", "dancers": [...]}. Dancers
+# behind it use the clock sync commands of the data stream, it has no clock channel.
+#   python aggregator.py <numDancers> [remote] [simulate] [port=10032]
+
+LOCAL_PORT = 10032
+UPSTREAM_HOST = "127.0.0.1"
+UPSTREAM_PORT = 10022
+
+
+class Aggregator():
+
+    def __init__(self, numDancers, localPort=LOCAL_PORT, upstreamHost=UPSTREAM_HOST, upstreamPort=UPSTREAM_PORT):
+        self.numDancers = numDancers
+        self.localPort = localPort
+        self.upstreamHost = upstreamHost
+        self.upstreamPort = upstreamPort
+        self.encryptionHandler = EncryptionHandler(b'Sixteen byte key')
+
+        # Writer of each dancer's current local connection, keyed by dancer ID
+        self.dancers = {}
+        # The dancers introduced upstream, only they can reconnect once it is connected
+        self.dancerIDs = []
+        self.upstream = None
+        # Created in run(), on the loop they belong to. Every dancer task drains the
+        # upstream writer, drainLock lets one at a time wait for it (Python 3.9 and
+        # older raise AssertionError on concurrent drains of one writer).
+        self.drainLock = None
+        self.allConnected = None
+        self.upstreamReady = None
+        self.allLeft = None
+        self.connectedCount = 0
+
+        self.framesUp = 0
+        self.framesDown = 0
+
+    async def handleDancer(self, reader, writer):
+        # Forwards everything a local dancer sends after its ID frame upstream
+        frameReader = FrameReader()
+        frames = []
+        while not frames:
+            data = await reader.read(4096)
+            if not data:
+                writer.close()
+                return
+            frames = frameReader.feed(data)
+        if frameReader.legacy:
+            logger.warning("Dancer at %s uses legacy framing, which can't be multiplexed", writer.get_extra_info('peername'))
+            writer.close()
+            return
+        dancerID = decryptFrame(frames.pop(0), self.encryptionHandler)
+        if dancerID.startswith("{"):
+            # session keys are agreed between a laptop and the server, the aggregator can't carry them
+            logger.warning("Dancer at %s asked for session mode, which can't be multiplexed", writer.get_extra_info('peername'))
+            writer.close()
+            return
+        if self.dancerIDs:
+            refused = dancerID not in self.dancerIDs or dancerID in self.dancers
+        else:
+            refused = dancerID in self.dancers or len(self.dancers) == self.numDancers
+        if refused:
+            logger.warning("Refusing dancer %s, already have %s", dancerID, list(self.dancers))
+            writer.close()
+            return
+        self.dancers[dancerID] = writer
+        self.connectedCount += 1
+        logger.info("Dancer %s connected (%d/%d)", dancerID, len(self.dancers), self.numDancers)
+        if len(self.dancers) == self.numDancers:
+            self.allConnected.set()
+
+        try:
+            await self.upstreamReady.wait()
+            while True:
+                for frame in frames:
+                    self.upstream.write(encodeTagged(dancerID, frameBytes(frame)))
+                    self.framesUp += 1
+                async with self.drainLock:
+                    await self.upstream.drain()
+                data = await reader.read(4096)
+                if not data:
+                    break
+                frames = frameReader.feed(data)
+        except (ConnectionError, OSError, FramingError) as e:
+            logger.warning("Dancer %s: %s", dancerID, e)
+        finally:
+            # the dancer can connect again, e.g. a laptop reconnecting after a lost link
+            if self.dancers.get(dancerID) is writer:
+                del self.dancers[dancerID]
+        logger.info("Dancer %s disconnected", dancerID)
+        writer.close()
+        self.connectedCount -= 1
+        if self.connectedCount == 0:
+            self.allLeft.set()
+
+    async def handleUpstream(self, reader):
+        # Passes the frames the server tags for each dancer on to it
+        frameReader = FrameReader()
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                raise ConnectionError("connection closed by server")
+            for frame in frameReader.feed(data):
+                if frame.type != TYPE_TAGGED:
+                    logger.warning("Untagged frame from server")
+                    continue
+                dancerID, inner = decodeTagged(frame.payload)
+                writer = self.dancers.get(dancerID)
+                if writer is None or writer.is_closing():
+                    continue
+                writer.write(frameBytes(inner))
+                self.framesDown += 1
+
+    async def run(self, dancers=()):
+        # dancers are coroutines of simulated dancer clients, run on the same loop
+        self.drainLock = asyncio.Lock()
+        self.allConnected = asyncio.Event()
+        self.upstreamReady = asyncio.Event()
+        self.allLeft = asyncio.Event()
+        server = await asyncio.start_server(self.handleDancer, "127.0.0.1", self.localPort)
+        logger.info("Waiting for %d dancers on port %d", self.numDancers, self.localPort)
+        tasks = [asyncio.ensure_future(dancer) for dancer in dancers]
+        try:
+            await self.allConnected.wait()
+            reader, self.upstream = await asyncio.open_connection(self.upstreamHost, self.upstreamPort)
+            self.dancerIDs = list(self.dancers)
+            hello = {"command" : "aggregator", "dancers" : self.dancerIDs}
+            self.upstream.write(encryptFrame(json.dumps(hello), self.encryptionHandler))
+            logger.info("Connected to %s with dancers %s", (self.upstreamHost, self.upstreamPort), self.dancerIDs)
+            self.upstreamReady.set()
+            # runs until the server closes the connection or every dancer has left
+            upstreamTask = asyncio.ensure_future(self.handleUpstream(reader))
+            allLeftTask = asyncio.ensure_future(self.allLeft.wait())
+            await asyncio.wait([upstreamTask, allLeftTask], return_when=asyncio.FIRST_COMPLETED)
+            allLeftTask.cancel()
+            if upstreamTask.done():
+                try:
+                    upstreamTask.result()
+                except (ConnectionError, OSError, FramingError) as e:
+                    logger.warning("Upstream connection lost: %s", e)
+            else:
+                upstreamTask.cancel()
+        finally:
+            if self.upstream is not None:
+                self.upstream.close()
+            logger.info("Frames forwarded: %d up, %d down", self.framesUp, self.framesDown)
+            server.close()
+            for writer in self.dancers.values():
+                writer.close()
+            for task in tasks:
+                task.cancel()
+
+
+if __name__ == "__main__":
+    numDancers = int(sys.argv[1])
+    options = [arg.strip() for arg in sys.argv[2:]]
+    if "remote" in options:
+        openTunnels()
+    localPort = int(next((option.split("=", 1)[1] for option in options if option.startswith("port=")), LOCAL_PORT))
+    aggregator = Aggregator(numDancers, localPort)
+    dancers = []
+    if "simulate" in options:
+        # load test: numDancers dummy dancers in this process, IDs 1 to numDancers
+        from asyncLaptopClient import AsyncLaptopClient
+        from main import blunoDummy
+        dancers = [AsyncLaptopClient("127.0.0.1", localPort, str(index + 1)).run(blunoDummy) for index in range(numDancers)]
+    asyncio.run(aggregator.run(dancers))
@@ -0,0 +1,340 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+from laptopClient import (SHUTDOWNCOMMAND, LINK_STATS_INTERVAL_SEC, IDLE_TIMEOUT_SEC, RECONNECT_DELAY_SEC,
+                          MAX_RECONNECT_DELAY_SEC, preprocess,
+                          linkStatsMessage, segmentMessage, offsetMessage, openTunnels)
+from Util.encryption import EncryptionHandler, SESSION_NONCE_BYTES
+from Cryptodome.Random import get_random_bytes
+from Util.ring_buffer import ID
+from Util.move_segmenter import MoveSegmenter
+from Util.batch_sender import BatchSender
+from Util.framing import FrameReader, FramingError, Frame, HEADER, TYPE_MESSAGE, TYPE_SEGMENT, encryptFrame, decryptFrame
+from Util.sample_codec import CODECS, CODEC_RAW, encodeSamples
+from Util.clock_sync import ClockSync
+from Util.clock_channel import CLOCK_PORT_OFFSET, PACKET, SYNC, REPLY, REQUEST, RESULT, packPacket, setNoDelay
+from Util.spool import Spool
+from Util.outbound_queue import IDLE, MOVE
+from Util.link_stats import SharedLinkStats
+from Util.logger import getLogger, RateLimitedLogger
+
+logger = getLogger("asyncLaptopClient")
+hotPathLogger = RateLimitedLogger(logger)
+
+# Single process, single event loop alternative to main.py's three processes.
+# Sending data, handling server commands (clock sync included) and reconnecting
+# all run as tasks on one loop over a single stream reader/writer, the blocking
+# bluno producer (bluepy or the dummy) runs in a thread and hands its samples
+# to the loop through a LoopQueue.
+
+# Samples waiting for handleBlunoData, the oldest are dropped beyond this
+SAMPLE_QUEUE_SIZE = 1024
+
+
+class LoopQueue():
+    # Output queue for producers running in another thread. Every record is handed to
+    # the loop's asyncio.Queue, when it is full the oldest record is dropped, same as
+    # SampleRingBuffer.
+
+    def __init__(self, loop, samples):
+        self.loop = loop
+        self.samples = samples
+        self.overrunCount = 0
+
+    def put(self, record):
+        try:
+            self.loop.call_soon_threadsafe(self.putNowait, record)
+        except RuntimeError:
+            # the loop is closed, the client is shutting down
+            pass
+
+    def putNowait(self, record):
+        if self.samples.full():
+            self.samples.get_nowait()
+            self.overrunCount += 1
+        self.samples.put_nowait(record)
+
+    def overruns(self):
+        return self.overrunCount
+
+
+class AsyncLaptopClient():
+
+    def __init__(self, host, port, dancerID, edgeFeatures=False, sampleCodec=CODEC_RAW, sessionMode=False):
+        # With edgeFeatures set, features are extracted from every move segment here
+        # and only the feature vector is sent instead of the raw samples
+        if edgeFeatures and preprocess is None:
+            raise ImportError("edgeFeatures needs pandas for preprocess")
+        self.edgeFeatures = edgeFeatures
+        # Codec of binary move segments, delta or delta-zlib trade laptop CPU for a slower link
+        self.sampleCodec = sampleCodec
+        # AES-GCM under a key agreed at identification, see LaptopClient
+        self.sessionMode = sessionMode
+        self.session = None
+        self.host = host
+        self.port = port
+        self.dancerID = dancerID
+        self.encryptionHandler = EncryptionHandler(b'Sixteen byte key')
+        self.clockSync = ClockSync()
+
+        self.reader = None
+        self.writer = None
+        # Dedicated clock sync connection, (reader, writer) while the server has one
+        self.clockChannel = None
+        self.batchSender = BatchSender(lambda message, samples: self.sendMessage(message, priority=MOVE))
+        # Data sent while disconnected, replayed by connect()
+        self.spool = Spool()
+        # One MoveSegmenter per bluno, keyed by bluno index
+        self.segmenters = {}
+        # Created in run(), on the loop they belong to
+        self.samples = None
+        self.evalStarted = None
+        self.drainLock = None
+
+    def sendMessage(self, message, frameType=TYPE_MESSAGE, priority=None):
+        # The transport buffers the write, handleBlunoData drains it. While disconnected
+        # data (messages with a priority) is spooled, control messages are dropped.
+        if self.writer is None or self.writer.is_closing():
+            if priority is None:
+                hotPathLogger.warning("Not connected, dropping message")
+            elif self.sessionMode and self.session is None:
+                # the server would reject a frame without the session it doesn't have yet
+                hotPathLogger.warning("No session yet, dropping message")
+            else:
+                self.spool.append(encryptFrame(message, self.encryptionHandler, frameType, self.session), priority)
+            return
+        hotPathLogger.debug("SENDING: %s", message)
+        self.writer.write(encryptFrame(message, self.encryptionHandler, frameType, self.session))
+
+    async def drain(self, writer):
+        # connect() and handleBlunoData both wait for the writer, Python 3.9 and older
+        # raise AssertionError on concurrent drains of one writer
+        async with self.drainLock:
+            await writer.drain()
+
+    async def connect(self):
+        # Retries with backoff until the server accepts, then identifies as dancerID. The
+        # connection only becomes self.writer once the identification, the session and the
+        # spool replay are written, until then sendMessage keeps spooling so nothing new
+        # overtakes the spooled frames.
+        delay = RECONNECT_DELAY_SEC
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                break
+            except OSError as e:
+                logger.warning("Connecting to %s failed: %s, retrying in %.1f s", (self.host, self.port), e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY_SEC)
+        logger.info("%s: Connection established with %s", self.dancerID, (self.host, self.port))
+        if self.sessionMode:
+            await self.startSession(reader, writer)
+        else:
+            writer.write(encryptFrame(self.dancerID, self.encryptionHandler))
+        replayed = 0
+        frames = self.spool.replay()
+        while frames:
+            for frame in frames:
+                writer.write(frame)
+            replayed += len(frames)
+            await self.drain(writer)
+            # frames spooled while draining
+            frames = self.spool.replay()
+        self.reader, self.writer = reader, writer
+        if replayed:
+            report = self.spool.report()
+            logger.info("Replayed %d spooled frames, %d spooled, %d discarded so far",
+                        replayed, report['spooled'], report['discarded'])
+        await self.connectClockChannel()
+
+    async def connectClockChannel(self):
+        # Clock sync goes over the data socket if the server has no clock channel
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port + CLOCK_PORT_OFFSET)
+            setNoDelay(writer.get_extra_info('socket'))
+            writer.write(encryptFrame(self.dancerID, self.encryptionHandler))
+            await writer.drain()
+        except OSError as e:
+            logger.warning("No clock channel: %s", e)
+            return
+        self.clockChannel = (reader, writer)
+        logger.info("%s: Clock channel established", self.dancerID)
+
+    async def handleClockChannel(self):
+        # Answers the server's sync rounds on the clock channel until it closes
+        reader, writer = self.clockChannel
+        try:
+            while True:
+                packet = await reader.readexactly(PACKET.size)
+                timeRecv = time.time()
+                packetType, number, t1, t2, t3, _ = PACKET.unpack(packet)
+                if packetType == SYNC:
+                    writer.write(packPacket(REQUEST, number, time.time()))
+                elif packetType == REPLY:
+                    writer.write(packPacket(RESULT, number, t1, t2, t3, timeRecv))
+                    sample = self.clockSync.addSample(t1, t2, t3, timeRecv)
+                    logger.info("Clock offset: %s (this sync %s, RTT %s, error %.2f ms)", self.clockSync.offset(timeRecv),
+                                sample.offset, sample.rtt, self.clockSync.error(timeRecv) * 1000)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            # the server falls back to clock sync over the data socket
+            logger.warning("Clock channel lost: %s", e)
+
+    async def startSession(self, reader, writer):
+        # Same exchange as LaptopClient.startSession
+        clientNonce = self.session.clientNonce if self.session is not None else get_random_bytes(SESSION_NONCE_BYTES)
+        hello = {"command" : "identify", "dancer" : self.dancerID, "nonce" : clientNonce.hex()}
+        writer.write(encryptFrame(json.dumps(hello), self.encryptionHandler))
+        frameType, flags, length = HEADER.unpack(await reader.readexactly(HEADER.size))[1:]
+        payload = await reader.readexactly(length)
+        reply = json.loads(decryptFrame(Frame(frameType, flags, payload), self.encryptionHandler))
+        serverNonce = bytes.fromhex(reply['nonce'])
+        if self.session is None or self.session.serverNonce != serverNonce:
+            self.session = self.encryptionHandler.newSession(clientNonce, serverNonce, self.dancerID, False)
+        logger.info("%s: Session established", self.dancerID)
+
+    async def disconnect(self):
+        if self.clockChannel is not None:
+            self.clockChannel[1].close()
+            self.clockChannel = None
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    def startClockSync(self):
+        self.timeSend = time.time()
+        messagedict = {"command" : "clocksync", "message" : str(self.timeSend)}
+        logger.debug("SENDING %s", messagedict)
+        self.sendMessage(json.dumps(messagedict))
+
+    def respondClockSync(self, timestamps, timeRecv):
+        self.sendMessage(json.dumps(offsetMessage(self.clockSync, self.timeSend, timestamps, timeRecv)))
+
+    async def handleServerCommands(self):
+        # Returns on quit, raises ConnectionError when the connection is lost
+        frameReader = FrameReader()
+        while True:
+            data = await self.reader.read(4096)
+            timeRecv = time.time()
+            if not data:
+                raise ConnectionError("connection closed by server")
+            for frame in frameReader.feed(data):
+                command = decryptFrame(frame, self.encryptionHandler, self.session)
+                logger.info("COMMAND RECEIVED: %s", command)
+                if command == "quit":
+                    return
+                elif command == "sync":
+                    self.startClockSync()
+                elif command == "start":
+                    self.evalStarted.set()
+                elif "clocksync" in command:
+                    self.respondClockSync(command, timeRecv)
+
+    async def sendSegment(self, moveStartTime, records):
+        if not self.edgeFeatures:
+            # One binary frame, the server takes the move start time from its first moving sample.
+            # Pending messages go first so the server sees everything in order.
+            self.batchSender.flush()
+            self.sendMessage(encodeSamples(records, self.sampleCodec), TYPE_SEGMENT, MOVE)
+            return
+        # The timestamp is the first sample of the move itself, the pre-roll comes before it
+        self.batchSender.add({"command" : "timestamp", "message" : moveStartTime})
+        # feature extraction takes milliseconds, keep it off the loop so clock sync replies aren't delayed
+        message = await asyncio.get_running_loop().run_in_executor(None, segmentMessage, records, True)
+        self.batchSender.add(message, len(records))
+
+    async def nextSample(self, timeout):
+        # Returns the next sample, or None if none arrives within timeout
+        if not self.samples.empty():
+            return self.samples.get_nowait()
+        try:
+            return await asyncio.wait_for(self.samples.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def handleBlunoData(self, inputQueue, linkStats=None):
+        lastLinkStatsTime = time.time()
+        while True:
+            if linkStats is not None and time.time() - lastLinkStatsTime >= LINK_STATS_INTERVAL_SEC:
+                lastLinkStatsTime = time.time()
+                message = linkStatsMessage(inputQueue, linkStats)
+                message["message"]["spool"] = self.spool.report()
+                self.sendMessage(json.dumps(message), priority=IDLE)
+            # Wait for the next sample, but wake up in time to send a pending batch
+            timeout = self.batchSender.timeout()
+            record = await self.nextSample(IDLE_TIMEOUT_SEC if timeout is None else timeout)
+            # Data is ignored until the eval has started
+            if record is not None and self.evalStarted.is_set():
+                segmenter = self.segmenters.get(record[ID])
+                if segmenter is None:
+                    segmenter = self.segmenters[record[ID]] = MoveSegmenter()
+                segment = segmenter.update(record)
+                if segment is not None:
+                    await self.sendSegment(*segment)
+            self.batchSender.flushIfDue()
+            if self.writer is not None:
+                try:
+                    await self.drain(self.writer)
+                except (ConnectionError, OSError):
+                    # handleServerCommands sees the lost connection and reconnects
+                    pass
+
+    async def run(self, producer, linkStats=None):
+        # producer(outputQueue) is the blocking bluno loop, run in a daemon thread
+        loop = asyncio.get_running_loop()
+        self.samples = asyncio.Queue(SAMPLE_QUEUE_SIZE)
+        self.evalStarted = asyncio.Event()
+        self.drainLock = asyncio.Lock()
+        inputQueue = LoopQueue(loop, self.samples)
+        threading.Thread(target=producer, args=(inputQueue,), daemon=True).start()
+
+        dataTask = asyncio.ensure_future(self.handleBlunoData(inputQueue, linkStats))
+        try:
+            while True:
+                await self.connect()
+                clockTask = asyncio.ensure_future(self.handleClockChannel()) if self.clockChannel else None
+                try:
+                    await self.handleServerCommands()
+                    break
+                except (ConnectionError, OSError, FramingError) as e:
+                    logger.warning("Connection lost: %s, reconnecting", e)
+                    await self.disconnect()
+                finally:
+                    if clockTask is not None:
+                        clockTask.cancel()
+
+            logger.info("Shutting down dancer number " + self.dancerID)
+            self.batchSender.flush()
+            self.sendMessage(json.dumps(SHUTDOWNCOMMAND))
+            await self.drain(self.writer)
+        finally:
+            dataTask.cancel()
+            await self.disconnect()
+            logger.info("Samples overwritten before being sent: %d", inputQueue.overruns())
+
+
+if __name__ == "__main__":
+    # python asyncLaptopClient.py <dancerID> [remote] [edge] [ble] [codec=raw|delta|delta-zlib] [port=10022] [session]
+    dancerID = sys.argv[1].strip()
+    options = [arg.strip() for arg in sys.argv[2:]]
+    if "remote" in options:
+        openTunnels()
+    codec = next((option.split("=", 1)[1] for option in options if option.startswith("codec=")), "raw")
+    port = int(next((option.split("=", 1)[1] for option in options if option.startswith("port=")), 10022))
+    client = AsyncLaptopClient("127.0.0.1", port, dancerID, edgeFeatures="edge" in options, sampleCodec=CODECS[codec],
+                               sessionMode="session" in options)
+    linkStats = None
+    if "ble" in options:
+        import ble_manager
+        # Loss and jitter of every bluno link, reported to the server
+        linkStats = SharedLinkStats(3)
+        producer = lambda outputQueue: ble_manager.connect_to_blunos("p1", outputQueue, linkStats=linkStats)
+    else:
+        from main import blunoDummy
+        producer = blunoDummy
+    asyncio.run(client.run(producer, linkStats))
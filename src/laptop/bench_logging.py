@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+from Util.logger import setupLogging, stopListener
+from Util.packet_decoder import calculateChecksum
+from Util import sample_processor
+from Util.sample_processor import SampleProcessor
+
+# Per packet cost of the laptop ingest path with logging disabled versus at debug level,
+# and at debug level with rate limiting turned off (every hot path message written):
+#   python bench_logging.py [numPackets]
+
+NOTIFICATION_SIZE = 20
+
+
+class NullQueue():
+    def put(self, record):
+        pass
+
+
+def makeNotifications(numPackets):
+    notifications = []
+    for i in range(numPackets):
+        content = "{};{};{};{};{};{};{};{}".format(i % 300, -i % 200, 17, -4000, i % 90 - 45, 16000, (i // 50) % 2, 512).encode()
+        packet = content + b":" + str(calculateChecksum(content)).encode() + b"\n"
+        for j in range(0, len(packet), NOTIFICATION_SIZE):
+            notifications.append(packet[j:j + NOTIFICATION_SIZE])
+    return notifications
+
+
+def run(notifications, numPackets):
+    processor = SampleProcessor(0, NullQueue())
+    start = time.perf_counter()
+    for notification in notifications:
+        processor.handleData(notification)
+    elapsed = time.perf_counter() - start
+    return elapsed / numPackets * 1e6
+
+
+if __name__ == "__main__":
+    numPackets = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    notifications = makeNotifications(numPackets)
+
+    with open(os.devnull, "w") as devnull:
+        for name, level, rateLimit in [("disabled (WARNING)", "WARNING", 1.0),
+                                       ("debug", "DEBUG", 1.0),
+                                       ("debug, no rate limit", "DEBUG", 0)]:
+            setupLogging(level=level, levels={}, stream=devnull)
+            sample_processor.hotPathLogger.interval = rateLimit
+            run(notifications, numPackets)  # warm up
+            print("logging {:<20} {:8.2f} us/packet".format(name, run(notifications, numPackets)))
+        # write out anything still queued before devnull is closed
+        stopListener()
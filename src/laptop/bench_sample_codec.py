@@ -0,0 +1,134 @@
+import argparse
+import json
+import math
+import random
+import time
+from Util.ring_buffer import RECORD_KEYS, recordToDict
+from Util.sample_codec import CODECS, encodeSamples, decodeSamples
+from Util.move_segmenter import MoveSegmenter
+
+# Encode and decode cost and bytes per sample of the data path encodings:
+#   json per sample   one {"command": "data", ...} message per sample (before move segments)
+#   json segment      one {"command": "segment", ...} message per move
+#   raw/delta/...     Util/sample_codec.py with each of its codecs
+# Segments are synthetic motion, or cut from a notification log recorded with ble_manager.py:
+#   python bench_sample_codec.py [--segments N] [--length N] [--log capture.log] [--kbps 256]
+# With --kbps, the time to encode, send over a link of that bandwidth and decode one
+# segment is also shown, to pick the codec for a link.
+
+
+def makeSegment(length, rng):
+    # Smooth motion: a few sines per axis plus sensor noise, sampled at about 50 Hz
+    startTime = time.time()
+    phases = [rng.uniform(0, 2 * math.pi) for _ in range(6)]
+    amplitudes = [2000] * 3 + [12000] * 3
+    records = []
+    for i in range(length):
+        t = i * 0.02
+        axes = [int(amplitude * (math.sin(2 * math.pi * 1.3 * t + phase) + 0.3 * math.sin(2 * math.pi * 4.1 * t + 2 * phase))
+                    + rng.gauss(0, amplitude / 200))
+                for amplitude, phase in zip(amplitudes, phases)]
+        records.append((1, *axes, 1, rng.choice((-1, 0, 1)) if i == length // 2 else 0,
+                        startTime + t + rng.uniform(0, 0.002)))
+    return records
+
+
+def readSegments(path):
+    # Replays the log through the ingest path, like ble_replay.py, and cuts the samples into move segments
+    from ble_manager import BlunoDevice, STREAMING
+    from ble_replay import NullCharacteristic
+    from Util.notification_log import readNotifications
+
+    class ListQueue():
+        def __init__(self):
+            self.records = []
+
+        def put(self, record):
+            self.records.append(record)
+
+    outputQueue = ListQueue()
+    devices = {}
+    for _, index, rawData in readNotifications(path):
+        if index not in devices:
+            device = devices[index] = BlunoDevice(index, "replay:{}".format(index), outputQueue)
+            device.serviceChar = NullCharacteristic()
+            device.state = STREAMING
+        devices[index].handleNotification(0, rawData)
+
+    segmenters = {}
+    segments = []
+    for record in outputQueue.records:
+        segment = segmenters.setdefault(record[0], MoveSegmenter()).update(record)
+        if segment is not None:
+            segments.append(segment[1])
+    return segments
+
+
+def encodeJsonSamples(records):
+    messages = []
+    for record in records:
+        packet = recordToDict(record)
+        packet['command'] = 'data'
+        messages.append(json.dumps(packet))
+    return messages
+
+
+def decodeJsonSamples(messages):
+    return [json.loads(message) for message in messages]
+
+
+def encodeJsonSegment(records):
+    return json.dumps({"command" : "segment", "message" : {"columns" : RECORD_KEYS, "samples" : records}})
+
+
+def decodeJsonSegment(message):
+    return json.loads(message)["message"]["samples"]
+
+
+def size(encoded):
+    if isinstance(encoded, list):
+        return sum(len(message) for message in encoded)
+    return len(encoded)
+
+
+def bench(name, encode, decode, segments, kbps):
+    numSamples = sum(len(segment) for segment in segments)
+    start = time.perf_counter()
+    encoded = [encode(segment) for segment in segments]
+    encodeTime = time.perf_counter() - start
+    start = time.perf_counter()
+    for message in encoded:
+        decode(message)
+    decodeTime = time.perf_counter() - start
+    totalBytes = sum(size(message) for message in encoded)
+    line = "{:<16} encode {:6.2f} us/sample   decode {:6.2f} us/sample   {:6.1f} bytes/sample".format(
+        name, encodeTime / numSamples * 1e6, decodeTime / numSamples * 1e6, totalBytes / numSamples)
+    if kbps:
+        perSegment = (encodeTime + decodeTime + totalBytes * 8 / (kbps * 1000)) / len(segments)
+        line += "   {:7.2f} ms/segment at {} kbps".format(perSegment * 1000, kbps)
+    print(line)
+    return totalBytes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the sample encodings of the laptop data path")
+    parser.add_argument("--segments", type=int, default=2000, help="number of synthetic segments")
+    parser.add_argument("--length", type=int, default=40, help="samples per synthetic segment")
+    parser.add_argument("--log", help="take the segments from this notification log instead")
+    parser.add_argument("--kbps", type=float, default=0, help="also show the time per segment over a link this fast")
+    args = parser.parse_args()
+
+    if args.log:
+        segments = readSegments(args.log)
+        if not segments:
+            parser.error("no move segments in {}".format(args.log))
+    else:
+        rng = random.Random(0)
+        segments = [makeSegment(args.length, rng) for _ in range(args.segments)]
+    print("{} segments, {} samples".format(len(segments), sum(len(segment) for segment in segments)))
+
+    bench("json per sample", encodeJsonSamples, decodeJsonSamples, segments, args.kbps)
+    jsonBytes = bench("json segment", encodeJsonSegment, decodeJsonSegment, segments, args.kbps)
+    for name, codec in CODECS.items():
+        codecBytes = bench(name, lambda records: encodeSamples(records, codec), decodeSamples, segments, args.kbps)
+        print("{:<16} {:.1f}x smaller than json segment".format("", jsonBytes / codecBytes))
@@ -0,0 +1,242 @@
+from functools import partial
+import sys
+import time
+from Util.sample_processor import SampleProcessor
+from Util.logger import getLogger
+from Util.notification_log import NotificationRecorder
+from Util.link_stats import addRates
+
+logger = getLogger("ble_manager")
+
+# Single process alternative to running one connect_to_pi process per bluno.
+# Every bluno has its own BlunoDevice holding its connection, handshake and parsing
+# state, and BlunoManager polls all of them round robin with short timeouts, so a
+# bluno that is handshaking or silent never holds up the others.
+
+BLUNO_SERVICE_UUID = "0000dfb0-0000-1000-8000-00805f9b34fb"
+
+POLL_TIMEOUT_SEC = 0.005            # waitForNotifications timeout per device per turn
+MAX_NOTIFICATIONS_PER_TURN = 8      # so one bursting device can't starve the others
+HANDSHAKE_TIMEOUT_SEC = 1           # resend H if no ACK within this time
+MAX_HANDSHAKE_ATTEMPTS = 5          # then drop the connection and reconnect
+PACKET_TIMEOUT_SEC = 3              # reconnect if a streaming bluno goes silent this long
+KEEP_ALIVE_SEC = 5                  # interval between C packets
+RECONNECT_DELAY_SEC = 0.5           # wait before connecting again after a failure
+MAX_RECONNECT_DELAY_SEC = 5
+
+# Device states
+DISCONNECTED = 0
+HANDSHAKING = 1
+STREAMING = 2
+STATE_NAMES = {DISCONNECTED: "DISCONNECTED", HANDSHAKING: "HANDSHAKING", STREAMING: "STREAMING"}
+
+
+class BlunoDevice():
+
+    def __init__(self, index, address, outputQueue, recorder=None, linkStats=None):
+        self.index = index
+        self.address = address
+        self.processor = SampleProcessor(index, outputQueue, linkStats)
+        # Optional NotificationRecorder capturing every raw notification for ble_replay.py
+        self.recorder = recorder
+
+        self.state = DISCONNECTED
+        self.peripheral = None
+        self.serviceChar = None
+
+        self.nextConnectTime = 0
+        self.reconnectDelay = RECONNECT_DELAY_SEC
+        self.handshakeAttempts = 0
+        self.handshakeSentTime = 0
+        self.lastPacketTime = 0
+        self.lastCPacketTime = 0
+
+        # Counters for load tests
+        self.connectionAttempts = 0
+        self.reconnections = 0
+        self.notifications = 0
+
+    def setState(self, state):
+        logger.info("Bluno %d: %s -> %s", self.index, STATE_NAMES[self.state], STATE_NAMES[state])
+        self.state = state
+
+    def send(self, command):
+        self.serviceChar.write(command)
+
+    def sendH(self, now):
+        self.send(b'H')
+        self.handshakeAttempts += 1
+        self.handshakeSentTime = now
+
+    # Called by the peripheral from inside waitForNotifications
+    def handleNotification(self, cHandle, rawData):
+        self.notifications += 1
+        now = time.time()
+        self.lastPacketTime = now
+        if self.recorder is not None:
+            self.recorder.record(self.index, rawData, now)
+
+        if b"ACK" in rawData:
+            # Duplicate ACKs while streaming are answered with R again, same as NotificationDelegate
+            self.send(b'R')
+            if self.state == HANDSHAKING:
+                logger.info("Handshake with bluno %d is completed", self.index)
+                self.lastCPacketTime = now
+                self.reconnectDelay = RECONNECT_DELAY_SEC
+                self.setState(STREAMING)
+        elif self.state == STREAMING:
+            # decoded by BlunoManager.poll once the burst this belongs to is drained
+            self.processor.appendData(rawData)
+
+
+class BlunoManager():
+
+    def __init__(self, addresses, outputQueue, peripheralClass=None, recorder=None, linkStats=None):
+        # linkStats is an optional SharedLinkStats every device publishes its link stats to
+        if peripheralClass is None:
+            from bluepy.btle import Peripheral
+            peripheralClass = Peripheral
+        self.peripheralClass = peripheralClass
+        self.devices = [BlunoDevice(index, address, outputQueue, recorder, linkStats)
+                        for index, address in enumerate(addresses)]
+
+    def connect(self, device, now):
+        # bluepy's Peripheral() blocks until connected or failed, the other devices are
+        # only held up for that one attempt, retries are spaced out by nextConnectTime
+        device.connectionAttempts += 1
+        logger.info("Connecting to bluno %d with address: %s", device.index, device.address)
+        try:
+            peripheral = self.peripheralClass(device.address)
+            peripheral.withDelegate(device)
+            device.serviceChar = peripheral.getServiceByUUID(BLUNO_SERVICE_UUID).getCharacteristics()[0]
+            device.peripheral = peripheral
+        except Exception as e:
+            logger.warning("Failed connecting to bluno %d: %s", device.index, e)
+            self.scheduleReconnect(device, time.time())
+            return
+
+        device.processor.reset()
+        device.handshakeAttempts = 0
+        device.setState(HANDSHAKING)
+        device.sendH(time.time())
+
+    def disconnect(self, device, now):
+        device.processor.flush()
+        if device.peripheral is not None:
+            try:
+                device.peripheral.disconnect()
+            except Exception:
+                pass
+        device.peripheral = None
+        device.serviceChar = None
+        device.reconnections += 1
+        device.setState(DISCONNECTED)
+        self.scheduleReconnect(device, now)
+
+    def scheduleReconnect(self, device, now):
+        device.nextConnectTime = now + device.reconnectDelay
+        device.reconnectDelay = min(device.reconnectDelay * 2, MAX_RECONNECT_DELAY_SEC)
+
+    def poll(self, device):
+        # Notifications are buffered until the device has nothing more pending, a burst
+        # (e.g. after a stall) is then decoded as one backlog. A burst longer than one
+        # turn stays buffered until a later turn drains it.
+        for _ in range(MAX_NOTIFICATIONS_PER_TURN):
+            if device.state == DISCONNECTED:
+                return
+            if not device.peripheral.waitForNotifications(POLL_TIMEOUT_SEC):
+                device.processor.flush()
+                return
+
+    def step(self):
+        # One round robin turn over every device
+        for device in self.devices:
+            now = time.time()
+            try:
+                if device.state == DISCONNECTED:
+                    if now >= device.nextConnectTime:
+                        self.connect(device, now)
+                    continue
+
+                self.poll(device)
+                now = time.time()
+
+                if device.state == HANDSHAKING and now - device.handshakeSentTime >= HANDSHAKE_TIMEOUT_SEC:
+                    if device.handshakeAttempts >= MAX_HANDSHAKE_ATTEMPTS:
+                        logger.warning("Didn't receive ACK from bluno %d after %d attempts", device.index, device.handshakeAttempts)
+                        self.disconnect(device, now)
+                    else:
+                        device.sendH(now)
+
+                elif device.state == STREAMING:
+                    if now - device.lastPacketTime >= PACKET_TIMEOUT_SEC:
+                        logger.warning("bluno %d packet delay more than %d seconds, performing reconnection...",
+                                       device.index, PACKET_TIMEOUT_SEC)
+                        self.disconnect(device, now)
+                    elif now - device.lastCPacketTime >= KEEP_ALIVE_SEC:
+                        # Send packet C to bluno to indicate a stable connection
+                        device.send(b'C')
+                        device.lastCPacketTime = now
+
+            except Exception as e:
+                logger.warning("Bluno %d exception: %s", device.index, e)
+                self.disconnect(device, time.time())
+
+    def run(self, duration=None):
+        endTime = None if duration is None else time.time() + duration
+        while endTime is None or time.time() < endTime:
+            if all(device.state == DISCONNECTED for device in self.devices):
+                # nothing to poll, don't spin while waiting to reconnect
+                time.sleep(POLL_TIMEOUT_SEC)
+            self.step()
+
+
+def connect_to_blunos(_name, buffer_tuple, addresses=None, recordPath=None, linkStats=None):
+    # Drop in replacement for one connect_to_pi process per bluno.
+    # With recordPath set every raw notification is also logged for ble_replay.py
+    if addresses is None:
+        from internal_comms import blunoAddress
+        addresses = blunoAddress
+    recorder = NotificationRecorder(recordPath) if recordPath is not None else None
+    try:
+        BlunoManager(addresses, buffer_tuple, recorder=recorder, linkStats=linkStats).run()
+    finally:
+        if recorder is not None:
+            recorder.close()
+
+
+class CountingQueue():
+    # Output queue for load tests, counts samples per bluno instead of keeping them
+
+    def __init__(self, numDevices):
+        self.counts = [0] * numDevices
+
+    def put(self, record):
+        self.counts[record[0]] += 1
+
+
+if __name__ == "__main__":
+    # Load test with fake blunos: python ble_manager.py [numBlunos] [seconds] [sampleRate] [recordPath]
+    numBlunos = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    sampleRate = float(sys.argv[3]) if len(sys.argv) > 3 else 25
+    recorder = NotificationRecorder(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    from fake_bluno import FakePeripheral
+    outputQueue = CountingQueue(numBlunos)
+    manager = BlunoManager(["fake:{}".format(i) for i in range(numBlunos)], outputQueue,
+                           peripheralClass=partial(FakePeripheral, sampleRate=sampleRate), recorder=recorder)
+    start = time.time()
+    manager.run(duration)
+    elapsed = time.time() - start
+    if recorder is not None:
+        recorder.close()
+        print("Recorded {} notifications to {}".format(recorder.count, sys.argv[4]))
+
+    for device in manager.devices:
+        stats = addRates(device.processor.getStats())
+        print("Bluno {}: {:.1f} samples/sec, {} notifications, {} reconnections, loss rate {:.2%}, "
+              "checksum failure rate {:.2%}, jitter {:.1f} ms".format(
+                  device.index, outputQueue.counts[device.index] / elapsed, device.notifications,
+                  device.reconnections, stats["lossRate"], stats["checksumFailureRate"], stats["jitterMs"]))
+    print("Total: {:.1f} samples/sec".format(sum(outputQueue.counts) / elapsed))
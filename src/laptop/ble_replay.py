@@ -0,0 +1,146 @@
+import argparse
+import random
+import time
+from ble_manager import BlunoDevice, STREAMING, POLL_TIMEOUT_SEC
+from Util.notification_log import readNotifications
+from Util.link_stats import addRates
+
+# Replays a notification log (recorded with ble_manager.py / connect_to_blunos recordPath)
+# through the laptop ingest path without any bluno, and reports throughput, parse errors
+# and per packet latency. Like BlunoManager.poll, notifications of one bluno arriving
+# within POLL_TIMEOUT_SEC of each other are decoded together once the burst ends. Faults can be injected to test the decoder under bad links:
+#   python ble_replay.py capture.log --speed max --fragment 5 --corrupt 0.01 --dup-ack 0.01
+
+
+class NullCharacteristic():
+    # Swallows the R packets BlunoDevice sends in reply to ACKs
+    def write(self, data, withResponse=False):
+        pass
+
+
+class LatencyQueue():
+    # Output queue recording, for every sample, the time since the first notification of its burst arrived
+
+    def __init__(self):
+        self.arrivalTime = 0
+        self.latencies = []
+
+    def put(self, record):
+        self.latencies.append(time.perf_counter() - self.arrivalTime)
+
+
+def fragment(notifications, maxSize, rng):
+    # Split every notification into random pieces of 1 to maxSize bytes
+    result = []
+    for arrivalTime, index, rawData in notifications:
+        offset = 0
+        while offset < len(rawData):
+            size = rng.randint(1, maxSize)
+            result.append((arrivalTime, index, rawData[offset:offset + size]))
+            offset += size
+    return result
+
+
+def injectFaults(notifications, corruptRate, dupAckRate, rng):
+    # Flip a random byte in corruptRate of the notifications and
+    # send a duplicate ACK after dupAckRate of them
+    result = []
+    for arrivalTime, index, rawData in notifications:
+        if rawData and rng.random() < corruptRate:
+            corrupted = bytearray(rawData)
+            corrupted[rng.randrange(len(corrupted))] ^= 1 << rng.randrange(8)
+            rawData = bytes(corrupted)
+        result.append((arrivalTime, index, rawData))
+        if rng.random() < dupAckRate:
+            result.append((arrivalTime, index, b"ACK"))
+    return result
+
+
+def replay(notifications, speed=None):
+    # speed is a multiple of the recorded rate, None replays as fast as possible
+    outputQueue = LatencyQueue()
+    devices = {}
+    for _, index, _ in notifications:
+        if index not in devices:
+            device = BlunoDevice(index, "replay:{}".format(index), outputQueue)
+            device.serviceChar = NullCharacteristic()
+            device.state = STREAMING
+            devices[index] = device
+
+    firstArrival = notifications[0][0] if notifications else 0
+    start = time.perf_counter()
+    burstStart = None
+    for position, (arrivalTime, index, rawData) in enumerate(notifications):
+        if speed is None:
+            replayTime = time.perf_counter()
+        else:
+            replayTime = start + (arrivalTime - firstArrival) / speed
+            wait = replayTime - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        if burstStart is None:
+            burstStart = outputQueue.arrivalTime = replayTime
+        devices[index].handleNotification(0, rawData)
+
+        following = notifications[position + 1] if position + 1 < len(notifications) else None
+        if following is None or following[1] != index or following[0] - arrivalTime > POLL_TIMEOUT_SEC:
+            devices[index].processor.flush()
+            burstStart = None
+    elapsed = time.perf_counter() - start
+
+    return devices, outputQueue.latencies, elapsed
+
+
+def percentile(sortedValues, fraction):
+    if not sortedValues:
+        return 0
+    return sortedValues[min(int(len(sortedValues) * fraction), len(sortedValues) - 1)]
+
+
+def report(notifications, devices, latencies, elapsed):
+    decoded = sum(device.processor.decoder.packetsDecoded for device in devices.values())
+    errors = sum(device.processor.decoder.checksumErrors + device.processor.decoder.parseErrors
+                 for device in devices.values())
+    latencies = sorted(latencies)
+
+    print("Notifications:     {}".format(len(notifications)))
+    print("Packets decoded:   {}".format(decoded))
+    print("Elapsed:           {:.3f} s".format(elapsed))
+    print("Packets/sec:       {:.1f}".format(decoded / elapsed if elapsed else 0))
+    print("Parse error rate:  {:.4%}".format(errors / (decoded + errors) if decoded + errors else 0))
+    print("Latency p50/p99/max: {:.1f} / {:.1f} / {:.1f} us".format(
+        percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6,
+        (latencies[-1] if latencies else 0) * 1e6))
+    for index, device in sorted(devices.items()):
+        decoder = device.processor.decoder
+        stats = addRates(device.processor.getStats())
+        print("  Bluno {}: {} packets, {} checksum errors, {} parse errors, {} bytes dropped, "
+              "{} lost ({:.2%}), {} out of order, {} duplicates".format(
+                  index, decoder.packetsDecoded, decoder.checksumErrors, decoder.parseErrors, decoder.bytesDropped,
+                  stats["lost"], stats["lossRate"], stats["outOfOrder"], stats["duplicates"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded bluno notifications through the ingest path")
+    parser.add_argument("log", help="notification log to replay")
+    parser.add_argument("--speed", default="max", help="1 for real time, N for N times faster, max for no delay")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the log this many times back to back")
+    parser.add_argument("--fragment", type=int, default=0, help="re-split notifications into pieces of at most N bytes")
+    parser.add_argument("--corrupt", type=float, default=0, help="fraction of notifications with a flipped bit")
+    parser.add_argument("--dup-ack", type=float, default=0, help="fraction of notifications followed by a duplicate ACK")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    notifications = readNotifications(args.log)
+    if args.repeat > 1 and notifications:
+        span = notifications[-1][0] - notifications[0][0]
+        notifications = [(arrivalTime + i * span, index, rawData)
+                         for i in range(args.repeat) for arrivalTime, index, rawData in notifications]
+    if args.fragment > 0:
+        notifications = fragment(notifications, args.fragment, rng)
+    notifications = injectFaults(notifications, args.corrupt, args.dup_ack, rng)
+
+    speed = None if args.speed == "max" else float(args.speed)
+    devices, latencies, elapsed = replay(notifications, speed)
+    report(notifications, devices, latencies, elapsed)
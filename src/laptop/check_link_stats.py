@@ -0,0 +1,52 @@
+from Util.link_stats import LinkStats
+
+# Checks the loss estimate for firmware without sequence numbers on arrival patterns
+# that have gone wrong before:
+#   python check_link_stats.py
+
+INTERVAL = 0.02
+
+
+def feed(linkStats, arrivalTimes):
+    for arrivalTime in arrivalTimes:
+        linkStats.update(-1, arrivalTime)
+
+
+def steady(start, count, interval=INTERVAL):
+    return [start + i * interval for i in range(count)]
+
+
+def checkBurstThenSteady():
+    # a notification flush delivers 50 packets with one arrival time
+    linkStats = LinkStats()
+    times = steady(0, 100)
+    times += [times[-1] + INTERVAL] * 50
+    times += steady(times[-1] + INTERVAL, 200)
+    feed(linkStats, times)
+    assert linkStats.lost == 0, linkStats.lost
+    assert abs(linkStats.meanInterval - INTERVAL) < INTERVAL * 0.1, linkStats.meanInterval
+
+
+def checkRateDrop():
+    # the packet rate drops to a quarter, the mean has to follow it
+    linkStats = LinkStats()
+    times = steady(0, 100, INTERVAL / 4)
+    times += steady(times[-1] + INTERVAL, 400)
+    feed(linkStats, times)
+    lostBefore = linkStats.lost
+    feed(linkStats, steady(times[-1] + INTERVAL, 200))
+    assert linkStats.lost == lostBefore, (lostBefore, linkStats.lost)
+    assert abs(linkStats.meanInterval - INTERVAL) < INTERVAL * 0.1, linkStats.meanInterval
+
+
+def checkRealLoss():
+    # 3 packets in a row lost out of every 20, a single lost packet is under GAP_FACTOR
+    linkStats = LinkStats()
+    feed(linkStats, [t for i, t in enumerate(steady(0, 1000)) if i < 20 or i % 20 >= 3])
+    assert linkStats.lost == 49 * 3, linkStats.lost
+
+
+if __name__ == "__main__":
+    for check in (checkBurstThenSteady, checkRateDrop, checkRealLoss):
+        check()
+        print(check.__name__, "ok")
@@ -0,0 +1,109 @@
+import random
+from Util.packet_decoder import PacketDecoder, calculateChecksum, BATCH_THRESHOLD
+
+# Checks that the per packet path and the vectorized backlog path of PacketDecoder decode
+# the same corrupted stream to the same samples and count the same errors:
+#   python check_packet_decoder.py
+
+NOTIFICATION_SIZE = 20
+NUM_PACKETS = 500
+
+
+def makePacket(values, checksumDelta=0):
+    content = ";".join(str(value) for value in values).encode()
+    return content + b":" + str(calculateChecksum(content) + checksumDelta).encode() + b"\n"
+
+
+def makeStream(rng, corruptions):
+    # Packets like fake_bluno sends them, every one of them hit by one of corruptions
+    # with probability 0.1. The corruptions all keep the END_FLAG, a lost END_FLAG makes
+    # the per packet path drop bytes depending on how the stream is split.
+    stream = bytearray()
+    for sequence in range(NUM_PACKETS):
+        values = [rng.randint(-32768, 32767) for _ in range(6)] + [rng.randint(0, 1), rng.randint(0, 1023), sequence]
+        if rng.random() < 0.1:
+            stream += rng.choice(corruptions)(rng, values)
+        else:
+            stream += makePacket(values)
+    return bytes(stream)
+
+
+def flipToNonDigit(rng, values):
+    # a bit flip turning a digit into a letter, the checksum doesn't match any more
+    packet = bytearray(makePacket(values))
+    packet[rng.randrange(packet.index(b":"))] = ord("x")
+    return bytes(packet)
+
+
+def nonDigitWithChecksum(rng, values):
+    packet = str(values[0]).encode() + b"x;" + ";".join(str(value) for value in values[1:]).encode()
+    return packet + b":" + str(calculateChecksum(packet)).encode() + b"\n"
+
+
+def wrongChecksum(rng, values):
+    return makePacket(values, checksumDelta=rng.randint(1, 100))
+
+
+def missingSeparator(rng, values):
+    return makePacket(values).replace(b":", b";")
+
+
+def twoSeparators(rng, values):
+    return makePacket(values).replace(b";", b":", 1)
+
+
+def tooFewFields(rng, values):
+    return makePacket(values[:5])
+
+
+def noSequence(rng, values):
+    return makePacket(values[:8])
+
+
+def strayMinus(rng, values):
+    # tokenizes to a different number of tokens, the backlog has to give up
+    packet = ";".join(str(value) for value in values).encode().replace(b";", b"1-2;", 1)
+    return packet + b":" + str(calculateChecksum(packet)).encode() + b"\n"
+
+
+def decodePerPacket(stream):
+    decoder = PacketDecoder()
+    samples = []
+    for i in range(0, len(stream), NOTIFICATION_SIZE):
+        samples += decoder.feed(stream[i:i + NOTIFICATION_SIZE])
+    return decoder, samples
+
+
+def decodeBacklog(stream):
+    decoder = PacketDecoder()
+    for i in range(0, len(stream), NOTIFICATION_SIZE):
+        decoder.append(stream[i:i + NOTIFICATION_SIZE])
+    assert decoder.pendingPackets >= BATCH_THRESHOLD, decoder.pendingPackets
+    return decoder, decoder.decode()
+
+
+def compare(stream):
+    perPacket, perPacketSamples = decodePerPacket(stream)
+    backlog, backlogSamples = decodeBacklog(stream)
+    assert [tuple(sample) for sample in backlogSamples] == perPacketSamples
+    for counter in ("packetsDecoded", "checksumErrors", "parseErrors", "bytesDropped"):
+        assert getattr(backlog, counter) == getattr(perPacket, counter), \
+            (counter, getattr(backlog, counter), getattr(perPacket, counter))
+    return perPacket
+
+
+def checkCorruptedStream():
+    corruptions = (flipToNonDigit, nonDigitWithChecksum, wrongChecksum, missingSeparator,
+                   twoSeparators, tooFewFields, noSequence)
+    decoder = compare(makeStream(random.Random(1), corruptions))
+    assert decoder.checksumErrors and decoder.parseErrors, (decoder.checksumErrors, decoder.parseErrors)
+
+
+def checkUntokenizableStream():
+    compare(makeStream(random.Random(2), (strayMinus, wrongChecksum, flipToNonDigit)))
+
+
+if __name__ == "__main__":
+    for check in (checkCorruptedStream, checkUntokenizableStream):
+        check()
+        print(check.__name__, "ok")
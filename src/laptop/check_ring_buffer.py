@@ -0,0 +1,60 @@
+from queue import Empty
+from Util.ring_buffer import SampleRingBuffer
+
+# Checks SampleRingBuffer in one process, the producer and consumer take turns:
+#   python check_ring_buffer.py
+
+
+def record(number):
+    return (1, number, 0, 0, 0, 0, 0, 0, 0, float(number))
+
+
+def received(ringBuffer):
+    numbers = []
+    while True:
+        try:
+            numbers.append(ringBuffer.get(block=False)[1])
+        except Empty:
+            return numbers
+
+
+def checkInOrder():
+    ringBuffer = SampleRingBuffer(4)
+    try:
+        for number in range(3):
+            ringBuffer.put(record(number))
+        assert received(ringBuffer) == [0, 1, 2]
+        assert ringBuffer.overruns() == 0
+    finally:
+        ringBuffer.close()
+
+
+def checkFull():
+    # exactly capacity records, none of them overwritten
+    ringBuffer = SampleRingBuffer(4)
+    try:
+        for number in range(4):
+            ringBuffer.put(record(number))
+        assert ringBuffer.qsize() == 4
+        assert received(ringBuffer) == [0, 1, 2, 3]
+        assert ringBuffer.overruns() == 0
+    finally:
+        ringBuffer.close()
+
+
+def checkLapped():
+    # the producer laps the consumer, the oldest records are counted as overruns
+    ringBuffer = SampleRingBuffer(4)
+    try:
+        for number in range(10):
+            ringBuffer.put(record(number))
+        assert received(ringBuffer) == [6, 7, 8, 9]
+        assert ringBuffer.overruns() == 6
+    finally:
+        ringBuffer.close()
+
+
+if __name__ == "__main__":
+    for check in (checkInOrder, checkFull, checkLapped):
+        check()
+        print(check.__name__, "ok")
@@ -0,0 +1,42 @@
+import numpy as np
+
+# Same get_ functions, in the same order, as the ultra96's extraction_functions.py,
+# preprocess.process_data_stream turns them into the feature vector
+
+
+def get_min(data):
+    return np.min(data)
+
+
+def get_max(data):
+    return np.max(data)
+
+
+def get_std(data):
+    return np.std(data)
+
+
+def get_mean(data):
+    return np.mean(data)
+
+
+def get_iqr(data):
+    q75, q25 = np.percentile(data, [75, 25], axis=0)
+    return q75 - q25
+
+
+def get_skewness(data):
+    return data.skew()
+
+
+def get_kurtosis(data):
+    return data.kurtosis()
+
+
+def get_sma(data):
+    x, y, z = [data[col] for col in data.columns]
+    sma = 0
+    for xi, yi, zi in zip(x, y, z):
+        sma += abs(xi) + abs(yi) + abs(zi)
+    return sma
+
@@ -0,0 +1,131 @@
+from collections import deque
+import random
+import time
+from Util.packet_decoder import calculateChecksum
+from Util.link_stats import SEQUENCE_MODULO
+
+# Stand-in for bluepy's Peripheral that behaves like a Bluno running our firmware,
+# used to load test BlunoManager without any hardware:
+#   H -> replies ACK, R -> starts streaming packets, C -> keep alive
+# Packets are split into 20 byte notifications like the real BLE link.
+
+NOTIFICATION_SIZE = 20
+SAMPLE_RATE = 25            # packets per second
+MOVE_PERIOD_SEC = 4         # moveFlag toggles every MOVE_PERIOD_SEC
+NOTIFICATION_HANDLE = 0x25
+
+
+class FakeDisconnectError(Exception):
+    def __init__(self, message="Fake bluno disconnected"):
+        print(message)
+
+
+class FakeCharacteristic():
+
+    def __init__(self, peripheral):
+        self.peripheral = peripheral
+
+    def write(self, data, withResponse=False):
+        self.peripheral.onWrite(data)
+
+
+class FakeService():
+
+    def __init__(self, peripheral):
+        self.peripheral = peripheral
+
+    def getCharacteristics(self):
+        return [FakeCharacteristic(self.peripheral)]
+
+
+class FakePeripheral():
+
+    def __init__(self, deviceAddr, sampleRate=SAMPLE_RATE, connectDelay=0, disconnectRate=0, seed=None,
+                 sendSequence=True, lossRate=0):
+        # disconnectRate is the chance per second of the link dropping while streaming,
+        # sendSequence=False emulates firmware without packet sequence numbers and
+        # lossRate is the fraction of packets lost over the air
+        self.deviceAddr = deviceAddr
+        self.sendSequence = sendSequence
+        self.lossRate = lossRate
+        self.sequence = 0
+        self.sampleRate = sampleRate
+        self.disconnectRate = disconnectRate
+        self.random = random.Random(seed)
+        self.delegate = None
+        self.connected = True
+        self.streaming = False
+        self.nextSampleTime = None
+        self.startTime = time.time()
+        self.lastWaitTime = self.startTime
+        self.notifications = deque()
+        time.sleep(connectDelay)
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def getServiceByUUID(self, uuid):
+        return FakeService(self)
+
+    def onWrite(self, data):
+        if not self.connected:
+            raise FakeDisconnectError()
+        if data == b'H':
+            self.streaming = False
+            self.notifications.append(b'ACK')
+        elif data == b'R':
+            if not self.streaming:
+                self.streaming = True
+                self.nextSampleTime = time.time()
+
+    def makePacket(self, now):
+        moveFlag = int((now - self.startTime) // MOVE_PERIOD_SEC) % 2
+        values = [self.random.randint(-32768, 32767) for _ in range(6)]
+        values += [moveFlag, self.random.randint(0, 1023)]
+        if self.sendSequence:
+            values.append(self.sequence)
+        self.sequence = (self.sequence + 1) % SEQUENCE_MODULO
+        content = ";".join(str(value) for value in values).encode()
+        return content + b":" + str(calculateChecksum(content)).encode() + b"\n"
+
+    def generate(self, now):
+        # Queue the notifications of every packet due by now
+        while self.streaming and self.nextSampleTime <= now:
+            packet = self.makePacket(self.nextSampleTime)
+            self.nextSampleTime += 1 / self.sampleRate
+            if self.random.random() < self.lossRate:
+                continue
+            for i in range(0, len(packet), NOTIFICATION_SIZE):
+                self.notifications.append(packet[i:i + NOTIFICATION_SIZE])
+
+    def waitForNotifications(self, timeout):
+        if not self.connected:
+            raise FakeDisconnectError()
+
+        now = time.time()
+        self.generate(now)
+        if not self.notifications and self.streaming:
+            # sleep until the next packet is due, but no longer than timeout
+            wait = min(timeout, self.nextSampleTime - now)
+            if wait > 0:
+                time.sleep(wait)
+            self.generate(time.time())
+        elif not self.notifications:
+            time.sleep(timeout)
+
+        now = time.time()
+        elapsed = now - self.lastWaitTime
+        self.lastWaitTime = now
+        if self.streaming and self.random.random() < self.disconnectRate * elapsed:
+            self.connected = False
+            raise FakeDisconnectError()
+
+        if not self.notifications:
+            return False
+        self.delegate.handleNotification(NOTIFICATION_HANDLE, self.notifications.popleft())
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        self.streaming = False
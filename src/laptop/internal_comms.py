@@ -1,6 +1,5 @@
 from bluepy.btle import Scanner, DefaultDelegate, Peripheral, BTLEException, BTLEDisconnectError, ADDR_TYPE_RANDOM
 from multiprocessing import Queue, Process
-from collections import deque 
 import threading
 import time
 import datetime
@@ -8,6 +7,11 @@ import logging
 import signal
 import sys
 import multiprocessing
+from Util.sample_processor import SampleProcessor
+from Util.logger import getLogger, RateLimitedLogger
+
+logger = getLogger("internal_comms")
+hotPathLogger = RateLimitedLogger(logger)
 
 SLEEP_SEC = 0.03  # 30ms
 LONG_SLEEP_SEC = 0.04  # for handshaking 40ms
@@ -16,83 +20,35 @@ SHORT_SLEEP_SEC = 0.02  # 5ms
 blunoAddress = ['80:30:dc:e9:08:8b', '80:30:dc:d9:0c:a7', '80:30:dc:d9:23:3d']
 # blunoAddress = ['34:14:b5:51:d6:0c', '34:b1:f7:d2:35:f3', '34:14:b5:51:d6:4e']
 blunoHandshake = [0, 0, 0]
-connections = [None]
-serviceChars = [None]
-
-yAccelDeque = deque([])
-
-def updateYAccelDeque(newYAccel, motion_flag):
-    global yAccelDeque
-
-    if motion_flag == 0:
-        yAccelDeque.appendleft(newYAccel)
-    else:
-        yAccelDeque.appendleft(0)
-    
-    if(len(yAccelDeque)> 100):
-        yAccelDeque.pop()
-    
-    print("current circular buffer size: " + str(len(yAccelDeque)))
-
-def getPosChangeFlag():
-    global yAccelDeque
-    ## iterate over deque to find max
-    maxY = -900000
-    minY = 900000
-    maxYIndex = 0
-    minYIndex = 0
-
-    for i in range(0, len(yAccelDeque)):
-        yAccel = yAccelDeque[i]
-        if yAccel < minY:
-            minY = yAccel
-            minYIndex = i
-        if yAccel > maxY:
-            maxY = yAccel
-            maxYIndex = i
-
-    ## moving right
-    if (minY < -60 and maxY > 80 and minYIndex > maxYIndex):
-        return -1
-
-    ## moving left
-    elif (minY < -60 and maxY > 80 and minYIndex < maxYIndex ):
-        return 1
-
-    ## netural
-    return 0
-    
-    
-def calculateChecksum(str):
-    result = 0
-    for char in str:
-        result ^= ord(char)
-    return result
+connections = [None] * len(blunoAddress)
+serviceChars = [None] * len(blunoAddress)
+# SampleProcessor of each bluno, kept across reconnections so its link stats carry on
+processors = [None] * len(blunoAddress)
 
 class BleConnectionError(Exception):
     # Base class ble connection error
     def __init__(self, message="Ble connection error!"):
-        print(message)
+        logger.error(message)
 
 
 class HandshakeError(Exception):
     def __init__(self, message="Handshake error"):
-        print(message)
+        logger.error(message)
 
 
 class DataProcessingError(Exception):
     def __init__(self, message="Data processing error!"):
-        print(message)
+        logger.error(message)
         
 def printAlert(msg):
-    print("***************************************** {} **************************************".format(msg))
+    hotPathLogger.debug("***************************************** %s **************************************", msg)
 
 def sendH(serviceChar):
     try:
         serviceChar.write(bytes('H', "utf-8"))
         return True
     except:
-        print("Fail sending H packet to bluno")
+        logger.warning("Fail sending H packet to bluno")
         return False
 
 
@@ -101,7 +57,7 @@ def sendR(serviceChar):
         serviceChar.write(bytes('R', "utf-8"))
         return True
     except:
-        print("Fail sending R packet to bluno")
+        logger.warning("Fail sending R packet to bluno")
         return False
 
 
@@ -110,38 +66,42 @@ def sendC(serviceChar):
         serviceChar.write(bytes('C', "utf-8"))
         return True
     except:
-        print("Fail sending C packet to bluno")
+        logger.warning("Fail sending C packet to bluno")
         return False
     
 
 def waitForAllConnections(blunoId):
     global blunoHandshake
-    print("Connection Status: {} ".format(str(blunoHandshake)))
+    logger.info("Connection Status: {} ".format(str(blunoHandshake)))
     if sum(blunoHandshake) != len(blunoAddress) and blunoHandshake[blunoId] == 1:
         time.sleep(LONG_SLEEP_SEC)
 
-def establishConnection(index, buffer_tuple):
-    global connections, serviceChars
+def establishConnection(index, buffer_tuple, linkStats=None):
+    global connections, serviceChars, processors
+    if processors[index] is None:
+        processors[index] = SampleProcessor(index, buffer_tuple, linkStats)
+    else:
+        processors[index].reset()
     addr = blunoAddress[index]
-    print("Connecting to bluno " + str(index) +
+    logger.info("Connecting to bluno " + str(index) +
           " with ip address: " + str(addr))
     connection_attempt_count = 0
     while True:
         try:
             p = Peripheral(addr)
-            p.withDelegate(NotificationDelegate(index, buffer_tuple))
+            p.withDelegate(NotificationDelegate(index, buffer_tuple, processors[index]))
             blunoService = p.getServiceByUUID(
                 "0000dfb0-0000-1000-8000-00805f9b34fb")
             serviceChar = blunoService.getCharacteristics()[0]
             connections[index] = p
             serviceChars[index] = serviceChar
-            print("Connected to " + str(index))
+            logger.info("Connected to " + str(index))
             break
 
         except Exception as e:
-            print(e)
+            logger.warning(e)
             connection_attempt_count += 1
-            print("Established connection with bluno {}, attempt {}...".format(
+            logger.info("Established connection with bluno {}, attempt {}...".format(
                 str(index), str(connection_attempt_count)))
             time.sleep(LONG_SLEEP_SEC)
             continue
@@ -151,7 +111,7 @@ def performHandshake(index):
     global connections, serviceChars
     handshake_count = 0
     while blunoHandshake[index] == 0 and handshake_count <= 5:
-        print("Performing handshake with bluno " + str(index))
+        logger.info("Performing handshake with bluno " + str(index))
         # wait for notification
         try:
             if not sendH(serviceChars[index]):
@@ -163,22 +123,22 @@ def performHandshake(index):
 
             if(connections[index].waitForNotifications(5)):
                 if blunoHandshake[index] == 1:
-                    print("Handshake with bluno " +
+                    logger.info("Handshake with bluno " +
                           str(index) + " is completed\n\n")
                     break
                 else:
-                    print(
+                    logger.info(
                         "I received something else, but blunoHandshake[index] == 0...")
-                    print(blunoHandshake)
+                    logger.info("%s", blunoHandshake)
             else:
-                print("Failed waitForNotification...")
+                logger.info("Failed waitForNotification...")
 
         except Exception as e:
-            print(e)
+            logger.info(e)
             break
 
         handshake_count += 1
-        print("Didn't receive ACK from bluno {}, attempt {}...".format(
+        logger.info("Didn't receive ACK from bluno {}, attempt {}...".format(
             str(index), str(handshake_count)))
         time.sleep(SLEEP_SEC)
 
@@ -186,7 +146,7 @@ def performHandshake(index):
 def reconnect(index, buffer_tuple):
     global blunoHandshake
     global connections
-    print("\n\n#################### Reconnecting to bluno " +
+    logger.info("\n\n#################### Reconnecting to bluno " +
           str(index) + " ###################\n\n")
     reconnection_attempts = 0
     blunoHandshake[index] = 0
@@ -199,181 +159,60 @@ def reconnect(index, buffer_tuple):
             break
 
         except Exception as e:
-            print(e)
+            logger.info(e)
             reconnection_attempts += 1
-            print("Error! Reconnection attempt {} failed. Try again... ----------------------".format(reconnection_attempts))
+            logger.info("Error! Reconnection attempt {} failed. Try again... ----------------------".format(reconnection_attempts))
             time.sleep(SLEEP_SEC)
             continue
 
         reconnection_attempts += 1
-        print("Bluno {} Reconnection attempt {}...".format(
+        logger.info("Bluno {} Reconnection attempt {}...".format(
             str(index), str(reconnection_attempts)))
         time.sleep(SLEEP_SEC)
-    print("\n\n#################### Successfully reconnected to bluno " +
+    logger.info("\n\n#################### Successfully reconnected to bluno " +
           str(index) + " ###################\n\n")
 
 
 class NotificationDelegate(DefaultDelegate):
 
-    def __init__(self, index, buffer_tuple):
+    def __init__(self, index, buffer_tuple, processor=None):
         DefaultDelegate.__init__(self)
         self.index = index
-        self.buffer_str = ""
+        self.processor = processor if processor is not None else SampleProcessor(index, buffer_tuple)
         self.buffer_tuple = buffer_tuple
 
     def handleNotification(self, cHandle, rawData):
         global blunoHandshake
 
-        data = rawData.decode("utf-8")
-        
         printAlert("Handling notification")
-        print('Connection Index:' + str(self.index))
-        print("Receive data from bluno" + str(self.index) + ": " + data)
-        print(blunoHandshake)
-        if data == "ACK":
+        hotPathLogger.debug("Receive data from bluno %d: %s", self.index, rawData)
+        hotPathLogger.debug("Handshake status: %s", blunoHandshake)
+        if rawData == b"ACK":
             if blunoHandshake[self.index] == 0:
-                print("Successfully received ACK from Bluno!")
+                logger.info("Successfully received ACK from Bluno!")
                 sendR(serviceChars[self.index])
                 blunoHandshake[self.index] = 1
             else:
-                print("Duplicate ACK...")
+                hotPathLogger.info("Duplicate ACK...")
                 sendR(serviceChars[self.index])
                 blunoHandshake[self.index] = 1
 
-        elif "ACK" in data:
-            print("Data containing ACK!")
+        elif b"ACK" in rawData:
+            logger.info("Data containing ACK!")
             blunoHandshake[self.index] = 1
             sendR(serviceChars[self.index])
 
         elif blunoHandshake[self.index] == 1:
-            self.handleData(data)
+            self.handleData(rawData)
         else:
             pass
 
-    def handleData(self, data):
-        self.buffer_str += data
-        remaining_str = self.postProcessing(index=self.index, data=self.buffer_str)
-        self.buffer_str = remaining_str
-        
-    
-    def postProcessing(self, index, data):
-        MAX_DATA_LENGTH = 70
-        END_FLAG = "\n"
-        DELIMITER = ";"
-        CHECKSUM_DELIMITER = ":"
-
-        buffer = ""
-        if len(data) < 1:
-            return ""
-
-        # check last char
-        if(data[-1] != END_FLAG):
-            # Incompleted data, buffer it
-            if (len(data) < MAX_DATA_LENGTH):
-                return data
-
-        # process data
-        time_recv = time.time()
-        # dt = datetime.datetime.now()
-        # dt = dt.strftime("%m/%d/%Y, %H:%M:%S")
-        packets = data.split(END_FLAG)
-
-        # no delimiter is found in split(), drop the whole buffer
-        if len(packets) == 1:
-            print("No END_FLAG exists for a long enough data stream, drop all buffer")
-            return ""
-
-        # if last packet is incompleted, buffer it
-        if packets[-1] != "":
-            # buffer incomplete packet
-            buffer = packets[-1]
-
-        # remove last token from processing, since it is either buffered or empty
-        packets.pop()
-
-        for i in range(len(packets)):
-            packet = packets[i]
-
-            print("Packet {}: {}".format(i, packet))
-
-            # last token or empty packet(very unlikely but possible if \n\n)
-            if packet == "":
-                continue
-
-            try:
-                tokens = packet.split(CHECKSUM_DELIMITER)
-
-                checksum_received = int(tokens[1])
-                checksum_computed = calculateChecksum(tokens[0])
-
-                if checksum_received != checksum_computed:
-                    raise DataProcessingError(
-                        "Packet corrupted! Checksum doesn't match!\n\
-                         Checksum received: {}\n\
-                         Checksum computed: {}\n"
-                        .format(checksum_received, checksum_computed))
-
-                print("Check sum passed!")
-
-                content_tokens = tokens[0].split(DELIMITER)
-
-#                 if len(content_tokens) != 9:
-#                     raise DataProcessingError(
-#                         "Packet corrupted! There are {} tokens (excluding checksum)".format(len(content_tokens)))
-
-                gyro_data_arr = [
-                    int(content_tokens[0]),
-                    int(content_tokens[1]),
-                    int(content_tokens[2])
-                ]
-
-                accel_data_arr = [
-                    int(content_tokens[3]),
-                    int(content_tokens[4]),
-                    int(content_tokens[5])
-                ]
-                
-                motion_flag = int(content_tokens[6])
-                emg = int(content_tokens[7])
-                
-                pos_change_flag = 0
-                ## push accelY or 0 to circular buffer
-                updateYAccelDeque(accel_data_arr[1], motion_flag)
-
-                ## get pos change if in neutral
-                if motion_flag == 0:
-                    print("no motion!")
-                    pos_change_flag = getPosChangeFlag()
-                    
-                    if pos_change_flag != 0:
-                        print("position change detected!!!")
-                        yAccelDeque.clear() ## clear Deque
-
-            except Exception as e:
-                print("Data corrupted! Parsing error: \n" + str(e))
-                continue
-
-            packet = {
-                "Id": index,
-                "GyroX": gyro_data_arr[0],
-                "GyroY": gyro_data_arr[1],
-                "GyroZ": gyro_data_arr[2],
-                "AccelX": accel_data_arr[0],
-                "AccelY": accel_data_arr[1],
-                "AccelZ": accel_data_arr[2],
-                "MoveFlag": motion_flag,
-                "PosChangeFlag": pos_change_flag,
-                "Time": time_recv
-            }
-            print("Emg: " + str(emg))
-            print(packet)
-            self.buffer_tuple.put(packet)
-
-        return buffer
-
-def connect_to_pi(_name, buffer_tuple, index):
+    def handleData(self, rawData):
+        self.processor.handleData(rawData)
+
+def connect_to_pi(_name, buffer_tuple, index, linkStats=None):
     global connections
-    establishConnection(index, buffer_tuple)
+    establishConnection(index, buffer_tuple, linkStats)
     performHandshake(index)
 
     # wait for incoming packet
@@ -382,16 +221,15 @@ def connect_to_pi(_name, buffer_tuple, index):
     while True:
         try:
             if(connections[index].waitForNotifications(1)):
-                print("bluno {0} start time updated to {1}".format(
-                    index, start_t))
+                hotPathLogger.debug("bluno %d start time updated to %f", index, start_t)
                 start_t = time.time()
                 curr_t = time.time()
                 if curr_t - start_t >= 3:
-                    print("bluno {} packet delay more than 3 seconds, performing reconnection...".format(
+                    logger.info("bluno {} packet delay more than 3 seconds, performing reconnection...".format(
                         index))
                     reconnect(index, buffer_tuple)
                 if curr_t - last_c_packet_t >= 5:
-                    print("Sending packet C to bluno {} at {}, last packet sent at {}, interval is {} seconds"
+                    logger.info("Sending packet C to bluno {} at {}, last packet sent at {}, interval is {} seconds"
                             .format(str(index),
                                     str(int(curr_t)),
                                     str(int(last_c_packet_t)),
@@ -404,6 +242,6 @@ def connect_to_pi(_name, buffer_tuple, index):
                             "Failed sending C packet, there is a connection error.")
 
         except Exception as e:
-            print("Expection: " + str(e))
+            logger.warning("Expection: " + str(e))
             reconnect(index, buffer_tuple)
             start_t = time.time()
\ No newline at end of file
@@ -11,155 +11,413 @@ import json
 import random
 import socket
 import queue
-from Util.encryption import EncryptionHandler
+import threading
+from Util.encryption import EncryptionHandler, SESSION_NONCE_BYTES
+from Util.ring_buffer import ID, RECORD_KEYS
+from Util.move_segmenter import MoveSegmenter
+from Util.batch_sender import BatchSender
+from Util.framing import FrameReader, Frame, HEADER, TYPE_MESSAGE, TYPE_SEGMENT, encryptFrame, decryptFrame
+from Util.sample_codec import CODEC_RAW, encodeSamples
+from Util.clock_sync import ClockSync
+from Util.clock_channel import CLOCK_PORT_OFFSET, PACKET, SYNC, REPLY, REQUEST, RESULT, packPacket, recvPacket, setNoDelay
+from Util.spool import Spool
+from Util.outbound_queue import OutboundQueue, DROP_IDLE_FIRST, MAX_QUEUED_MESSAGES, IDLE, MOVE
+from Util.logger import getLogger, RateLimitedLogger
 import sshtunnel
 
+try:
+    # Same feature pipeline as the ultra96, pandas is only needed with edgeFeatures
+    import preprocess
+except ImportError:
+    preprocess = None
+
+logger = getLogger("laptopClient")
+hotPathLogger = RateLimitedLogger(logger)
+
 SHUTDOWNCOMMAND = {'command' : 'shutdown'}
+# Interval between two linkstats reports to the server
+LINK_STATS_INTERVAL_SEC = 5
+# Longest handleBlunoData waits for a sample while no batch is pending
+IDLE_TIMEOUT_SEC = 0.5
+# Backoff between reconnect attempts after losing the server
+RECONNECT_DELAY_SEC = 0.5
+MAX_RECONNECT_DELAY_SEC = 5
+
+
+def linkStatsMessage(inputQueue, linkStats):
+    # linkStats is the SharedLinkStats the bluno process publishes to, if any
+    stats = {"devices": linkStats.snapshots() if linkStats is not None else []}
+    if hasattr(inputQueue, "overruns"):
+        stats["overruns"] = inputQueue.overruns()
+    return {"command" : "linkstats", "message" : stats}
+
+
+def segmentMessage(records, edgeFeatures):
+    # The raw move segment, or only its features with edgeFeatures
+    segment = {"columns" : RECORD_KEYS, "samples" : records}
+    if edgeFeatures:
+        features = preprocess.process_data_stream(preprocess.segment_to_dataframe(segment))
+        return {"command" : "features", "message" : {"features" : features.tolist(), "length" : len(records)}}
+    return {"command" : "segment", "message" : segment}
+
+
+def offsetMessage(clockSync, timeSend, reply, timeRecv):
+    # Adds the exchange to clockSync and returns the offset message for the server,
+    # with the four timestamps so the server can run its own ClockSync on them
+    timestamps = json.loads(reply)['message'].split('|')
+    t = [timeSend, float(timestamps[0]), float(timestamps[1]), timeRecv]
+    logger.debug("t1: %s t2: %s t3: %s t4: %s", *t)
+    sample = clockSync.addSample(*t)
+    clockOffset = clockSync.offset(timeRecv)
+    logger.info("Clock offset: %s (this sync %s, RTT %s, error %.2f ms)",
+                clockOffset, sample.offset, sample.rtt, clockSync.error(timeRecv) * 1000)
+    return {"command" : "offset", "message" : str(clockOffset), "timestamps" : t}
+
+
+def openTunnels():
+    # Tunnels localhost:10022 and the clock channel port after it through sunfire to the ultra96 server
+    REMOTE_SERVER_IP = 'sunfire.comp.nus.edu.sg'
+    PRIVATE_SERVER_IP = '137.132.86.228'
+
+    username = input("Enter ssh username: ")
+    password =  getpass.getpass("Enter ssh password: ")
+    tunnel1 = sshtunnel.open_tunnel(
+        (REMOTE_SERVER_IP, 22), 
+        remote_bind_address=(PRIVATE_SERVER_IP, 22),
+        ssh_username=username,
+        ssh_password=password,
+        # local_bind_address=('127.0.0.1', 8081),
+        block_on_close=False
+    )
+    tunnel1.start()
+    logger.info('[Tunnel Opened] Tunnel into Sunfire opened ' +
+        str(tunnel1.local_bind_port))
+    tunnel2 = sshtunnel.open_tunnel(
+        ssh_address_or_host=(
+            'localhost', tunnel1.local_bind_port),  # ssh into xilinx
+        remote_bind_addresses=[('127.0.0.1', 10022), ('127.0.0.1', 10022 + CLOCK_PORT_OFFSET)],  # binds xilinx host
+        ssh_username='xilinx',
+        ssh_password='xilinx',
+        local_bind_addresses=[('127.0.0.1', 10022), ('127.0.0.1', 10022 + CLOCK_PORT_OFFSET)],  # localhost to bind them to
+        block_on_close=False
+    )
+    tunnel2.start()
+
+
 class LaptopClient():
-    def __init__(self, host, port, dancerID):
-        self.moveStarted = Event()
+    def __init__(self, host, port, dancerID, edgeFeatures=False, legacyFraming=False,
+                 sendPolicy=DROP_IDLE_FIRST, maxQueuedMessages=MAX_QUEUED_MESSAGES, sampleCodec=CODEC_RAW,
+                 sessionMode=False):
+        # Data messages wait in a bounded OutboundQueue for the socket, sendPolicy
+        # (block, drop-oldest or drop-idle-first) says what happens when it's full
+        self.sendPolicy = sendPolicy
+        self.maxQueuedMessages = maxQueuedMessages
+        # legacyFraming talks the old ',' terminated base64 format, for servers without Util/framing.py
+        self.legacyFraming = legacyFraming
+        # sessionMode agrees on a key for this connection at identification and encrypts
+        # with AES-GCM under it instead of AES-CBC under the shared key
+        if sessionMode and legacyFraming:
+            raise ValueError("sessionMode needs the binary framing")
+        self.sessionMode = sessionMode
+        self.session = None
+        # With edgeFeatures set, features are extracted from every move segment here
+        # and only the feature vector is sent instead of the raw samples
+        if edgeFeatures and preprocess is None:
+            raise ImportError("edgeFeatures needs pandas for preprocess")
+        self.edgeFeatures = edgeFeatures
+        # Codec of binary move segments, delta or delta-zlib trade laptop CPU for a slower link
+        self.sampleCodec = sampleCodec
         self.evalStarted = Event()
+        # Set on "quit", whichever process handles the server commands then. Nothing
+        # reconnects after it and handleBlunoData returns.
+        self.shutDown = Event()
         self.socketLock = Lock()
         self.host = host
         self.port = port
         self.encryptionHandler = EncryptionHandler(b'Sixteen byte key')
         self.dancerID = dancerID
+        self.clockSync = ClockSync()
+        # Dedicated clock sync connection, None when the server has none
+        self.clockSocket = None
+        # Frames sendOutbound couldn't send while reconnect() brings the connection back.
+        # connected and transportLock only matter in the handleBlunoData process.
+        self.spool = Spool()
+        self.connected = threading.Event()
+        self.connected.set()
+        self.transportLock = threading.Lock()
+
+    def encryptMessage(self, message, frameType=TYPE_MESSAGE):
+        hotPathLogger.debug("SENDING: %s", message)
+        if self.legacyFraming:
+            return self.encryptionHandler.encrypt_msg(message) + b',' #Send b64encoded bytes with ',' delimiter as ',' is not valid b64encoded char
+        return encryptFrame(message, self.encryptionHandler, frameType, self.session)
+
+    def writeFrame(self, frame):
+        # handleBlunoData and handleServerCommands share the socket, don't let their messages interleave
+        with self.socketLock:
+            self.mySocket.sendall(frame)
 
-    def sendMessage(self, message):
-        print("SENDING: ", message)
-        encrypted_message = self.encryptionHandler.encrypt_msg(message) + b',' #Send b64encoded bytes with ',' delimiter as ',' is not valid b64encoded char
-        self.mySocket.send(encrypted_message)
+    def sendMessage(self, message, frameType=TYPE_MESSAGE):
+        # Sent right away, for clock sync and other control messages
+        self.writeFrame(self.encryptMessage(message, frameType))
 
-    def handleBlunoData(self, inputQueue):
+    def queueMessage(self, message, frameType=TYPE_MESSAGE, priority=MOVE, samples=0):
+        # Data messages go through the outbound queue, sendOutbound writes them to the socket
+        self.outbound.put(self.encryptMessage(message, frameType), priority, samples)
+
+    def sendOutbound(self):
+        # A lost connection doesn't lose data: frames are spooled until reconnect() is done
         try:
-            packet = None
-            while True:
-                packet = None 
-                packet = inputQueue.get()
-                if packet is not None:
-                    if not self.evalStarted.is_set():
-                        # print("Eval not yet started, ignoring data")
-                        # print(packet)
-                        continue
-                    if packet['moveFlag'] == 1:
-                        if not self.moveStarted.is_set():
-                            # if move hasn't started, set flag and send timestamp
-                            self.moveStarted.set()
-                            self.sendMessage(json.dumps({"command" : "timestamp", "message" : packet['time']}))
-                        packet['command'] = 'data'
-                        self.sendMessage(json.dumps(packet))
-                        # print(packet)
-                    else:
-#                        if self.moveStarted.is_set():
-#                            stopMoveMessage = {"command": "moveComplete"}
-#                            self.sendMessage(stopMoveMessage)     
-                        self.moveStarted.clear()
-                else:
-                    print("No packet found...")
-                time.sleep(0.04)
+            while not self.shutDown.is_set():
+                priority, frame = self.outbound.getEntry()
+                with self.transportLock:
+                    if self.shutDown.is_set():
+                        return
+                    if self.connected.is_set():
+                        try:
+                            self.writeFrame(frame)
+                            continue
+                        except OSError as e:
+                            if self.shutDown.is_set():
+                                # the socket was closed on "quit"
+                                return
+                            logger.warning("Connection lost: %s, spooling until reconnected", e)
+                            self.connected.clear()
+                            threading.Thread(target=self.reconnect, daemon=True).start()
+                    self.spool.append(frame, priority)
+        except Exception as e:
+            logger.error("SENDOUTBOUND: %s", e)
+
+    def reconnect(self):
+        # Connects and identifies again, replays what is still relevant from the spool and
+        # takes over handling server commands, the process that did it had the old socket
+        lostTime = time.time()
+        delay = RECONNECT_DELAY_SEC
+        while True:
+            if self.shutDown.is_set():
+                logger.info("Not reconnecting, shutting down")
+                return
+            self.mySocket.close()
+            if self.clockSocket is not None:
+                self.clockSocket.close()
+                self.clockSocket = None
+            try:
+                self.connectAndIdentify(self.host, self.port, self.dancerID)
+                with self.transportLock:
+                    frames = self.spool.replay()
+                    while frames:
+                        try:
+                            self.writeFrame(frames[0])
+                        except OSError:
+                            # lost again, the rest waits for the next attempt
+                            for frame in frames:
+                                self.spool.append(frame, MOVE)
+                            raise
+                        frames.pop(0)
+                    self.connected.set()
+                break
+            except OSError as e:
+                logger.warning("Reconnecting to %s failed: %s, retrying in %.1f s", (self.host, self.port), e, delay)
+                self.shutDown.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY_SEC)
+        report = self.spool.report()
+        logger.info("Reconnected after %.1f s: %d frames spooled, %d replayed, %d discarded so far",
+                    time.time() - lostTime, report['spooled'], report['replayed'], report['discarded'])
+        threading.Thread(target=self.handleServerCommands, daemon=True).start()
+
+    def sendLinkStats(self, inputQueue, linkStats):
+        message = linkStatsMessage(inputQueue, linkStats)
+        message["message"]["outbound"] = self.outbound.report()
+        message["message"]["spool"] = self.spool.report()
+        outbound = message["message"]["outbound"]
+        if outbound["shedPerSec"] > 0:
+            logger.warning("Outbound queue shedding %.1f samples/sec in %.1f messages/sec",
+                           outbound["shedSamplesPerSec"], outbound["shedPerSec"])
+        self.queueMessage(json.dumps(message), priority=IDLE)
+
+    def sendSegment(self, moveStartTime, records):
+        if not self.edgeFeatures and not self.legacyFraming:
+            # One binary frame, the server takes the move start time from its first moving sample.
+            # Pending messages go first so the server sees everything in order.
+            self.batchSender.flush()
+            self.queueMessage(encodeSamples(records, self.sampleCodec), TYPE_SEGMENT, samples=len(records))
+            return
+        # The timestamp is the first sample of the move itself, the pre-roll comes before it
+        self.batchSender.add({"command" : "timestamp", "message" : moveStartTime})
+        self.batchSender.add(segmentMessage(records, self.edgeFeatures), len(records))
+
+    def handleBlunoData(self, inputQueue, linkStats=None):
+        try:
+            record = None
+            # One MoveSegmenter per bluno, keyed by bluno index
+            segmenters = {}
+            # Data messages are batched, each batch is encrypted once and queued for sendOutbound
+            self.outbound = OutboundQueue(self.maxQueuedMessages, self.sendPolicy)
+            self.batchSender = BatchSender(lambda message, samples: self.queueMessage(message, samples=samples))
+            threading.Thread(target=self.sendOutbound, daemon=True).start()
+            lastLinkStatsTime = time.time()
+            while not self.shutDown.is_set():
+                if time.time() - lastLinkStatsTime >= LINK_STATS_INTERVAL_SEC:
+                    lastLinkStatsTime = time.time()
+                    self.sendLinkStats(inputQueue, linkStats)
+                # Block until the next sample, but wake up in time to send a pending batch
+                timeout = self.batchSender.timeout()
+                try:
+                    record = inputQueue.get(timeout=IDLE_TIMEOUT_SEC if timeout is None else timeout)
+                except queue.Empty:
+                    record = None
+                # Data is ignored until the eval has started
+                if record is not None and self.evalStarted.is_set():
+                    segmenter = segmenters.get(record[ID])
+                    if segmenter is None:
+                        segmenter = segmenters[record[ID]] = MoveSegmenter()
+                    segment = segmenter.update(record)
+                    if segment is not None:
+                        self.sendSegment(*segment)
+                self.batchSender.flushIfDue()
         except Exception as e:
-            print("HANDLEBLUNO:", e)
+            logger.error("HANDLEBLUNO: %s", e)
             sys.exit()
             
 
     def startClockSync(self):
         self.timeSend = time.time()
         messagedict = {"command" : "clocksync", "message" : str(self.timeSend)}
-        print("SENDING", messagedict)
+        logger.debug("SENDING %s", messagedict)
         self.sendMessage(json.dumps(messagedict))
 
     def respondClockSync(self, timestamps, timeRecv):
-        timestamps = json.loads(timestamps)['message'].split('|')
-        print(f"t1:", {self.timeSend}, "t2:", \
-            {timestamps[0]}, "t3:", {timestamps[1]}, "t4:", {timeRecv})
-        t = [self.timeSend, float(timestamps[0]), float(timestamps[1]), timeRecv]
-        
-        roundTripTime = (t[3] - t[0]) - (t[2] - t[1])
-        print("RTT:", {roundTripTime})
-        
-        clockOffset = ((t[2]-t[3]-roundTripTime/2) + (t[1] - t[0] - roundTripTime/2))/2
-        messagedict = {"command" : "offset", "message" : str(clockOffset)}
-        self.sendMessage(json.dumps(messagedict))
-        print("Clock offset:", {clockOffset})
-        print("\n")
+        self.sendMessage(json.dumps(offsetMessage(self.clockSync, self.timeSend, timestamps, timeRecv)))
         
+    def recvCommands(self, reader):
+        # Blocks until at least one command arrives, returns the commands and their receive time
+        while True:
+            data = self.mySocket.recv(4096)
+            timeRecv = time.time()
+            if not data:
+                raise ConnectionError("connection closed by server")
+            if self.legacyFraming:
+                # the old server sends one bare base64 message per send
+                return [self.encryptionHandler.decrypt_message(data)], timeRecv
+            frames = reader.feed(data)
+            if frames:
+                return [decryptFrame(frame, self.encryptionHandler, self.session) for frame in frames], timeRecv
+
+    def handleClockChannel(self):
+        # Answers the server's sync rounds on the clock channel, t1 and t4 are taken
+        # right at the send and recv
+        buffer = bytearray(PACKET.size)
+        try:
+            while True:
+                (packetType, number, t1, t2, t3, _), timeRecv = recvPacket(self.clockSocket, buffer)
+                if packetType == SYNC:
+                    timeSend = time.time()
+                    self.clockSocket.sendall(packPacket(REQUEST, number, timeSend))
+                elif packetType == REPLY:
+                    self.clockSocket.sendall(packPacket(RESULT, number, t1, t2, t3, timeRecv))
+                    sample = self.clockSync.addSample(t1, t2, t3, timeRecv)
+                    logger.info("Clock offset: %s (this sync %s, RTT %s, error %.2f ms)", self.clockSync.offset(timeRecv),
+                                sample.offset, sample.rtt, self.clockSync.error(timeRecv) * 1000)
+        except (ConnectionError, OSError) as e:
+            # the server falls back to clock sync over the data socket
+            logger.warning("Clock channel lost: %s", e)
+
     def handleServerCommands(self): 
-        command = self.mySocket.recv(4096)
-        timeRecv = time.time()
-        command = self.encryptionHandler.decrypt_message(command)
-        print("COMMAND RECEIVED:", command)
+        if self.clockSocket is not None:
+            threading.Thread(target=self.handleClockChannel, daemon=True).start()
+        reader = FrameReader()
+        command = None
         while command != "quit":
-            if command == "sync":
-                self.startClockSync()
-            elif command == "start":
-                self.evalStarted.set() 
-            elif "clocksync" in command:
-                self.respondClockSync(command,timeRecv)
-
-            command = self.mySocket.recv(4096)
-            timeRecv = time.time()
-            command = self.encryptionHandler.decrypt_message(command)
-            print("COMMAND RECEIVED:", command)
-        print("Shutting down dancer number " + self.dancerID)
+            try:
+                commands, timeRecv = self.recvCommands(reader)
+            except OSError as e:
+                # sendOutbound notices too, reconnects and starts handling commands again
+                logger.warning("Lost the server connection: %s", e)
+                return
+            for command in commands:
+                logger.info("COMMAND RECEIVED: %s", command)
+                if command == "quit":
+                    break
+                elif command == "sync":
+                    self.startClockSync()
+                elif command == "start":
+                    self.evalStarted.set() 
+                elif "clocksync" in command:
+                    self.respondClockSync(command,timeRecv)
+        self.shutDown.set()
+        logger.info("Shutting down dancer number " + self.dancerID)
         self.sendMessage(json.dumps(SHUTDOWNCOMMAND))
         self.mySocket.close()
-        print("Quitting now")
-        sys.exit()
+        logger.info("Quitting now")
 
     def connectAndIdentify(self, host, port, dancerID):
         self.mySocket = socket.socket()
         self.mySocket.connect((host,port))
-        print(dancerID, ": Connection established with ", (host,port))
-        self.sendMessage(dancerID)
+        logger.info("%s: Connection established with %s", dancerID, (host,port))
+        if self.sessionMode:
+            self.startSession(dancerID)
+        else:
+            self.sendMessage(dancerID)
+        if not self.legacyFraming:
+            self.connectClockChannel(host, port, dancerID)
+
+    def startSession(self, dancerID):
+        # Identifies with a nonce and derives the session key from it and the server's reply.
+        # After a reconnect the current session is resumed, spooled frames are encrypted with it.
+        clientNonce = self.session.clientNonce if self.session is not None else get_random_bytes(SESSION_NONCE_BYTES)
+        hello = {"command" : "identify", "dancer" : dancerID, "nonce" : clientNonce.hex()}
+        self.writeFrame(encryptFrame(json.dumps(hello), self.encryptionHandler))
+        # Read exactly the reply, whatever follows it is for handleServerCommands
+        frameType, flags, length = HEADER.unpack(self.recvExactly(HEADER.size))[1:]
+        reply = json.loads(decryptFrame(Frame(frameType, flags, self.recvExactly(length)), self.encryptionHandler))
+        serverNonce = bytes.fromhex(reply['nonce'])
+        if self.session is None or self.session.serverNonce != serverNonce:
+            self.session = self.encryptionHandler.newSession(clientNonce, serverNonce, dancerID, False)
+        logger.info("%s: Session established", dancerID)
+
+    def recvExactly(self, count):
+        data = bytearray()
+        while len(data) < count:
+            chunk = self.mySocket.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed by server")
+            data += chunk
+        return bytes(data)
+
+    def connectClockChannel(self, host, port, dancerID):
+        # Clock sync goes over the data socket if the server has no clock channel
+        try:
+            clockSocket = socket.create_connection((host, port + CLOCK_PORT_OFFSET))
+            setNoDelay(clockSocket)
+            clockSocket.sendall(encryptFrame(dancerID, self.encryptionHandler))
+        except OSError as e:
+            logger.warning("No clock channel: %s", e)
+            return
+        self.clockSocket = clockSocket
+        logger.info("%s: Clock channel established", dancerID)
 
     def start(self, remote = False):
         if remote:
-            REMOTE_SERVER_IP = 'sunfire.comp.nus.edu.sg'
-            PRIVATE_SERVER_IP = '137.132.86.228'
-
-            username = input("Enter ssh username: ")
-            password =  getpass.getpass("Enter ssh password: ")
-            key = 'Sixteen byte key' #remember to hide
-            tunnel1 = sshtunnel.open_tunnel(
-                (REMOTE_SERVER_IP, 22), 
-                remote_bind_address=(PRIVATE_SERVER_IP, 22),
-                ssh_username=username,
-                ssh_password=password,
-                # local_bind_address=('127.0.0.1', 8081),
-                block_on_close=False
-            )
-            tunnel1.start()
-            print('[Tunnel Opened] Tunnel into Sunfire opened ' +
-                str(tunnel1.local_bind_port))
-            tunnel2 = sshtunnel.open_tunnel(
-                ssh_address_or_host=(
-                    'localhost', tunnel1.local_bind_port),  # ssh into xilinx
-                remote_bind_address=('127.0.0.1', 10022),  # binds xilinx host
-                ssh_username='xilinx',
-                ssh_password='xilinx',
-                local_bind_address=('127.0.0.1', 10022),  # localhost to bind it to
-                block_on_close=False
-            )
-            tunnel2.start()
-            self.connectAndIdentify('127.0.0.1', 10022, self.dancerID)
-        else:
-            self.connectAndIdentify('127.0.0.1', 10022, self.dancerID)
+            openTunnels()
+        self.connectAndIdentify(self.host, self.port, self.dancerID)
 
 if __name__ == "__main__":
     client = LaptopClient("127.0.0.1", 10022)
     client.start()
     inputQueue = queue.Queue()
     for _ in range(50):
-        dummy_packet = None
-        dummy_packet = {
-                    "GyroX": random.randint(-40000, 40000),
-                    "GyroY": random.randint(-40000, 40000),
-                    "GyroZ": random.randint(-40000, 40000),
-                    "AccelX": random.randint(-40000, 40000),
-                    "AccelY": random.randint(-40000, 40000),
-                    "AccelZ": random.randint(-40000, 40000),
-                    "StartFlag": 1
-                }
+        dummy_record = (
+                    1,
+                    random.randint(-40000, 40000),
+                    random.randint(-40000, 40000),
+                    random.randint(-40000, 40000),
+                    random.randint(-40000, 40000),
+                    random.randint(-40000, 40000),
+                    random.randint(-40000, 40000),
+                    1,
+                    0,
+                    time.time()
+                )
         
-        inputQueue.put(dummy_packet)
+        inputQueue.put(dummy_record)
     client.handleBlunoData(inputQueue)
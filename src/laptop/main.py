@@ -1,6 +1,11 @@
-from multiprocessing import Pool, Queue, Process, pool
+from multiprocessing import Pool, Process, pool
 from laptopClient import LaptopClient
+from Util.ring_buffer import SampleRingBuffer
+from Util.link_stats import SharedLinkStats
+from Util.outbound_queue import DROP_IDLE_FIRST
+from Util.sample_codec import CODECS
 # import internal_comms
+# import ble_manager
 import random
 import time
 import datetime
@@ -9,52 +14,68 @@ import sys
 def blunoDummy(inputQueue):
     while True:
         for _ in range(60):
-            dummy_packet = None
-            dummy_packet = {
-                        "Id": 1,
-                        "GyroX": random.randint(-40000, 40000),
-                        "GyroY": random.randint(-40000, 40000),
-                        "GyroZ": random.randint(-40000, 40000),
-                        "AccelX": random.randint(-40000, 40000),
-                        "AccelY": random.randint(-40000, 40000),
-                        "AccelZ": random.randint(-40000, 40000),
-                        "time": time.time(),
-                        "moveFlag": 0
-                    }
-            inputQueue.put(dummy_packet)
+            dummy_record = (
+                1,
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                0,
+                0,
+                time.time()
+            )
+            inputQueue.put(dummy_record)
             time.sleep(0.04)
 
         for _ in range(60):
-            dummy_packet = None
-            dummy_packet = {
-                        "Id": 1,
-                        "GyroX": random.randint(-40000, 40000),
-                        "GyroY": random.randint(-40000, 40000),
-                        "GyroZ": random.randint(-40000, 40000),
-                        "AccelX": random.randint(-40000, 40000),
-                        "AccelY": random.randint(-40000, 40000),
-                        "AccelZ": random.randint(-40000, 40000),
-                        "time": time.time(),
-                        "moveFlag": 1
-                    }
-            inputQueue.put(dummy_packet)
+            dummy_record = (
+                1,
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                random.randint(-40000, 40000),
+                1,
+                0,
+                time.time()
+            )
+            inputQueue.put(dummy_record)
             time.sleep(0.05)
 
 
 if __name__ == "__main__":
+    # python main.py <dancerID> [remote] [edge] [policy=block|drop-oldest|drop-idle-first] [codec=raw|delta|delta-zlib] [port=10022] [session]
     dancerID = sys.argv[1].strip()
-    client = LaptopClient("127.0.0.1", 10022, dancerID)
+    options = [arg.strip() for arg in sys.argv[2:]]
+    # edge: extract features on the laptop and send only the feature vectors
+    # policy: what the outbound queue does when the link can't keep up
+    sendPolicy = next((option.split("=", 1)[1] for option in options if option.startswith("policy=")), DROP_IDLE_FIRST)
+    # codec: encoding of move segments, see bench_sample_codec.py for what each costs and saves
+    codec = next((option.split("=", 1)[1] for option in options if option.startswith("codec=")), "raw")
+    # session: AES-GCM under a key agreed for this connection instead of AES-CBC under the shared key
+    # port: 10032 to go through a local aggregator.py instead of straight to the ultra96
+    port = int(next((option.split("=", 1)[1] for option in options if option.startswith("port=")), 10022))
+    client = LaptopClient("127.0.0.1", port, dancerID, edgeFeatures="edge" in options, sendPolicy=sendPolicy,
+                          sampleCodec=CODECS[codec], sessionMode="session" in options)
     remote = False
-    if len(sys.argv) > 2 and sys.argv[2].strip() == "remote":
+    if "remote" in options:
         client.start(remote=True)
     else:
         client.start()
 
-    inputQueue = Queue()
+    # Samples are passed from the bluno process to handleBlunoData through shared memory
+    inputQueue = SampleRingBuffer()
+    # Loss and jitter of every bluno link, published by the bluno process and reported to the server
+    linkStats = SharedLinkStats(3)
             
-    # blunoProcess = Process(target=internal_comms.connect_to_pi, args=("p1", inputQueue, 0))
+    # blunoProcess = Process(target=internal_comms.connect_to_pi, args=("p1", inputQueue, 0, linkStats))
+    # all blunos from one process, keeps the ring buffer single producer
+    # blunoProcess = Process(target=ble_manager.connect_to_blunos, args=("p1", inputQueue, None, None, linkStats))
     blunoProcess = Process(target=blunoDummy, args=(inputQueue,))    
-    handleBlunoDataProcess = Process(target=client.handleBlunoData, args=(inputQueue,))
+    handleBlunoDataProcess = Process(target=client.handleBlunoData, args=(inputQueue, linkStats))
     handleServerProcess = Process(target=client.handleServerCommands)
     try:
         blunoProcess.start()
@@ -69,4 +90,7 @@ if __name__ == "__main__":
         blunoProcess.terminate()
         handleServerProcess.terminate()
         handleBlunoDataProcess.terminate()
+    finally:
+        print("Samples overwritten before being sent: ", inputQueue.overruns())
+        inputQueue.close()
     # client.handleBlunoData(inputQueue)
@@ -0,0 +1,51 @@
+import pandas as pd
+import extraction_functions
+import numpy as np
+
+# The streaming part of the ultra96's preprocess.py, used to extract features on
+# the laptop with edgeFeatures. Keep extract_segment in step with the ultra96.
+
+# Raw sample columns that are not features
+NON_FEATURE_COLUMNS = ["Id", "moveFlag", "time"]
+
+
+# Get the gradient for the raw data
+def gradient_of(data):
+    return pd.DataFrame(np.gradient(data, axis=1))
+
+
+def extract_segment(segment, functions):
+    row = np.empty(0)
+    acc = segment.iloc[:, 0:3]
+    gyro = segment.iloc[:, 3:6]
+
+    # Getting all the data and extracting row by row
+    for data in [acc,
+                 gyro,
+                 gradient_of(acc),
+                 gradient_of(gyro),
+                 ]:
+        for fn in functions:
+            # calling each function from the pointer
+            f = getattr(extraction_functions, fn)
+
+            # extract features by row
+            row = np.append(row, np.asarray(f(data)))
+
+    extracted_segment = row
+
+    return extracted_segment
+
+
+def process_data_stream(data_stream):
+    # get extraction functions
+    functions = [f for f in extraction_functions.__dict__ if
+                 callable(getattr(extraction_functions, f)) and f.startswith("get_")]
+    # extract
+    return extract_segment(data_stream, functions)
+
+
+def segment_to_dataframe(segment):
+    # segment is a move window from the laptop: {"columns": [...], "samples": [[...], ...]}
+    df = pd.DataFrame(segment["samples"], columns=segment["columns"])
+    return df.drop(columns=NON_FEATURE_COLUMNS)
@@ -1,16 +1,23 @@
-import time
-import sys
-import os
+import logging
 import tflite_runtime.interpreter as tflite
 import numpy as np
 import pandas
+import queue
 
 import preprocess
+from Util.logger import getLogger
+
+logger = getLogger("ML")
 # from keras.models import load_model
 
 DECODE = {0: "dab", 1: "listen", 2: "pointhigh"}
 ENCODE = {"dab": 0, "listen": 1, "pointhigh": 2}
 
+# Samples per window when the laptop sends single samples instead of move segments
+WINDOW_SIZE = 30
+# How long handleML waits for data before checking for shutdown again
+POLL_TIMEOUT_SEC = 0.1
+
 # class ML:
 #     def __init__(self):
 #         self.test_model = load_model("MLP")
@@ -49,31 +56,42 @@ def eval_mlp(data, tflite_model):
 def handleML(inputQueue, output, moveCompletedFlag, evalClient):
     try:
         # test_model = load_model("MLP")
-        print("Initializing ML model")
+        logger.info("Initializing ML model")
         tflite_model = tflite.Interpreter(model_path="model.tflite")
         tflite_model.allocate_tensors()
-        print("Initialization done")
+        logger.info("Initialization done")
         while True:
-            dataFrame = []
-            if inputQueue.qsize() > 29: 
-                print("queue > 40, processing data")
-                for _ in range(30):
-                    dataPoint = inputQueue.get()
-                    dataPoint.pop('moveFlag')
-                    dataPoint.pop('Id')
-                    dataPoint.pop('time')
-                    dataFrame.append(dataPoint)
-                print("dataframe retrieved")
-                # print(dataFrame)
-                pdDataFrame = pandas.DataFrame(dataFrame)
-                print(pdDataFrame)
+            try:
+                item = inputQueue.get(timeout=POLL_TIMEOUT_SEC)
+            except queue.Empty:
+                continue
+            if "features" in item:
+                # features already extracted by the laptop
+                data_to_evaluate = np.asarray(item["features"])
+            else:
+                if "samples" in item:
+                    # a complete move segment assembled by the laptop
+                    pdDataFrame = preprocess.segment_to_dataframe(item)
+                else:
+                    # single samples, wait for a full window
+                    dataFrame = [item]
+                    while len(dataFrame) < WINDOW_SIZE:
+                        dataFrame.append(inputQueue.get())
+                    for dataPoint in dataFrame:
+                        dataPoint.pop('moveFlag')
+                        dataPoint.pop('Id')
+                        dataPoint.pop('time')
+                    pdDataFrame = pandas.DataFrame(dataFrame)
+                logger.debug("dataframe retrieved")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("\n%s", pdDataFrame)
                 data_to_evaluate = preprocess.process_data_stream(pdDataFrame)
-                prediction = eval_mlp(data_to_evaluate, tflite_model)
-                output = prediction
-                print(output)
-                evalClient.sendToEval(action=ENCODE[output],positions=1)
-                moveCompletedFlag.set()
-                while not inputQueue.empty():
-                    inputQueue.get()
+            prediction = eval_mlp(data_to_evaluate, tflite_model)
+            output = prediction
+            logger.info("Prediction: %s", output)
+            evalClient.sendToEval(action=ENCODE[output],positions=1)
+            moveCompletedFlag.set()
+            while not inputQueue.empty():
+                inputQueue.get()
     except:
-        print(sys.exc_info())
+        logger.exception("handleML stopped")
@@ -0,0 +1,261 @@
+from collections import namedtuple
+import struct
+
+# Binary framing of laptop <-> ultra96 traffic. Every frame is an 8 byte header
+#   uint8 version, uint8 type, uint8 flags, pad byte, uint32 payload length (network order)
+# followed by the payload. Payloads are raw IV + ciphertext, without base64.
+#
+# The old format, base64(IV + ciphertext) terminated by ',', is still accepted: its
+# first byte is a base64 character, which can never be a version byte, so the format
+# of a stream is decided from its first byte and legacy messages come out as
+# TYPE_LEGACY frames holding the base64 text.
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!BBBxI')
+
+# Frame types
+TYPE_LEGACY = 0         # base64 message of the old ',' terminated format
+TYPE_MESSAGE = 1        # encrypted utf8 message (command string or json)
+TYPE_SEGMENT = 2        # encrypted move segment in the binary layout of Util/sample_codec.py
+TYPE_TAGGED = 3         # another dancer's frame multiplexed by an aggregator, see encodeTagged
+
+# Flag bits
+FLAG_ENCRYPTED = 0x01   # AES-CBC with the shared key
+FLAG_SESSION = 0x02     # AES-GCM with the connection's session key, see Util/encryption.py SessionCipher
+
+# Frames longer than this are a corrupt or hostile stream, not a message
+MAX_FRAME_LENGTH = 1 << 20
+
+# Receive buffer of a StreamFramer: it doubles while recvs fill all the space there is and
+# halves after SHRINK_AFTER_RECVS recvs in a row that used under a quarter of it, so bursts
+# are read with few recv calls and quiet connections don't hold on to big buffers
+MIN_RECV_BYTES = 4096
+MAX_RECV_BYTES = 1 << 18
+SHRINK_AFTER_RECVS = 64
+
+LEGACY_DELIMITER = b','
+BASE64_BYTES = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+
+Frame = namedtuple("Frame", ["type", "flags", "payload"])
+
+
+class FramingError(ValueError):
+    pass
+
+
+def encodeFrame(payload, frameType=TYPE_MESSAGE, flags=FLAG_ENCRYPTED):
+    return HEADER.pack(PROTOCOL_VERSION, frameType, flags, len(payload)) + payload
+
+
+def encodeTagged(dancerID, frame):
+    # Wraps a complete frame of dancerID for the shared aggregator <-> ultra96 connection:
+    #   uint8 dancer ID length, dancer ID (utf8), the frame with its own header
+    tag = dancerID.encode('utf8')
+    return encodeFrame(bytes([len(tag)]) + tag + frame, TYPE_TAGGED, 0)
+
+
+def decodeTagged(payload):
+    # Returns the dancer ID and the frame inside a TYPE_TAGGED payload
+    if not payload or len(payload) < 1 + payload[0] + HEADER.size:
+        raise FramingError("tagged frame of {} bytes is too short".format(len(payload)))
+    end = 1 + payload[0]
+    version, frameType, flags, length = HEADER.unpack_from(payload, end)
+    if version != PROTOCOL_VERSION or len(payload) != end + HEADER.size + length:
+        raise FramingError("corrupt frame inside tagged frame")
+    return str(payload[1:end], 'utf8'), Frame(frameType, flags, payload[end + HEADER.size:])
+
+
+def frameBytes(frame):
+    return encodeFrame(frame.payload, frame.type, frame.flags)
+
+
+def copyFrame(frame):
+    # The frame with a payload of its own, for keeping a StreamFramer frame past the next recv
+    return Frame(frame.type, frame.flags, bytes(frame.payload))
+
+
+def encryptFrame(message, encryptionHandler, frameType=TYPE_MESSAGE, session=None):
+    # Encrypted with the session's key once the connection has one
+    if session is not None:
+        return encodeFrame(session.encrypt_raw(message), frameType, FLAG_SESSION)
+    return encodeFrame(encryptionHandler.encrypt_raw(message), frameType)
+
+
+def decryptFrame(frame, encryptionHandler, session=None):
+    # Returns the message string of a message frame, whichever format it came in,
+    # and the payload bytes of a binary frame. A connection with a session takes
+    # nothing but session frames, anything else would bypass its authentication.
+    if session is not None and not frame.flags & FLAG_SESSION:
+        raise FramingError("frame without a session on a session connection")
+    if frame.type == TYPE_LEGACY:
+        return encryptionHandler.decrypt_message(frame.payload)
+    if frame.type not in (TYPE_MESSAGE, TYPE_SEGMENT):
+        raise FramingError("unknown frame type {}".format(frame.type))
+    binary = frame.type != TYPE_MESSAGE
+    if frame.flags & FLAG_SESSION:
+        if session is None:
+            raise FramingError("session frame on a connection without a session")
+        return session.decrypt_raw(frame.payload, binary)
+    if not frame.flags & FLAG_ENCRYPTED:
+        # nothing sends plaintext, it would be an unauthenticated way in
+        raise FramingError("unencrypted frame")
+    return encryptionHandler.decrypt_raw(frame.payload, binary)
+
+
+# Incremental frame parser for one stream. feed() takes whatever recv returned,
+# frames split across recvs are kept until complete and several frames in one
+# recv are all returned.
+class FrameReader():
+
+    def __init__(self, maxLength=MAX_FRAME_LENGTH):
+        self.maxLength = maxLength
+        self.buffer = bytearray()
+        # None until the first byte decides between binary and legacy frames
+        self.legacy = None
+
+    def feed(self, data):
+        self.buffer += data
+        if self.legacy is None and self.buffer:
+            self.legacy = self.buffer[0] in BASE64_BYTES
+        if self.legacy:
+            return self.feedLegacy()
+
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            version, frameType, flags, length = HEADER.unpack_from(self.buffer, offset)
+            if version != PROTOCOL_VERSION:
+                raise FramingError("unsupported protocol version {}".format(version))
+            if length > self.maxLength:
+                raise FramingError("frame of {} bytes is over the {} byte limit".format(length, self.maxLength))
+            end = offset + HEADER.size + length
+            if end > len(self.buffer):
+                break
+            frames.append(Frame(frameType, flags, bytes(self.buffer[offset + HEADER.size:end])))
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+    def feedLegacy(self):
+        parts = self.buffer.split(LEGACY_DELIMITER)
+        self.buffer = bytearray(parts.pop())
+        if len(self.buffer) > self.maxLength:
+            raise FramingError("legacy message over the {} byte limit".format(self.maxLength))
+        return [Frame(TYPE_LEGACY, FLAG_ENCRYPTED, bytes(part)) for part in parts if part]
+
+
+# Frame parser owning the receive buffer of a blocking socket. recv() reads with recv_into
+# straight into a preallocated bytearray and returns the frames it completed with payloads
+# that are memoryviews into the buffer, so the bytes of a frame are only copied by the
+# kernel. Those payloads are valid until the next recv(), see copyFrame. A frame cut off
+# at the end of a recv is moved to the start of the buffer and completed by the next one,
+# which costs at most one frame's bytes per recv however much arrives at once.
+class StreamFramer():
+
+    def __init__(self, maxLength=MAX_FRAME_LENGTH, minSize=MIN_RECV_BYTES, maxSize=MAX_RECV_BYTES):
+        self.maxLength = maxLength
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.buffer = bytearray(minSize)
+        self.view = memoryview(self.buffer)
+        # Received bytes that aren't part of a returned frame yet are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # Buffer size for the next recvs, and the size the frame cut off at the end needs
+        self.size = minSize
+        self.needed = 0
+        self.smallRecvs = 0
+        # None until the first byte decides between binary and legacy frames
+        self.legacy = None
+
+        # Counters
+        self.recvCount = 0
+        self.bytesReceived = 0
+        self.bytesMoved = 0
+
+    def recv(self, conn):
+        # Blocks for one recv, returns the frames it completed, possibly none
+        self.makeRoom()
+        free = len(self.buffer) - self.end
+        count = conn.recv_into(self.view[self.end:])
+        if not count:
+            raise ConnectionError("connection closed")
+        self.end += count
+        self.recvCount += 1
+        self.bytesReceived += count
+        self.adapt(count, free)
+        if self.legacy is None:
+            self.legacy = self.buffer[self.start] in BASE64_BYTES
+        if self.legacy:
+            return self.splitLegacy()
+        return self.split()
+
+    def makeRoom(self):
+        # Moves the cut off frame to the start of the buffer, reallocated if the buffer
+        # size changes or the frame doesn't fit
+        pending = self.end - self.start
+        size = max(self.size, self.needed, pending)
+        if size != len(self.buffer):
+            buffer = bytearray(size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start == 0:
+            return
+        else:
+            # memoryview assignment copies overlapping ranges correctly
+            self.view[:pending] = self.view[self.start:self.end]
+        self.bytesMoved += pending
+        self.start = 0
+        self.end = pending
+
+    def adapt(self, count, free):
+        # Picks the buffer size of the next recvs from how much of the free space this one filled
+        size = len(self.buffer)
+        if count == free:
+            self.smallRecvs = 0
+            self.size = max(self.size, min(size * 2, self.maxSize))
+        elif count < size // 4:
+            self.smallRecvs += 1
+            if self.smallRecvs >= SHRINK_AFTER_RECVS:
+                self.smallRecvs = 0
+                self.size = max(self.size // 2, self.minSize)
+        else:
+            self.smallRecvs = 0
+
+    def split(self):
+        frames = []
+        start = self.start
+        self.needed = 0
+        while self.end - start >= HEADER.size:
+            version, frameType, flags, length = HEADER.unpack_from(self.buffer, start)
+            if version != PROTOCOL_VERSION:
+                raise FramingError("unsupported protocol version {}".format(version))
+            if length > self.maxLength:
+                raise FramingError("frame of {} bytes is over the {} byte limit".format(length, self.maxLength))
+            end = start + HEADER.size + length
+            if end > self.end:
+                self.needed = HEADER.size + length
+                break
+            frames.append(Frame(frameType, flags, self.view[start + HEADER.size:end]))
+            start = end
+        self.start = start
+        return frames
+
+    def splitLegacy(self):
+        frames = []
+        start = self.start
+        while True:
+            delimiter = self.buffer.find(LEGACY_DELIMITER, start, self.end)
+            if delimiter < 0:
+                break
+            if delimiter > start:
+                frames.append(Frame(TYPE_LEGACY, FLAG_ENCRYPTED, self.view[start:delimiter]))
+            start = delimiter + 1
+        self.start = start
+        pending = self.end - start
+        if pending > self.maxLength:
+            raise FramingError("legacy message over the {} byte limit".format(self.maxLength))
+        # a message that fills the whole buffer needs a bigger one, its length isn't known
+        self.needed = 2 * len(self.buffer) if pending == len(self.buffer) else 0
+        return frames
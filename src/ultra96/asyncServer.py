@@ -0,0 +1,302 @@
+import asyncio
+import concurrent.futures
+import sys
+import threading
+import time
+from server import (Ultra96Server, NUM_DANCERS, SYNC_ROUNDS_PER_BURST, SYNC_RESPONSE_TIMEOUT_SEC,
+                    CLOCK_CHANNEL_IDENTIFY_TIMEOUT_SEC, IDENTIFY_TIMEOUT_SEC)
+from Util.framing import FrameReader, FramingError, decryptFrame
+from Util.clock_channel import CLOCK_PORT_OFFSET, PACKET, setNoDelay
+from Util.logger import getLogger
+
+logger = getLogger("asyncServer")
+
+# Ultra96Server with all the connections served by one asyncio event loop, in a thread of
+# its own, instead of a handleClient and a handleClockSync thread per dancer plus a thread
+# per clock channel. The loop does the non-blocking reads and writes, the message handling
+# (Ultra96Server.handleFrame and everything it calls, where sendToDancer only queues the
+# write) and the clock sync scheduling. The ML loops keep running in their own executor,
+# see ControlMain, and get their data through dancerDataDict as before.
+#   python main.py async
+#   python asyncServer.py <numDancers> [port=10022]     load test, no ML or eval server
+
+# Bytes read from a connection at once
+READ_BYTES = 1 << 16
+# How often the loop checks globalShutDown
+SHUTDOWN_POLL_SEC = 0.2
+
+
+class AsyncUltra96Server(Ultra96Server):
+
+    def __init__(self, host:str, port:int, key:str, controlMain):
+        super().__init__(host, port, key, controlMain)
+        self.numDancers = NUM_DANCERS
+        # The loop and its thread, set up by initializeConnections
+        self.loop = None
+        self.thread = None
+        self.allConnected = None
+        # StreamReader of each dancer's connection, FrameReaders are in readers
+        self.streams = {}
+        # handleClient and handleClockSync task of each dancer
+        self.tasks = {}
+
+    def initializeConnections(self, numDancers = NUM_DANCERS):
+        # Starts the loop thread and blocks until numDancers dancers have identified, the loop
+        # serves them from then on
+        self.numDancers = numDancers
+        connected = concurrent.futures.Future()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.serve(connected)), name="asyncServer", daemon=True)
+        self.thread.start()
+        connected.result()
+
+    async def serve(self, connected):
+        self.loop = asyncio.get_running_loop()
+        self.allConnected = asyncio.Event()
+        host, port = self.connection
+        try:
+            server = await asyncio.start_server(self.handleConnection, host, port)
+            clockServer = await asyncio.start_server(self.handleClockChannel, host, port + CLOCK_PORT_OFFSET)
+        except OSError as e:
+            connected.set_exception(e)
+            return
+        logger.info("Waiting for %d dancers on %s", self.numDancers, self.connection)
+        await self.allConnected.wait()
+        connected.set_result(None)
+        try:
+            while not self.globalShutDown.is_set():
+                await asyncio.sleep(SHUTDOWN_POLL_SEC)
+        finally:
+            server.close()
+            clockServer.close()
+            for tasks in self.tasks.values():
+                for task in tasks:
+                    task.cancel()
+            logger.info("Event loop stopped")
+
+    async def readFrames(self, reader, frameReader):
+        # Waits until at least one complete frame has arrived
+        while True:
+            data = await reader.read(READ_BYTES)
+            if not data:
+                raise ConnectionError("connection closed by laptop")
+            frames = frameReader.feed(data)
+            if frames:
+                return frames
+
+    async def nextFrames(self, stream, reader, muxQueue):
+        # Waits for frames, from muxQueue for a dancer behind an aggregator, returns them and
+        # their receive time
+        if muxQueue is not None:
+            item = await muxQueue.get()
+            if item is None:
+                raise ConnectionError("aggregator connection lost")
+            return item
+        frames = await self.readFrames(stream, reader)
+        return frames, time.time()
+
+    def sendToDancer(self, dancerID, message):
+        # Only called on the loop, the transport sends the message in the background
+        writer, addr = self.clients[dancerID]
+        writer.write(self.encodeMessage(message, dancerID))
+
+    def broadcastMessage(self, message):
+        # Safe from any thread, the messages are written on the loop
+        self.loop.call_soon_threadsafe(super().broadcastMessage, message)
+
+    def addDancer(self, dancerID, writer, addr, reader, sendLock=None):
+        # The loop is the only writer, there are no send locks
+        super().addDancer(dancerID, writer, addr, reader, sendLock)
+        self.clockSyncResponseLock[dancerID] = asyncio.Event()
+        logger.info("Dancer ID: %s, legacy framing: %s (%d/%d)", dancerID, reader.legacy, len(self.clients), self.numDancers)
+
+    def attachDancer(self, dancerID, writer, addr, reader, sendLock, muxQueue, acceptTime):
+        # A rejoining dancer's old tasks stop with its old connection, it gets new ones
+        for task in self.tasks.pop(dancerID, []):
+            task.cancel()
+        super().attachDancer(dancerID, writer, addr, reader, sendLock, muxQueue, acceptTime)
+        self.tasks[dancerID] = [asyncio.ensure_future(self.handleClient(dancerID)),
+                                asyncio.ensure_future(self.handleClockSync(dancerID))]
+        if len(self.clients) >= self.numDancers:
+            self.allConnected.set()
+
+    def closeConnection(self, writer):
+        writer.close()
+
+    async def handleConnection(self, reader, writer):
+        # Identifies a new connection, then serves an aggregator's connection itself. A
+        # laptop's connection is read by its dancer's handleClient task. A known dancer
+        # rejoins, see Ultra96Server.attachDancer.
+        acceptTime = time.time()
+        addr = writer.get_extra_info('peername')
+        frameReader = FrameReader()
+        try:
+            frames = await asyncio.wait_for(self.readFrames(reader, frameReader), IDENTIFY_TIMEOUT_SEC)
+            hello = self.identify(frames[0])
+        except (asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            # ValueError covers FramingError, a bad key and a broken hello message
+            logger.warning("Connection from %s failed to identify: %s", addr, e)
+            writer.close()
+            return
+        # Nothing awaits from here to the attachDancer calls, identification needs no lock
+        dancerIDs = hello['dancers'] if hello['command'] == "aggregator" else [hello['dancer']]
+        newCount = len([dancerID for dancerID in dancerIDs if dancerID not in self.clients])
+        if len(self.clients) + newCount > self.numDancers:
+            logger.warning("Refusing %s from %s, already serving %s", dancerIDs, addr, list(self.clients))
+            writer.close()
+            return
+
+        if hello['command'] == "aggregator":
+            logger.info("Aggregator %s with dancers %s", addr, dancerIDs)
+            for dancerID in dancerIDs:
+                # frames behind an aggregator are encrypted with the shared key
+                self.sessions.pop(dancerID, None)
+                self.attachDancer(dancerID, writer, addr, frameReader, None, asyncio.Queue(), acceptTime)
+            await self.handleAggregator(reader, frameReader, addr, dancerIDs, frames[1:])
+            return
+        dancerID = hello['dancer']
+        self.streams[dancerID] = reader
+        self.pendingFrames[dancerID] = frames[1:]
+        if 'nonce' in hello:
+            writer.write(self.startSession(dancerID, bytes.fromhex(hello['nonce'])))
+        else:
+            # rejoining without a session, the old one would reject its frames
+            self.sessions.pop(dancerID, None)
+        self.attachDancer(dancerID, writer, addr, frameReader, None, None, acceptTime)
+
+    async def handleAggregator(self, reader, frameReader, addr, dancerIDs, frames):
+        # Splits the tagged frames of an aggregator's connection up by dancer, for their handleClient
+        muxQueues = {dancerID : self.muxQueues[dancerID] for dancerID in dancerIDs}
+        try:
+            while True:
+                if not frames:
+                    frames = await self.readFrames(reader, frameReader)
+                self.dispatchTagged(frames, addr, time.time())
+                frames = []
+        except (ConnectionError, OSError, ValueError) as e:
+            logger.error("Aggregator %s connection lost: %s", addr, e)
+            # the queues of this connection, a dancer that has rejoined already has a new one
+            for muxQueue in muxQueues.values():
+                muxQueue.put_nowait(None)
+
+    async def handleClient(self, dancerID : str):
+        # Serves dancerID's current connection, a rejoin cancels it
+        stream, reader, muxQueue = self.streams.get(dancerID), self.readers[dancerID], self.muxQueues.get(dancerID)
+        frames = self.pendingFrames.pop(dancerID, [])
+        timerecv = time.time()
+        try:
+            while not self.globalShutDown.is_set():
+                for frame in frames:
+                    if not self.handleFrame(frame, dancerID, timerecv):
+                        logger.info("%s RETURNING", dancerID)
+                        return
+                frames, timerecv = await self.nextFrames(stream, reader, muxQueue)
+        except (ConnectionError, OSError, FramingError) as e:
+            # the stream can't be resynchronised after a bad frame
+            self.lostTimes[dancerID] = time.time()
+            logger.error("%s connection lost: %s", dancerID, e)
+        finally:
+            # after a rejoin attachDancer has cancelled this task and started the dancer's next ones
+            tasks = self.tasks.get(dancerID)
+            if tasks and tasks[0] is asyncio.current_task():
+                tasks[1].cancel()
+
+    async def handleClockSync(self, dancerID):
+        # Ultra96Server.handleClockSync as a coroutine
+        clockSync = self.clockSyncs[dancerID]
+        reply = self.clockSyncResponseLock[dancerID]
+        while True:
+            rounds = 0
+            while rounds < SYNC_ROUNDS_PER_BURST and clockSync.needsSync(clockSync.toLocal(time.time())):
+                reply.clear()
+                self.requestClockSync(dancerID, clockSync.syncCount)
+                try:
+                    await asyncio.wait_for(reply.wait(), SYNC_RESPONSE_TIMEOUT_SEC)
+                except asyncio.TimeoutError:
+                    logger.warning("%s didn't answer clock sync", dancerID)
+                rounds += 1
+            await asyncio.sleep(self.nextClockSync(dancerID, rounds))
+
+    async def identifyClockChannel(self, reader, addr):
+        # Returns the dancer ID the channel belongs to, None if it isn't a known dancer
+        try:
+            frames = await asyncio.wait_for(self.readFrames(reader, FrameReader()), IDENTIFY_TIMEOUT_SEC)
+            dancerID = decryptFrame(frames[0], self.encryptionHandler)
+        except (asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            logger.warning("Clock channel from %s failed to identify: %s", addr, e)
+            return None
+        deadline = time.time() + CLOCK_CHANNEL_IDENTIFY_TIMEOUT_SEC
+        while dancerID not in self.clockSyncs:
+            if time.time() > deadline:
+                logger.warning("Clock channel from %s for unknown dancer %s", addr, dancerID)
+                return None
+            await asyncio.sleep(0.01)
+        return dancerID
+
+    async def handleClockChannel(self, reader, writer):
+        # The receive time is taken when the loop gets to the packet, which can be after
+        # another dancer's message. That delay counts into the rtt, so ClockSync's lowest
+        # rtt samples leave it out like any other queueing delay.
+        addr = writer.get_extra_info('peername')
+        setNoDelay(writer.get_extra_info('socket'))
+        dancerID = await self.identifyClockChannel(reader, addr)
+        if dancerID is None:
+            writer.close()
+            return
+        logger.info("Dancer %s opened a clock channel", dancerID)
+        self.clockChannels[dancerID] = writer
+        try:
+            while True:
+                packet = await reader.readexactly(PACKET.size)
+                self.handleClockPacket(dancerID, PACKET.unpack(packet), time.time())
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            # clock sync falls back to the data socket
+            logger.warning("%s clock channel lost: %s", dancerID, e)
+            # a rejoined dancer may have opened its next channel already
+            if self.clockChannels.get(dancerID) is writer:
+                self.clockChannels.pop(dancerID, None)
+            writer.close()
+
+    def sendClockPacket(self, dancerID, packet):
+        self.clockChannels[dancerID].write(packet)
+
+
+class LoadTestMain():
+    # Stands in for ControlMain without ML or eval server, see loadTest
+
+    def __init__(self):
+        self.lockDataQueue = threading.Lock()
+        self.dancerDataDict = {}
+        self.moveCompletedFlag = threading.Event()
+        self.globalShutDown = threading.Event()
+
+
+def loadTest(numDancers, port):
+    # Serves numDancers dancers (python aggregator.py <numDancers> simulate for many) and logs
+    # how many data items each queues for ML, and how many threads that takes
+    controlMain = LoadTestMain()
+    server = AsyncUltra96Server('127.0.0.1', port, "Sixteen byte key", controlMain)
+    server.initializeConnections(numDancers)
+    server.broadcastMessage('start')
+    counts = dict.fromkeys(controlMain.dancerDataDict, 0)
+    lastReport = time.time()
+    try:
+        while True:
+            for dancerID, dataQueue in controlMain.dancerDataDict.items():
+                while not dataQueue.empty():
+                    dataQueue.get()
+                    counts[dancerID] += 1
+            if time.time() - lastReport >= 5:
+                logger.info("Items per dancer in %.0f s: %s, %d threads", time.time() - lastReport, counts, threading.active_count())
+                counts = dict.fromkeys(counts, 0)
+                lastReport = time.time()
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        server.broadcastMessage('quit')
+        time.sleep(0.5)
+        controlMain.globalShutDown.set()
+
+
+if __name__ == "__main__":
+    options = [arg.strip() for arg in sys.argv[2:]]
+    port = int(next((option.split("=", 1)[1] for option in options if option.startswith("port=")), 10022))
+    loadTest(int(sys.argv[1]), port)
@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import time
+from Util.encryption import EncryptionHandler, AESGCM
+
+# Per message cost of the transport encryption modes, meant to be run on the ultra96
+# (its ARM cores are the slow end of the link) as well as on the laptops:
+#   legacy        encrypt_msg / decrypt_message, AES-CBC, space padding, base64 (eval server)
+#   cbc           encrypt_raw / decrypt_raw, AES-CBC under the shared key, PKCS7 (binary frames)
+#   gcm           SessionCipher, AES-GCM under a session key with one reused context
+#   gcm-cryptodome  SessionCipher without the cryptography package, a new cipher per message
+#   python bench_encryption.py [--messages N] [--sizes 64 256 1024 4096]
+
+
+def legacyPair(handler):
+    # space padding would eat trailing spaces, the benchmark messages have none
+    return handler.encrypt_msg, lambda data: handler.decrypt_message(data)
+
+
+def cbcPair(handler):
+    return handler.encrypt_raw, handler.decrypt_raw
+
+
+def gcmPair(handler, useCryptography):
+    clientNonce, serverNonce = os.urandom(16), os.urandom(16)
+    laptop = handler.newSession(clientNonce, serverNonce, "1", False)
+    server = handler.newSession(clientNonce, serverNonce, "1", True)
+    if not useCryptography:
+        laptop.aead = server.aead = None
+    return laptop.encrypt_raw, server.decrypt_raw
+
+
+def bench(name, pair, message, count):
+    encrypt, decrypt = pair
+    start = time.perf_counter()
+    encrypted = [encrypt(message) for _ in range(count)]
+    encryptTime = time.perf_counter() - start
+    start = time.perf_counter()
+    for data in encrypted:
+        decrypt(data)
+    decryptTime = time.perf_counter() - start
+    print("{:<15} {:>5} B   encrypt {:7.2f} us   decrypt {:7.2f} us   {:6.1f} MB/s   {:5} B on the wire".format(
+        name, len(message), encryptTime / count * 1e6, decryptTime / count * 1e6,
+        len(message) * count / (encryptTime + decryptTime) / 1e6, len(encrypted[0])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the per message cost of the encryption modes")
+    parser.add_argument("--messages", type=int, default=5000, help="messages per mode and size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 256, 1024, 4096], help="message sizes in bytes")
+    args = parser.parse_args()
+
+    handler = EncryptionHandler(b'Sixteen byte key')
+    modes = [("legacy", legacyPair(handler)), ("cbc", cbcPair(handler))]
+    if AESGCM is not None:
+        modes.append(("gcm", gcmPair(handler, True)))
+    else:
+        print("cryptography is not installed, gcm falls back to Cryptodome")
+    modes.append(("gcm-cryptodome", gcmPair(handler, False)))
+
+    for size in args.sizes:
+        # json like text, the size of a typical message
+        message = json.dumps({"command": "data", "message": "x" * max(size - 32, 0)})[:size]
+        for name, pair in modes:
+            bench(name, pair, message, args.messages)
+        print()
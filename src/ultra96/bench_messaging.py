@@ -0,0 +1,334 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import time
+import tracemalloc
+from Util.encryption import EncryptionHandler, AESGCM, SESSION_NONCE_BYTES
+from Util.framing import FrameReader, StreamFramer, encryptFrame, decryptFrame
+from Util.sample_codec import COLUMNS
+
+# Per message cost of every stage of the laptop -> ultra96 messaging path, so transport
+# changes can be judged with numbers. The laptop side is
+#   dumps     json.dumps of the message (a BatchSender batch when batch > 1)
+#   encrypt   encryption and framing, as LaptopClient.encryptMessage
+#   send      sendall on a loopback TCP connection drained by another process
+# and the server side, as Ultra96Server.handleClient
+#   split     StreamFramer.recv of the operation's bytes, copied in by a stand-in socket
+#   decrypt   decryptFrame
+#   loads     json.loads
+# Each stage runs in isolation on prepared inputs, then the whole path runs end to end
+# over loopback with the server side in another process:
+#   e2e         as fast as the sender can go, for throughput
+#   e2e-paced   at --rate operations a second, for latency without queueing
+# for every transport format:
+#   legacy    base64(AES-CBC) terminated by ',' (encrypt_msg / decrypt_message)
+#   cbc       binary frames, AES-CBC under the shared key
+#   gcm       binary frames, AES-GCM under a session key
+#
+# Results are written as json, one record per stage, format, message size and batch size
+# with opsPerSec, messagesPerSec, p50Us and p99Us per operation (one dumps, send, ... of a
+# batch) and allocBytesPerMessage, the peak memory tracemalloc sees allocated by one
+# operation, divided by the messages in it. A summary table goes to stderr.
+#   python bench_messaging.py [--ops N] [--sizes 128 1024 8192] [--batches 1 8]
+#                             [--formats legacy cbc gcm] [--rate 200] [--output results.json]
+#
+# e2e latencies compare perf_counter across two processes, which is one system wide clock
+# on Linux (the ultra96 and the laptops running Linux) but not on every platform.
+
+KEY = b'Sixteen byte key'
+FORMATS = ("legacy", "cbc", "gcm")
+# Size of the recvs of the draining receiver
+RECV_BYTES = 1 << 16
+# Operations run before measuring, and operations traced for allocations (tracemalloc is slow)
+WARMUP_OPS = 50
+ALLOC_OPS = 200
+# Limit on the wire bytes prepared per case, so big messages in big batches fit in memory
+MAX_CASE_BYTES = 32 << 20
+
+
+def makeMessage(size, rng):
+    # A move segment message of about size bytes of json, as segmentMessage() on the laptop
+    records = []
+    message = {"command" : "segment", "message" : {"columns" : COLUMNS, "samples" : records}}
+    startTime = time.time()
+    while len(json.dumps(message)) < size:
+        records.append([1, *(rng.randint(-16000, 16000) for _ in range(6)), 1, 0, startTime + len(records) * 0.02])
+    return message
+
+
+def makeBatch(message, batch):
+    # What BatchSender.flush sends for batch messages
+    if batch == 1:
+        return message
+    return {"command" : "batch", "messages" : [message] * batch}
+
+
+class Codec():
+    # Both ends of one transport format: the laptop's encryption and the server's decryption
+
+    def __init__(self, name, nonces=None):
+        self.name = name
+        self.handler = EncryptionHandler(KEY)
+        self.nonces = nonces or (os.urandom(SESSION_NONCE_BYTES), os.urandom(SESSION_NONCE_BYTES))
+        self.laptopSession = None
+        self.serverSession = None
+        if name == "gcm":
+            self.laptopSession = self.handler.newSession(*self.nonces, "1", False)
+        self.newReceiver()
+
+    def newReceiver(self):
+        # A fresh server side, whose replay window hasn't seen any of the frames yet
+        if self.name == "gcm":
+            self.serverSession = self.handler.newSession(*self.nonces, "1", True)
+
+    def encrypt(self, text):
+        if self.name == "legacy":
+            return self.handler.encrypt_msg(text) + b','
+        return encryptFrame(text, self.handler, session=self.laptopSession)
+
+    def decrypt(self, frame):
+        return decryptFrame(frame, self.handler, self.serverSession)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(times, elapsedNs, messagesPerOp):
+    # times are the nanoseconds of each operation, elapsedNs the time for all of them
+    times = sorted(times)
+    return {
+        "ops" : len(times),
+        "opsPerSec" : len(times) / elapsedNs * 1e9,
+        "messagesPerSec" : len(times) * messagesPerOp / elapsedNs * 1e9,
+        "p50Us" : percentile(times, 0.5) / 1000,
+        "p99Us" : percentile(times, 0.99) / 1000,
+    }
+
+
+def measure(makeOp, inputs, messagesPerOp):
+    # makeOp returns the operation with fresh state (a new StreamFramer, replay window, ...),
+    # which is called on every input once per pass
+    op = makeOp()
+    for item in inputs[:WARMUP_OPS]:
+        op(item)
+
+    op = makeOp()
+    clock = time.perf_counter_ns
+    times = []
+    started = clock()
+    for item in inputs:
+        start = clock()
+        op(item)
+        times.append(clock() - start)
+    result = summarize(times, clock() - started, messagesPerOp)
+
+    # peak of each operation's allocations, in a pass of its own as tracing slows everything down
+    op = makeOp()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for item in inputs[:ALLOC_OPS]:
+            tracemalloc.clear_traces()
+            op(item)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+    result["allocBytesPerMessage"] = percentile(sorted(peaks), 0.5) / messagesPerOp
+    return result
+
+
+def receive(port, codecName, nonces, pipe):
+    # Server side of the end to end runs, in its own process: receives until the sender
+    # closes and sends back the time each operation was decoded, if decoding
+    codec = Codec(codecName, nonces)
+    conn = socket.create_connection(("127.0.0.1", port))
+    decoding = pipe.recv()
+    framer = StreamFramer()
+    clock = time.perf_counter_ns
+    recvTimes = []
+    while True:
+        if not decoding:
+            if not conn.recv(RECV_BYTES):
+                break
+            continue
+        try:
+            frames = framer.recv(conn)
+        except ConnectionError:
+            break
+        for frame in frames:
+            json.loads(codec.decrypt(frame))
+            recvTimes.append(clock())
+    conn.close()
+    pipe.send(recvTimes)
+
+
+class Loopback():
+    # A loopback connection to a receive() process
+
+    def __init__(self, codec, decoding):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.pipe, childPipe = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=receive, args=(listener.getsockname()[1], codec.name, codec.nonces, childPipe), daemon=True)
+        self.process.start()
+        self.sock, _ = listener.accept()
+        listener.close()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pipe.send(decoding)
+
+    def close(self):
+        # Returns the receive times of a decoding receiver
+        self.sock.close()
+        recvTimes = self.pipe.recv()
+        self.process.join()
+        return recvTimes
+
+
+class ChunkSource():
+    # Stands in for a socket in front of a StreamFramer, recv_into hands out data
+
+    def __init__(self):
+        self.data = memoryview(b'')
+
+    def recv_into(self, view):
+        count = min(len(view), len(self.data))
+        view[:count] = self.data[:count]
+        self.data = self.data[count:]
+        return count
+
+
+def newSplit():
+    # The bytes of an operation arriving together, in as many recvs as the framer needs
+    framer = StreamFramer()
+    source = ChunkSource()
+
+    def split(wire):
+        source.data = memoryview(wire)
+        frames = []
+        while source.data:
+            frames += framer.recv(source)
+        return frames
+    return split
+
+
+def measureSend(codec, wires, messagesPerOp):
+    loopback = Loopback(codec, False)
+    try:
+        return measure(lambda: loopback.sock.sendall, wires, messagesPerOp)
+    finally:
+        loopback.close()
+
+
+def measureEndToEnd(codec, payload, count, messagesPerOp, rate=None):
+    # json.dumps, encrypt and send of count operations, each timed until the receiver has
+    # decoded it. rate paces the operations, None sends them back to back
+    codec = Codec(codec.name)
+    loopback = Loopback(codec, True)
+    clock = time.perf_counter_ns
+    sendTimes = []
+    started = clock()
+    try:
+        for index in range(count):
+            if rate:
+                delay = started / 1e9 + index / rate - clock() / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+            sendTimes.append(clock())
+            loopback.sock.sendall(codec.encrypt(json.dumps(payload)))
+    finally:
+        recvTimes = loopback.close()
+    if len(recvTimes) != count:
+        raise RuntimeError("receiver decoded {} of {} operations".format(len(recvTimes), count))
+    return summarize([recv - send for send, recv in zip(sendTimes, recvTimes)], recvTimes[-1] - started, messagesPerOp)
+
+
+def runCase(formats, size, batch, count, rate, rng):
+    payload = makeBatch(makeMessage(size, rng), batch)
+    text = json.dumps(payload)
+    case = {"messageBytes" : len(json.dumps(payload if batch == 1 else payload["messages"][0])), "batch" : batch}
+    results = []
+
+    def record(stage, codecName, wireBytes, result):
+        results.append(dict(case, stage=stage, format=codecName, wireBytes=wireBytes, **result))
+
+    # json is the same whatever the transport
+    record("dumps", None, len(text), measure(lambda: json.dumps, [payload] * count, batch))
+    record("loads", None, len(text), measure(lambda: json.loads, [text] * count, batch))
+
+    for codecName in formats:
+        codec = Codec(codecName)
+        wires = [codec.encrypt(text) for _ in range(count)]
+        frames = FrameReader().feed(b''.join(wires))
+        wireBytes = len(wires[0])
+
+        record("encrypt", codecName, wireBytes, measure(lambda: codec.encrypt, [text] * count, batch))
+        record("send", codecName, wireBytes, measureSend(codec, wires, batch))
+        record("split", codecName, wireBytes, measure(newSplit, wires, batch))
+
+        def newDecrypt():
+            codec.newReceiver()
+            return codec.decrypt
+        record("decrypt", codecName, wireBytes, measure(newDecrypt, frames, batch))
+
+        record("e2e", codecName, wireBytes, measureEndToEnd(codec, payload, count, batch))
+        # paced runs take count / rate seconds, a few hundred operations give the percentiles
+        record("e2e-paced", codecName, wireBytes, measureEndToEnd(codec, payload, min(count, rate), batch, rate))
+    return results
+
+
+def printSummary(results, stream):
+    print("{:<10} {:<7} {:>7} {:>5} {:>12} {:>14} {:>9} {:>9} {:>12}".format(
+        "stage", "format", "bytes", "batch", "ops/s", "messages/s", "p50 us", "p99 us", "alloc B/msg"), file=stream)
+    for result in results:
+        print("{:<10} {:<7} {:>7} {:>5} {:>12.0f} {:>14.0f} {:>9.1f} {:>9.1f} {:>12}".format(
+            result["stage"], result["format"] or "-", result["messageBytes"], result["batch"], result["opsPerSec"],
+            result["messagesPerSec"], result["p50Us"], result["p99Us"],
+            "{:.0f}".format(result["allocBytesPerMessage"]) if "allocBytesPerMessage" in result else "-"), file=stream)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the laptop -> ultra96 messaging path")
+    parser.add_argument("--ops", type=int, default=2000, help="operations per stage and case")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[128, 1024, 8192], help="json message sizes in bytes")
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 8], help="messages per batch")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(FORMATS), help="transport formats")
+    parser.add_argument("--rate", type=int, default=200, help="operations a second of the paced end to end runs")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated messages")
+    parser.add_argument("--output", help="file for the json results, stdout if not given")
+    args = parser.parse_args()
+    if args.rate <= 0:
+        parser.error("--rate must be positive")
+
+    rng = random.Random(args.seed)
+    results = []
+    for size in args.sizes:
+        for batch in args.batches:
+            count = max(WARMUP_OPS, min(args.ops, MAX_CASE_BYTES // (size * batch)))
+            print("{} B messages, batches of {}: {} operations".format(size, batch, count), file=sys.stderr)
+            results += runCase(args.formats, size, batch, count, args.rate, rng)
+
+    report = {
+        "environment" : {
+            "python" : platform.python_version(),
+            "machine" : platform.machine(),
+            "system" : platform.system(),
+            "gcm" : "cryptography" if AESGCM is not None else "cryptodome",
+            "time" : time.time(),
+        },
+        "settings" : vars(args),
+        "results" : results,
+    }
+    printSummary(results, sys.stderr)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
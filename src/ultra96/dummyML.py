@@ -1,41 +1,63 @@
-import sys
+import logging
+import numpy as np
 import pandas
+import queue
 import random
 import preprocess
+from Util.logger import getLogger
+
+logger = getLogger("dummyML")
+
 DECODE = {0: "dab", 1: "listen", 2: "pointhigh"}
 ENCODE = {"dab": 0, "listen": 1, "pointhigh": 2}
 
+# Samples per window when the laptop sends single samples instead of move segments
+WINDOW_SIZE = 30
+# How long handleML waits for data before checking for shutdown again
+POLL_TIMEOUT_SEC = 0.1
+
 def handleML(inputQueue, output, moveCompletedFlag, evalClient, globalShutDown, doClockSync):
     try:
         # test_model = load_model("MLP")
-        print("Initializing ML model")
+        logger.info("Initializing ML model")
         # tflite_model = tflite.Interpreter(model_path="model.tflite")
         # tflite_model.allocate_tensors()
-        print("Initialization done")
+        logger.info("Initialization done")
         while True:
             if globalShutDown.is_set():
                 return
-            dataFrame = []
-            if inputQueue.qsize() > 29: 
-                print("queue > 40, processing data")
-                for _ in range(30):
-                    dataPoint = inputQueue.get()
-                    dataPoint.pop('moveFlag')
-                    dataPoint.pop('Id')
-                    dataPoint.pop('time')
-                    dataFrame.append(dataPoint)
-                print("dataframe retrieved")
-                # print(dataFrame)
-                pdDataFrame = pandas.DataFrame(dataFrame)
-                print(pdDataFrame)
+            try:
+                item = inputQueue.get(timeout=POLL_TIMEOUT_SEC)
+            except queue.Empty:
+                continue
+            if "features" in item:
+                # features already extracted by the laptop
+                data_to_evaluate = np.asarray(item["features"])
+            else:
+                if "samples" in item:
+                    # a complete move segment assembled by the laptop
+                    pdDataFrame = preprocess.segment_to_dataframe(item)
+                else:
+                    # single samples, wait for a full window
+                    dataFrame = [item]
+                    while len(dataFrame) < WINDOW_SIZE:
+                        dataFrame.append(inputQueue.get())
+                    for dataPoint in dataFrame:
+                        dataPoint.pop('moveFlag')
+                        dataPoint.pop('Id')
+                        dataPoint.pop('time')
+                    pdDataFrame = pandas.DataFrame(dataFrame)
+                logger.debug("dataframe retrieved")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("\n%s", pdDataFrame)
                 data_to_evaluate = preprocess.process_data_stream(pdDataFrame)
-                prediction = random.randint(0,2)
-                output = DECODE[prediction]
-                print(output)
-                evalClient.sendToEval(action=ENCODE[output],positions=1)
-                moveCompletedFlag.set()
-                doClockSync.set()
-                while not inputQueue.empty():
-                    inputQueue.get()
+            prediction = random.randint(0,2)
+            output = DECODE[prediction]
+            logger.info("Prediction: %s", output)
+            evalClient.sendToEval(action=ENCODE[output],positions=1)
+            moveCompletedFlag.set()
+            doClockSync.set()
+            while not inputQueue.empty():
+                inputQueue.get()
     except:
-        print(sys.exc_info())
+        logger.exception("handleML stopped")
@@ -2,6 +2,7 @@ from concurrent.futures import thread
 from socket import setdefaulttimeout
 import threading
 from server import Ultra96Server
+from asyncServer import AsyncUltra96Server
 import concurrent.futures
 import threading
 from evalClient import EvalClient
@@ -11,18 +12,23 @@ from dummyML import handleML
 import sys
 
 class ControlMain():
-    def __init__(self):
+    def __init__(self, asyncServer=False):
         self.lockDataQueue = threading.Lock()
         self.dancerDataDict = {}
         self.output = None
         self.moveCompletedFlag = threading.Event()
         self.globalShutDown = threading.Event()
 
-        #if true, then broadcast clock sync. If false, wait for move eval then set to true
+        # set by handleML after every move evaluation, clock sync rounds are
+        # scheduled by each dancer's ClockSync in Ultra96Server.handleClockSync
         self.doClockSync = threading.Event()
         self.doClockSync.set()
 
-        self.ultra96Server = Ultra96Server(host='127.0.0.1', port=10022, key="Sixteen byte key", controlMain=self)
+        # asyncServer serves every dancer from one event loop thread, see asyncServer.py,
+        # instead of handleClient and handleClockSync threads per dancer
+        self.asyncServer = asyncServer
+        serverClass = AsyncUltra96Server if asyncServer else Ultra96Server
+        self.ultra96Server = serverClass(host='127.0.0.1', port=10022, key="Sixteen byte key", controlMain=self)
         self.evalClient = EvalClient('127.0.0.1', 8888, controlMain=self)
         
     def run(self):
@@ -36,17 +42,20 @@ class ControlMain():
         executor = concurrent.futures.ThreadPoolExecutor()
         print(dancerIDList)
         
-        for dancer in dancerIDList:
-            executor.submit(self.ultra96Server.handleClient, dancer)
+        # with the async server the executor only runs the ML loops, the server's
+        # event loop already serves the dancers and schedules their clock sync
+        if not self.asyncServer:
+            for dancer in dancerIDList:
+                executor.submit(self.ultra96Server.handleClient, dancer)
         
         
-        # for _ in range(10):
-        #     self.ultra96Server.broadcastMessage('sync')
-        #     time.sleep(0.5)
+            # for _ in range(10):
+            #     self.ultra96Server.broadcastMessage('sync')
+            #     time.sleep(0.5)
 
-        time.sleep(3)
-        for dancer in dancerIDList:
-            executor.submit(self.ultra96Server.handleClockSync, dancer)
+            time.sleep(3)
+            for dancer in dancerIDList:
+                executor.submit(self.ultra96Server.handleClockSync, dancer)
         input("Press Enter to connect to eval server")
         try:
             self.evalClient.connectToEval()
@@ -83,5 +92,6 @@ class ControlMain():
         print(self.dancerDataDict)
 
 if __name__ == "__main__":
-    controlMain = ControlMain()
+    # python main.py [async]
+    controlMain = ControlMain(asyncServer="async" in sys.argv[1:])
     controlMain.run()
@@ -9,6 +9,9 @@ SAMPLING = 30
 # Sliding Window Overlap in %
 SLIDING = 0.5
 
+# Raw sample columns that are not features
+NON_FEATURE_COLUMNS = ["Id", "moveFlag", "time"]
+
 # Data Directory
 CURRENT_DIR = os.getcwd()
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
@@ -41,7 +44,6 @@ def extract_segment(segment, functions):
 
     extracted_segment = row
 
-    print(extracted_segment.shape)
     return extracted_segment
 
 
@@ -125,6 +127,12 @@ def process_data_stream(data_stream):
     return extracted_feature
 
 
+def segment_to_dataframe(segment):
+    # segment is a move window from the laptop: {"columns": [...], "samples": [[...], ...]}
+    df = pd.DataFrame(segment["samples"], columns=segment["columns"])
+    return df.drop(columns=NON_FEATURE_COLUMNS)
+
+
 def process_data_test():
     extracted_features = pd.DataFrame()
     col_names = ["accX", "accY", "accZ", "gyroX", "gyroY", "gyroZ"]
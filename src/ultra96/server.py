@@ -1,19 +1,34 @@
 from multiprocessing import Queue
 import socket
-import sys
+import queue
 import json
 import threading
-import concurrent.futures
 import time
-from types import DynamicClassAttribute
-from Util.encryption import EncryptionHandler
+from Util.encryption import EncryptionHandler, SESSION_NONCE_BYTES
+from Cryptodome.Random import get_random_bytes
+from Util.framing import (StreamFramer, FramingError, TYPE_SEGMENT, TYPE_TAGGED, encryptFrame, decryptFrame,
+                          encodeTagged, decodeTagged, copyFrame)
+from Util.sample_codec import COLUMNS, MOVE_FLAG, TIME, decodeSamples
+from Util.clock_sync import ClockSync
+from Util.clock_channel import (CLOCK_PORT_OFFSET, PACKET, SYNC, REQUEST, REPLY, RESULT,
+                                packPacket, recvPacket, setNoDelay)
+from Util.logger import getLogger, RateLimitedLogger
+
+logger = getLogger("server")
+hotPathLogger = RateLimitedLogger(logger)
 
 NUM_DANCERS = 1
-
-def variance(data, ddof=0):
-    n = len(data)
-    mean = sum(data) / n 
-    return sum((x - mean) ** 2 for x in data) / (n - ddof)
+# Sync rounds sent back to back while a dancer's offset is too uncertain
+SYNC_ROUNDS_PER_BURST = 10
+# How long a sync round waits for the dancer's offset reply
+SYNC_RESPONSE_TIMEOUT_SEC = 1
+# Pause after a burst that didn't bring the error under ClockSync.maxError, so a
+# slow link isn't flooded with sync rounds it can't get any better from
+MIN_RESYNC_INTERVAL_SEC = 10
+# How long a clock channel may wait for its dancer to identify on the data socket
+CLOCK_CHANNEL_IDENTIFY_TIMEOUT_SEC = 2
+# How long a new connection has to identify
+IDENTIFY_TIMEOUT_SEC = 5
 
 class Ultra96Server():
     # Tuple containing "host" and "port" values for ultra96 server
@@ -28,82 +43,367 @@ class Ultra96Server():
     # Holds last timestamps from the 3 dancers/laptops
     currTimeStamps = {}
 
-    # Holds the last 10 recorded offsets from the 3 dancers
-    # 2d array containing 10 lists of 3 offsets from each dancer 
-    last10Offsets = {}
-
-    # Used to iterate offset list from the back in order to update offsets
-    currIndexClockOffset = {}
-
-    # Holds average offsets for 3 dancers, calculated from last10Offsets
-    currAvgOffsets = {}
+    # ClockSync of each dancer, the offset and drift of its laptop's clock and how sure they are
+    clockSyncs = {}
 
     # Booleans to check if current moves have been received for each dancer
     currentMoveReceived = {}
 
-    # Count to keep track of number of clock sync updates sent from each client
-    # in current rotation (1-10)
-    clocksyncCount = {}
-
     # To synchronize clock sync broadcasts and offset receiving
     clockSyncResponseLock = {}
 
+    # StreamFramer of each dancer's connection, it also knows if the laptop uses the legacy format
+    readers = {}
+
+    # Frames received together with a dancer's ID, handled first by handleClient
+    pendingFrames = {}
+
+    # Clock channel socket of each dancer that opened one and the lock for writing to it
+    clockChannels = {}
+
+    # Lock for writing to each dancer's connection, shared by the dancers behind one aggregator
+    sendLocks = {}
+
+    # SessionCipher of each dancer that asked for session mode at identification
+    sessions = {}
+
+    # Dancers behind an aggregator, handleAggregator passes them their frames through these queues
+    muxQueues = {}
+
+    # Latest BLE link stats (loss, jitter, ring buffer overruns) reported by each dancer's laptop
+    linkStats = {}
+
+    # Connection each dancer's handleClient is reading, so a dancer never gets two
+    handlerConns = {}
+
+    # When each dancer's connection was last lost
+    lostTimes = {}
+
+    # Timestamps of the rejoins whose dancer hasn't sent data yet, see attachDancer and addData
+    rejoins = {}
+
+    # Reconnect times of every rejoin of each dancer: seconds down, accept to identified
+    # and accept to the first data (reconnect-to-streaming)
+    rejoinStats = {}
+
     def __init__(self, host:str, port:int, key:str, controlMain):
         self.controlMain = controlMain
         self.connection = (host,port)
         self.encryptionHandler = EncryptionHandler(key.encode())
         self.lockDataQueue = controlMain.lockDataQueue
-        self.doClockSync = controlMain.doClockSync
         self.dancerDataDict = controlMain.dancerDataDict
         self.moveCompletedFlag = controlMain.moveCompletedFlag
         self.globalShutDown = controlMain.globalShutDown
+        self.numDancers = NUM_DANCERS
+        # Set once numDancers dancers have identified
+        self.allConnected = threading.Event()
+        # Serializes identification, which runs in a thread per new connection
+        self.joinLock = threading.Lock()
+        # Set once 'start' has been broadcast, a dancer rejoining after it is sent its own
+        self.evalStarted = threading.Event()
         
         return
 
-    def recvall(self,conn: socket.socket):
-        fullMessageReceived = False
-        data = b''
-        while not fullMessageReceived:
-            data += conn.recv(1024)
-            if data[-1] == 44: # 44 corresponds to ',' which is delimiter for end of b64 encoded msg
-                fullMessageReceived = True
-        return data
+    def recvFrames(self, conn: socket.socket, reader: StreamFramer):
+        # Blocks until at least one complete frame has arrived, the frames are only valid
+        # until the next call with the same reader
+        while True:
+            frames = reader.recv(conn)
+            if frames:
+                return frames
+
+    def nextFrames(self, conn, reader, muxQueue):
+        # Blocks until frames arrive, from the aggregator's muxQueue for a dancer behind an
+        # aggregator, returns them and their receive time
+        if muxQueue is not None:
+            item = muxQueue.get()
+            if item is None:
+                raise ConnectionError("aggregator connection lost")
+            return item
+        frames = self.recvFrames(conn, reader)
+        return frames, time.time()
+
+    def encodeMessage(self, message, dancerID):
+        # Legacy laptops get a bare base64 message, which they read with a single recv
+        if self.readers[dancerID].legacy:
+            return self.encryptionHandler.encrypt_msg(message)
+        if dancerID in self.muxQueues:
+            return encodeTagged(dancerID, encryptFrame(message, self.encryptionHandler))
+        return encryptFrame(message, self.encryptionHandler, session=self.sessions.get(dancerID))
+
+    def sendToDancer(self, dancerID, message):
+        conn, addr = self.clients[dancerID]
+        with self.sendLocks[dancerID]:
+            conn.sendall(self.encodeMessage(message, dancerID))
 
     def initializeConnections(self, numDancers = NUM_DANCERS):
+        # Blocks until numDancers dancers have identified. Connections are accepted for as
+        # long as the server runs, so a dancer whose connection dropped can rejoin.
+        self.numDancers = numDancers
         mySocket = socket.socket()
         # host,port = self.connection
         mySocket.bind((self.connection))
         mySocket.listen(5)
+        threading.Thread(target=self.acceptClockChannels, daemon=True).start()
+        threading.Thread(target=self.acceptConnections, args=(mySocket,), daemon=True).start()
+        while not self.allConnected.wait(0.5):
+            if self.globalShutDown.is_set():
+                return
+
+    def acceptConnections(self, mySocket):
+        # Every connection identifies in a thread of its own, a slow or silent one holds nobody up
+        while not self.globalShutDown.is_set():
+            try:
+                conn, addr = mySocket.accept()
+            except OSError as e:
+                logger.error("Accepting connections failed: %s", e)
+                return
+            logger.info("Accepted %s %s", conn, addr)
+            threading.Thread(target=self.handleConnection, args=(conn, addr, time.time()), daemon=True).start()
+
+    def handleConnection(self, conn, addr, acceptTime):
+        reader = StreamFramer()
+        try:
+            conn.settimeout(IDENTIFY_TIMEOUT_SEC)
+            frames = self.recvFrames(conn, reader)
+            hello = self.identify(frames[0])
+            conn.settimeout(None)
+        except (OSError, ValueError, KeyError) as e:
+            # OSError covers the timeout and a lost connection, ValueError a bad frame or message
+            logger.warning("Connection from %s failed to identify: %s", addr, e)
+            conn.close()
+            return
+        aggregator = hello['command'] == "aggregator"
+        dancerIDs = hello['dancers'] if aggregator else [hello['dancer']]
+        with self.joinLock:
+            newCount = len([dancerID for dancerID in dancerIDs if dancerID not in self.clients])
+            if len(self.clients) + newCount > self.numDancers:
+                logger.warning("Refusing %s from %s, already serving %s", dancerIDs, addr, list(self.clients))
+                conn.close()
+                return
+            sendLock = threading.Lock()
+            if aggregator:
+                # an aggregator, it introduces all the dancers it carries at once
+                logger.info("Aggregator %s with dancers %s", addr, dancerIDs)
+                for dancerID in dancerIDs:
+                    # frames behind an aggregator are encrypted with the shared key
+                    self.sessions.pop(dancerID, None)
+                    self.attachDancer(dancerID, conn, addr, reader, sendLock, queue.Queue(), acceptTime)
+                threading.Thread(target=self.handleAggregator, args=(conn, addr, reader, dancerIDs, frames[1:]), daemon=True).start()
+            else:
+                dancerID = hello['dancer']
+                logger.info("Dancer ID: %s, legacy framing: %s", dancerID, reader.legacy)
+                self.pendingFrames[dancerID] = [copyFrame(frame) for frame in frames[1:]]
+                # the laptop reads the session reply before anything else
+                if 'nonce' in hello:
+                    conn.sendall(self.startSession(dancerID, bytes.fromhex(hello['nonce'])))
+                else:
+                    # rejoining without a session, the old one would reject its frames
+                    self.sessions.pop(dancerID, None)
+                self.attachDancer(dancerID, conn, addr, reader, sendLock, None, acceptTime)
+            if len(self.clients) >= self.numDancers:
+                self.allConnected.set()
+        # Dancers joining before allConnected are started by ControlMain, handleClient
+        # makes sure only one of the two serves them
+        if self.allConnected.is_set():
+            for dancerID in dancerIDs:
+                threading.Thread(target=self.handleClient, args=(dancerID,), daemon=True).start()
+
+    def attachDancer(self, dancerID, conn, addr, reader, sendLock, muxQueue, acceptTime):
+        # Adds a new dancer, or moves a rejoining one over to its new connection. A rejoining
+        # dancer keeps its clock sync, data queue and session, the other dancers carry on.
+        # muxQueue is the dancer's queue when it is behind an aggregator, None otherwise.
+        oldQueue = self.muxQueues.pop(dancerID, None)
+        if muxQueue is not None:
+            self.muxQueues[dancerID] = muxQueue
+        if dancerID not in self.clients:
+            self.addDancer(dancerID, conn, addr, reader, sendLock)
+            return
+        oldConn, oldAddr = self.clients[dancerID]
+        self.clients[dancerID] = (conn, addr)
+        self.readers[dancerID] = reader
+        self.sendLocks[dancerID] = sendLock
+        # unblocks a handleClient still waiting on the old connection, which is left
+        # open while other dancers behind the same aggregator use it
+        if oldQueue is not None:
+            oldQueue.put_nowait(None)
+        if not any(other is oldConn for other, _ in self.clients.values()):
+            self.closeConnection(oldConn)
+        lostTime = self.lostTimes.get(dancerID)
+        identifiedTime = time.time()
+        self.rejoins[dancerID] = (acceptTime, identifiedTime)
+        logger.info("Dancer %s rejoined from %s, down %s, identified %.0f ms after accept", dancerID, addr,
+                    "{:.1f} s".format(acceptTime - lostTime) if lostTime is not None else "for an unknown time",
+                    (identifiedTime - acceptTime) * 1000)
+        # a restarted laptop drops its samples until it hears the eval has started
+        if self.evalStarted.is_set():
+            try:
+                self.sendToDancer(dancerID, 'start')
+            except OSError as e:
+                logger.warning("Couldn't send start to %s: %s", dancerID, e)
 
+    def closeConnection(self, conn):
         try:
-            for _ in range(numDancers):
-                conn,addr = mySocket.accept()
-                print(conn,addr)
-                # data = conn.recv(4096)
-                data = self.recvall(conn)
-                print(data)
-                data = self.encryptionHandler.decrypt_message(data)
-                print("Dancer ID: ", data)
-                self.clients[data] = (conn,addr)
-                print(addr, '\n')
-
-                self.currIndexClockOffset[data] = 9 # initialize index counter to 9 for each dancer
-                self.last10Offsets[data] = [None for _ in range(10)] # initialize last 10 offsets for dancer id to None
-                self.currAvgOffsets[data] = None
-                self.currentMoveReceived[data] = False
-                self.clocksyncCount[data] = 0
-                self.dancerDataDict[data] = Queue()
-                self.clockSyncResponseLock[data] = threading.Event()
-            return 
-        except:
-            print(sys.exc_info(), "\n")
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def streamingAgain(self, dancerID):
+        # Records the reconnect-to-streaming time of a rejoined dancer's first data
+        rejoin = self.rejoins.pop(dancerID, None)
+        if rejoin is None:
             return
+        acceptTime, identifiedTime = rejoin
+        lostTime = self.lostTimes.get(dancerID)
+        now = time.time()
+        stats = {
+            "downSec" : acceptTime - lostTime if lostTime is not None else None,
+            "identifySec" : identifiedTime - acceptTime,
+            "streamingSec" : now - acceptTime,
+        }
+        self.rejoinStats.setdefault(dancerID, []).append(stats)
+        logger.info("Dancer %s streaming again %.0f ms after reconnecting", dancerID, stats['streamingSec'] * 1000)
+
+    def identify(self, frame):
+        # The first message of a connection as a dict: {"command": "aggregator", "dancers": [...]}
+        # from an aggregator, {"command": "identify", "dancer": ..., "nonce": ...} from a laptop
+        # asking for session mode, and {"command": "identify", "dancer": ...} for a bare dancer ID
+        data = decryptFrame(frame, self.encryptionHandler)
+        if data.startswith("{"):
+            return json.loads(data)
+        return {"command" : "identify", "dancer" : data}
+
+    def startSession(self, dancerID, clientNonce):
+        # Agrees on the session key with the laptop, returns the reply frame for it. A laptop
+        # that reconnects with the nonce of its current session keeps it
+        session = self.sessions.get(dancerID)
+        if session is None or session.clientNonce != clientNonce:
+            session = self.encryptionHandler.newSession(clientNonce, get_random_bytes(SESSION_NONCE_BYTES), dancerID, True)
+            self.sessions[dancerID] = session
+        reply = {"command" : "session", "nonce" : session.serverNonce.hex()}
+        logger.info("Dancer %s in session mode", dancerID)
+        return encryptFrame(json.dumps(reply), self.encryptionHandler)
+
+    def addDancer(self, dancerID, conn, addr, reader, sendLock):
+        self.clients[dancerID] = (conn,addr)
+        self.readers[dancerID] = reader
+        self.sendLocks[dancerID] = sendLock
+
+        self.clockSyncs[dancerID] = ClockSync()
+        self.currentMoveReceived[dancerID] = False
+        self.dancerDataDict[dancerID] = Queue()
+        self.clockSyncResponseLock[dancerID] = threading.Event()
+
+    def handleAggregator(self, conn, addr, reader, dancerIDs, frames):
+        # Splits the tagged frames of an aggregator's connection up by dancer, for their handleClient
+        muxQueues = {dancerID : self.muxQueues[dancerID] for dancerID in dancerIDs}
+        try:
+            while True:
+                if not frames:
+                    frames = self.recvFrames(conn, reader)
+                self.dispatchTagged(frames, addr, time.time())
+                frames = []
+        except (ConnectionError, OSError, ValueError) as e:
+            # ValueError covers FramingError and a tag that isn't utf8
+            logger.error("Aggregator %s connection lost: %s", addr, e)
+            # the queues of this connection, a dancer that has rejoined already has a new one
+            for muxQueue in muxQueues.values():
+                muxQueue.put(None)
+
+    def dispatchTagged(self, frames, addr, timerecv):
+        # Queues the frames of an aggregator's connection for the handleClient of their dancers
+        received = {}
+        for frame in frames:
+            if frame.type != TYPE_TAGGED:
+                hotPathLogger.warning("Untagged frame from aggregator %s", addr)
+                continue
+            dancerID, inner = decodeTagged(frame.payload)
+            if dancerID not in self.muxQueues:
+                hotPathLogger.warning("Frame from aggregator %s for unknown dancer %s", addr, dancerID)
+                continue
+            # handleClient reads it after the aggregator connection's next recv
+            received.setdefault(dancerID, []).append(copyFrame(inner))
+        for dancerID, inner in received.items():
+            self.muxQueues[dancerID].put_nowait((inner, timerecv))
+
+    def acceptClockChannels(self):
+        # Laptops open their clock channel after identifying on the data socket
+        host, port = self.connection
+        clockSocket = socket.socket()
+        clockSocket.bind((host, port + CLOCK_PORT_OFFSET))
+        clockSocket.listen(5)
+        while not self.globalShutDown.is_set():
+            conn, addr = clockSocket.accept()
+            threading.Thread(target=self.handleClockChannel, args=(conn, addr), daemon=True).start()
+
+    def identifyClockChannel(self, conn, addr):
+        # Returns the dancer ID the channel belongs to, None if it isn't a known dancer.
+        # The channel can be quicker than the data socket the dancer identified on.
+        try:
+            setNoDelay(conn)
+            frames = self.recvFrames(conn, StreamFramer())
+            dancerID = decryptFrame(frames[0], self.encryptionHandler)
+        except (ConnectionError, FramingError, ValueError) as e:
+            logger.warning("Clock channel from %s failed to identify: %s", addr, e)
+            return None
+        deadline = time.time() + CLOCK_CHANNEL_IDENTIFY_TIMEOUT_SEC
+        while dancerID not in self.clockSyncs:
+            if time.time() > deadline:
+                logger.warning("Clock channel from %s for unknown dancer %s", addr, dancerID)
+                return None
+            time.sleep(0.01)
+        return dancerID
+
+    def handleClockChannel(self, conn, addr):
+        dancerID = self.identifyClockChannel(conn, addr)
+        if dancerID is None:
+            conn.close()
+            return
+        logger.info("Dancer %s opened a clock channel", dancerID)
+        self.clockChannels[dancerID] = (conn, threading.Lock())
+        buffer = bytearray(PACKET.size)
+        try:
+            while True:
+                fields, timeRecv = recvPacket(conn, buffer)
+                self.handleClockPacket(dancerID, fields, timeRecv)
+        except (ConnectionError, OSError) as e:
+            # clock sync falls back to the data socket
+            logger.warning("%s clock channel lost: %s", dancerID, e)
+            # a rejoined dancer may have opened its next channel already
+            if self.clockChannels.get(dancerID, (None,))[0] is conn:
+                self.clockChannels.pop(dancerID, None)
+            conn.close()
+
+    def handleClockPacket(self, dancerID, fields, timeRecv):
+        packetType, number, t1, t2, t3, t4 = fields
+        if packetType == REQUEST:
+            self.sendClockPacket(dancerID, packPacket(REPLY, number, t1, timeRecv, time.time()))
+        elif packetType == RESULT:
+            self.clockSyncs[dancerID].addSample(t1, t2, t3, t4)
+            self.clockSyncResponseLock[dancerID].set()
+
+    def sendClockPacket(self, dancerID, packet):
+        conn, lock = self.clockChannels[dancerID]
+        with lock:
+            conn.sendall(packet)
+
+    def requestClockSync(self, dancerID, number):
+        # Starts a sync round over the clock channel, or over the data socket without one
+        if dancerID in self.clockChannels:
+            try:
+                self.sendClockPacket(dancerID, packPacket(SYNC, number))
+                return
+            except (KeyError, OSError):
+                pass
+        self.sendToDancer(dancerID, 'sync')
 
     def calculateSyncDelay(self):
         sortedTimestamps = sorted(self.currTimeStamps.values())
         return (sortedTimestamps[-1] - sortedTimestamps[0])
 
     def addData(self, dancerID, data):
+        if dancerID in self.rejoins:
+            self.streamingAgain(dancerID)
         with self.lockDataQueue:
             if not self.moveCompletedFlag.is_set():
                 self.dancerDataDict[dancerID].put(data)
@@ -112,139 +412,192 @@ class Ultra96Server():
                     self.dancerDataDict[dancerID].get()
 
     def updateTimeStamp(self, message : str, dancerID):
-        print("Evaluating move...")
-        print(f"time recorded by bluno:", {message})
+        logger.info("Evaluating move...")
+        logger.debug("time recorded by bluno: %s", message)
 
         #calculate relative time using offset
         timestamp = float(message)
-        relativeTS = timestamp - self.currAvgOffsets[dancerID]
+        clockSync = self.clockSyncs[dancerID]
+        if clockSync.needsSync(timestamp):
+            logger.warning("%s clock offset may be off by %.1f ms", dancerID, clockSync.error(timestamp) * 1000)
+        relativeTS = clockSync.toRemote(timestamp)
         self.currTimeStamps[dancerID] = relativeTS
-        print(dancerID, "adjusted timestamp: ", relativeTS)
+        logger.info("%s adjusted timestamp: %s", dancerID, relativeTS)
+
+    def startMove(self, timestamp, dancerID):
+        self.moveCompletedFlag.clear()
+        self.updateTimeStamp(timestamp, dancerID)
+        self.currentMoveReceived[dancerID] = True
+
+    def handleSegment(self, records, dancerID):
+        # A binary move segment stands for a timestamp message followed by a segment message,
+        # the move starts at the first moving sample, after the pre-roll
+        moveStartTime = next((record[TIME] for record in records if record[MOVE_FLAG] == 1), records[0][TIME])
+        self.startMove(moveStartTime, dancerID)
+        self.addData(dancerID, {"columns" : COLUMNS, "samples" : records})
+
+    def handleMessage(self, data, dancerID, timerecv):
+        # Acts on one decoded message from a dancer, returns False on shutdown
+        if data['command'] == "shutdown":
+            logger.info('%s Received shutdown signal', dancerID)
+            return False
+        elif data['command'] == "clocksync":
+            self.respondClockSync(data['message'], dancerID, timerecv)
+        elif data['command'] == "offset":
+            self.updateOffset(data, dancerID)
+            self.clockSyncResponseLock[dancerID].set()
+        elif data['command'] == "timestamp":
+            self.startMove(data['message'], dancerID)
+            # if all(value == True for value in self.currentMoveReceived.values()):
+            #     print(f"Sync delay calculated:", {self.calculateSyncDelay()})
+            #     self.currentMoveReceived = {key: False for key in self.currentMoveReceived.keys()}
+        elif data['command'] == "batch":
+            # several messages sent together by the laptop's BatchSender
+            for message in data['messages']:
+                if not self.handleMessage(message, dancerID, timerecv):
+                    return False
+        elif data['command'] == "data":
+            data.pop('command')
+            self.addData(dancerID, data)
+        elif data['command'] == "segment" or data['command'] == "features":
+            # a complete move window or its features, queued as one item for handleML
+            self.addData(dancerID, data['message'])
+        elif data['command'] == "linkstats":
+            self.linkStats[dancerID] = data['message']
+            for index, stats in enumerate(data['message']['devices']):
+                logger.info("%s bluno %d: received %d, lost %d, loss rate %.2f%%, checksum failure rate %.2f%%, jitter %.1f ms",
+                            dancerID, index, stats['received'], stats['lost'], stats['lossRate'] * 100,
+                            stats['checksumFailureRate'] * 100, stats['jitterMs'])
+            outbound = data['message'].get('outbound')
+            if outbound is not None:
+                logger.info("%s outbound queue: depth %d, oldest %.0f ms, shed %.1f samples/s in %.1f messages/s, stale %.1f/s",
+                            dancerID, outbound['depth'], outbound['oldestAgeMs'], outbound['shedSamplesPerSec'],
+                            outbound['shedPerSec'], outbound['stalePerSec'])
+            spool = data['message'].get('spool')
+            if spool is not None and spool['spooled']:
+                logger.info("%s reconnect spool: %d frames spooled, %d replayed, %d discarded",
+                            dancerID, spool['spooled'], spool['replayed'], spool['discarded'])
+        elif data['command'] == "moveComplete":
+            pass
+            # self.moveCompletedFlag.clear()
+        return True
 
     def handleClient(self, dancerID : str):
-        conn,addr = self.clients[dancerID]
+        # Serves dancerID's current connection until it is lost, or replaced by a rejoin
+        conn, addr = self.clients[dancerID]
+        reader, muxQueue = self.readers[dancerID], self.muxQueues.get(dancerID)
+        with self.joinLock:
+            if self.handlerConns.get(dancerID) is conn:
+                return
+            self.handlerConns[dancerID] = conn
+        frames = self.pendingFrames.pop(dancerID, [])
         while True:
             if self.globalShutDown.is_set():
                 return
+            if self.clients[dancerID][0] is not conn:
+                logger.info("%s moved to a new connection", dancerID)
+                return
             try:
-                # receivedFromBuffer = conn.recv(4096)
-                receivedFromBuffer = self.recvall(conn)
-                timerecv = time.time()
-                packets = receivedFromBuffer.decode('utf8').split(",") #Split into b64encoded packets by ',' delimiter
-                packets.pop(-1)
+                if frames:
+                    timerecv = time.time()
+                else:
+                    frames, timerecv = self.nextFrames(conn, reader, muxQueue)
+                received, frames = frames, []
                 # print("data received at ", timerecv, data)
-                for packet in packets:
-                    data = self.encryptionHandler.decrypt_message(packet)
-                    if not data:
-                        continue
-                    data = json.loads(data)
-                    # print("Received data:" + json.dumps(data) + "\n")
-                    # print(data.decode("utf8"))
-        
-                    if data['command'] == "shutdown":
-                        print(dancerID, ' Received shutdown signal\n')
-                        break
-                    elif data['command'] == "clocksync":
-                        self.respondClockSync(data['message'], dancerID, timerecv)
-                    elif data['command'] == "offset":
-                        self.clockSyncResponseLock[dancerID].set()
-                        self.updateOffset(data['message'], dancerID)
-                    elif data['command'] == "timestamp":
-                        self.moveCompletedFlag.clear()
-                        self.updateTimeStamp(data['message'], dancerID)
-                        self.currentMoveReceived[dancerID] = True
-                        # if all(value == True for value in self.currentMoveReceived.values()):
-                        #     print(f"Sync delay calculated:", {self.calculateSyncDelay()})
-                        #     self.currentMoveReceived = {key: False for key in self.currentMoveReceived.keys()}
-                    elif data['command'] == "data":
-                        data.pop('command')
-                        self.addData(dancerID, data)
-                    elif data['command'] == "moveComplete":
-                        pass
-                        # self.moveCompletedFlag.clear()
-            except UnicodeDecodeError:
-
-                print("Packet incorrectly received")
-                pass
-            except Exception as e:
-                print("[ERROR][", dancerID, "] -> ", e)
-                print(self.dancerDataDict[dancerID].qsize())
-                pass
+                for frame in received:
+                    if not self.handleFrame(frame, dancerID, timerecv):
+                        logger.info("%s RETURNING", dancerID)
+                        return
+            except (ConnectionError, FramingError) as e:
+                # the stream can't be resynchronised after a bad frame
+                if self.clients[dancerID][0] is conn:
+                    self.lostTimes[dancerID] = time.time()
+                logger.error("%s connection lost: %s", dancerID, e)
+                logger.info("%s received %d bytes in %d recvs, %d bytes of cut off frames moved",
+                            dancerID, reader.bytesReceived, reader.recvCount, reader.bytesMoved)
+                return
 
             # decrypted_msg = encryptionHandler.decrypt_message(data)
-        print(dancerID, " RETURNING\n")
+        logger.info("%s RETURNING", dancerID)
         return
 
+    def handleFrame(self, frame, dancerID, timerecv):
+        # Decodes one frame from dancerID and acts on it, returns False on shutdown. A frame
+        # that can't be decoded is skipped, errors of the connection itself are raised
+        try:
+            data = decryptFrame(frame, self.encryptionHandler, self.sessions.get(dancerID))
+            if frame.type == TYPE_SEGMENT:
+                self.handleSegment(decodeSamples(data), dancerID)
+                return True
+            if not data:
+                return True
+            data = json.loads(data)
+            # print("Received data:" + json.dumps(data) + "\n")
+            return self.handleMessage(data, dancerID, timerecv)
+        except (ConnectionError, FramingError):
+            raise
+        except UnicodeDecodeError:
+            hotPathLogger.warning("Packet incorrectly received")
+        except Exception as e:
+            hotPathLogger.error("[ERROR][%s] -> %s, queue size %d", dancerID, e, self.dancerDataDict[dancerID].qsize())
+        return True
+
 
     def handleClockSync(self, dancerID):
-        while True:
-            if self.globalShutDown.is_set():
-                return
-            self.doClockSync.wait()
-            for _ in range(10):
-                self.broadcastMessage('sync')
+        # Sync rounds are scheduled by the dancer's ClockSync: a burst whenever its error
+        # estimate is over the limit, otherwise nothing until drift brings it there
+        clockSync = self.clockSyncs[dancerID]
+        while not self.globalShutDown.is_set():
+            rounds = 0
+            while rounds < SYNC_ROUNDS_PER_BURST and clockSync.needsSync(clockSync.toLocal(time.time())):
                 self.clockSyncResponseLock[dancerID].clear()
-                self.clockSyncResponseLock[dancerID].wait()
-            self.doClockSync.clear()
-
-    # Check if variance between 10 offsets in dancerID is too high.
-    # If so, force another 10 updates with the specific dancerID
-    def checkOffsetVar(self, dancerID):
-        conn,addr = self.clients[dancerID]
-        self.updateAvgOffset()
-
-        varLast10 = variance(self.last10Offsets[dancerID])
-        print("VARIANCE FOR DANCER: ", dancerID, varLast10)
-        if varLast10 > 1e-05:
-            print("Offset variance too high: ", "varLast10",
-                "Resyncing for Dancer: ", dancerID)
-            conn.send(self.encryptionHandler.encrypt_msg("sync"))
-        
-        return
-            
-    def updateOffset(self, message: str, dancerID):
-        # self.offsetLock.acquire()
-        # print(f"{dancerID} has received offsetlock")
-        self.last10Offsets[dancerID][self.currIndexClockOffset[dancerID]] = float(message)
-        self.currIndexClockOffset[dancerID] = (self.currIndexClockOffset[dancerID] - 1) % 10
-        # print(f"{dancerID} is releasing offsetlock")
-        # self.offsetLock.release()
-
-        if self.clocksyncCount[dancerID] != 10:
-            self.clocksyncCount[dancerID] += 1
-
-        if self.clocksyncCount[dancerID] == 10:
-            self.checkOffsetVar(dancerID)
-            self.clocksyncCount[dancerID] = 0
-            
-        print("Updating dancer " + str(dancerID) + " offset to: " + message + "\n")
-        return
+                try:
+                    self.requestClockSync(dancerID, clockSync.syncCount)
+                except OSError as e:
+                    # the dancer is gone for now, it is synced again once it rejoins
+                    logger.warning("%s clock sync failed: %s", dancerID, e)
+                    break
+                if not self.clockSyncResponseLock[dancerID].wait(SYNC_RESPONSE_TIMEOUT_SEC):
+                    logger.warning("%s didn't answer clock sync", dancerID)
+                rounds += 1
+            self.globalShutDown.wait(self.nextClockSync(dancerID, rounds))
+
+    def nextClockSync(self, dancerID, rounds):
+        # Logs dancerID's clock after a burst of rounds, returns the seconds until the next burst
+        clockSync = self.clockSyncs[dancerID]
+        now = clockSync.toLocal(time.time())
+        state = clockSync.state(now)
+        logger.info("%s clock offset %.6f s, skew %.1f ppm, error %.2f ms after %d sync rounds",
+                    dancerID, state['offset'], state['skewPpm'], state['errorMs'], rounds)
+        delay = clockSync.nextSyncDelay(now)
+        if delay == 0:
+            delay = MIN_RESYNC_INTERVAL_SEC
+        return delay
+
+    def updateOffset(self, data, dancerID):
+        # Laptops send the timestamps of the exchange, older ones only their offset
+        if 'timestamps' in data:
+            self.clockSyncs[dancerID].addSample(*data['timestamps'])
+        else:
+            clockSync = self.clockSyncs[dancerID]
+            clockSync.addOffset(clockSync.toLocal(time.time()), float(data['message']))
+        logger.debug("Updating dancer %s offset to: %s", dancerID, data['message'])
 
     def broadcastMessage(self, message):
-        print("BROADCASTING: ", message)
-        message = self.encryptionHandler.encrypt_msg(message)
-        for conn, addr in self.clients.values():
-            conn.send(message)
+        logger.info("BROADCASTING: %s", message)
+        if message == 'start':
+            self.evalStarted.set()
+        for dancerID in list(self.clients):
+            try:
+                self.sendToDancer(dancerID, message)
+            except OSError as e:
+                logger.warning("Couldn't send %s to %s: %s", message, dancerID, e)
 
     def respondClockSync(self, message : str, dancerID, timerecv):
-        print(f"Received clock sync request from dancer, {dancerID}")
+        logger.debug("Received clock sync request from dancer, %s", dancerID)
         timestamp = message
-        print(f"t1 =",{timestamp})
-        conn, addr = self.clients[dancerID]
+        logger.debug("t1 = %s", timestamp)
 
         # response = str(timerecv) + "|" + str(time.time())
         response = json.dumps({'command' : 'clocksync', 'message': str(timerecv) + '|' + str(time.time())})
-        conn.send(self.encryptionHandler.encrypt_msg(response))
-
-    def updateAvgOffset(self):
-        for dancerID, offsetList in self.last10Offsets.items():
-            currSum = 0
-            numOffsets = 10
-            for offset in offsetList:
-                if offset is None:
-                    numOffsets -= 1
-                    continue
-                currSum += offset
-            if numOffsets == 0:
-                continue
-            self.currAvgOffsets[dancerID] = currSum/numOffsets
+        self.sendToDancer(dancerID, response)